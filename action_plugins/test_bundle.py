@@ -0,0 +1,206 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# test_bundle.py is a third party action plugin for Ansible
+#
+# test_bundle.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# test_bundle.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sqlite3
+
+from ansible.module_utils.six import string_types
+from ansible.parsing.splitter import parse_kv
+from ansible.plugins import action_loader
+from ansible.utils.boolean import boolean
+
+# NOTE: Inherit the test_check action plugin so that the checks can be run
+# through the check agent. See action_plugins/test_check.py
+TestCheckAction = action_loader.get('test_check', class_only=True)
+
+
+class CheckCosts(object):
+    '''
+    The estimated costs of the checks on a host from the history database
+    which the test callback plugin writes (see test_history.py): the average
+    duration and the failure rate of each check of a task, or of its module
+    if the check has no history.
+    '''
+
+    # the seconds a check of each module is assumed to take without history
+    DEFAULT_DURATIONS = {
+        'test_command': 0.1,
+        'test_http': 0.1,
+        'test_pidfile': 0.01,
+        'test_port': 0.01,
+        'test_ps': 0.05,
+        'test_rpm': 0.1,
+        'test_service': 0.2,
+        'test_systemd': 0.05,
+    }
+    DEFAULT_DURATION = 0.1
+
+    # the failure rate a check is assumed to have without history
+    PRIOR_FAILURE_RATE = 0.05
+
+    # the number of the last runs whose results are used
+    HISTORY_RUNS = 10
+
+    FAILING_SQL = "('changed', 'failed', 'unreachable')"
+
+    def __init__(self, db_path, host, task):
+        # (average duration, failures, count) of the checks of the task and of the modules
+        self.checks = {}
+        self.modules = {}
+        if not db_path or not os.path.exists(db_path):
+            return
+        recent = 'run_id > (SELECT MAX(id) FROM runs) - %d' % self.HISTORY_RUNS
+        try:
+            db = sqlite3.connect(db_path, timeout=1.0)
+            try:
+                for check, duration, failures, count in db.execute('''
+                        SELECT check_name, AVG(duration), SUM(status IN %s), COUNT(*) FROM results
+                        WHERE host = ? AND task = ? AND check_name IS NOT NULL AND duration IS NOT NULL
+                          AND status != 'skipped' AND %s
+                        GROUP BY check_name''' % (self.FAILING_SQL, recent), (host, task)):
+                    self.checks[check] = (duration, failures, count)
+                for module, duration, failures, count in db.execute('''
+                        SELECT module, AVG(duration), SUM(status IN %s), COUNT(*) FROM results
+                        WHERE host = ? AND check_name IS NOT NULL AND duration IS NOT NULL
+                          AND status != 'skipped' AND %s
+                        GROUP BY module''' % (self.FAILING_SQL, recent), (host,)):
+                    self.modules[module] = (duration, failures, count)
+            finally:
+                db.close()
+        except sqlite3.Error:
+            # NOTE: The order is only an optimization, so run without history.
+            self.checks = {}
+            self.modules = {}
+
+    def priority(self, name, module):
+        '''
+        Returns the priority of a check, lower first: the estimated duration
+        divided by the estimated failure rate, so that the cheap checks which
+        are likely to fail run first.
+        '''
+        history = self.checks.get(name) or self.modules.get(module)
+        if history is None:
+            duration, failures, count = self.DEFAULT_DURATIONS.get(module, self.DEFAULT_DURATION), 0, 0
+        else:
+            duration, failures, count = history
+        failure_rate = (failures + self.PRIOR_FAILURE_RATE) / (count + 1)
+        return round(duration / failure_rate, 6)
+
+
+class ActionModule(TestCheckAction):
+    '''
+    Runs many checks in one test_bundle module execution.
+
+    Each check is written like a task, for example:
+
+        - test_bundle:
+            fail_fast: yes
+            checks:
+              - name: Check nginx version
+                test_rpm: name=nginx state=present
+              - name: Check nginx service state and enabled
+                test_service: name=nginx state=started enabled=True
+                depends_on: Check nginx version
+
+    A check runs after the checks named in its depends_on. With fail_fast,
+    a check whose prerequisite failed, changed or was skipped is skipped.
+    Of the checks which can run, the cheap ones which are likely to fail
+    run first, estimated from the history database of the test callback
+    plugin (the test_history_db variable, or TEST_CALLBACK_HISTORY_DB).
+    With order=given, they run in the given order instead. The results are
+    in the given order either way.
+
+    The load tests of test_http (with duration) can not be bundled, as they
+    must run as the test_http module.
+    '''
+
+    CHECK_MODULES = ('test_command', 'test_http', 'test_pidfile', 'test_port', 'test_ps', 'test_rpm', 'test_service')
+
+    def _run_test(self, result, task_vars):
+        ''' handler for bundled test operations '''
+        checks = self._task.args.get('checks', None)
+        workers = self._task.args.get('workers', 8)
+        fail_fast = boolean(self._task.args.get('fail_fast', False))
+        order = self._task.args.get('order', 'cost')
+
+        if not isinstance(checks, list):
+            result['failed'] = True
+            result['msg'] = "checks is required and must be a list"
+            return result
+
+        service_action = None
+        service_mgr = None
+        bundle = []
+        for check in checks:
+            modules = isinstance(check, dict) and [k for k in check if k in self.CHECK_MODULES] or []
+            if len(modules) != 1:
+                result['failed'] = True
+                result['msg'] = "each check must have exactly one of %s: %s" % (', '.join(self.CHECK_MODULES), check)
+                return result
+
+            module = modules[0]
+            args = check[module]
+            if isinstance(args, string_types):
+                args = parse_kv(args)
+            elif isinstance(args, dict):
+                args = args.copy()
+            else:
+                result['failed'] = True
+                result['msg'] = "arguments of %s must be a string or a dictionary: %s" % (module, args)
+                return result
+            if self._is_load_test(module, args):
+                result['failed'] = True
+                result['msg'] = "a load test of test_http can not be bundled: %s" % check
+                return result
+            name = check.get('name') or module
+            depends_on = check.get('depends_on') or []
+            if isinstance(depends_on, string_types):
+                depends_on = [depends_on]
+
+            if module == 'test_service':
+                if service_action is None:
+                    service_action = self._shared_loader_obj.action_loader.get('test_service',
+                        task=self._task, connection=self._connection, play_context=self._play_context,
+                        loader=self._loader, templar=self._templar, shared_loader_obj=self._shared_loader_obj)
+                use = args.get('use', 'auto').lower()
+                if use == 'auto':
+                    if service_mgr is None:
+                        service_mgr, detected = service_action._get_service_mgr(task_vars)
+                        if detected and (not self._task.delegate_to or self._task.delegate_facts):
+                            result['ansible_facts'] = dict(ansible_service_mgr=service_mgr)
+                    use = service_mgr
+                module, args = service_action._get_test_module_args(use, args)
+
+            bundle.append(dict(name=name, module=module, args=args, depends_on=depends_on))
+
+        if order == 'cost':
+            host = self._task.delegate_to or task_vars.get('inventory_hostname', '')
+            db_path = self._templar.template(task_vars.get('test_history_db', os.environ.get('TEST_CALLBACK_HISTORY_DB')))
+            costs = CheckCosts(db_path, host, self._task.get_name().strip())
+            for check in bundle:
+                check['priority'] = costs.priority(check['name'], check['module'])
+        elif order != 'given':
+            result['failed'] = True
+            result['msg'] = "order must be cost or given: %s" % order
+            return result
+
+        self._display.vvvv("test_bundle.ActionModule Running %d checks" % len(bundle))
+        result.update(self._execute_bundle(bundle, workers, task_vars, fail_fast))
+
+        return result
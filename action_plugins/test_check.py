@@ -0,0 +1,623 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# test_check.py is a third party action plugin for Ansible
+#
+# test_check.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# test_check.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import base64
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import select
+import socket
+import subprocess
+import time
+import zipfile
+import zlib
+from io import BytesIO
+
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.executor.module_common import recursive_finder
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.plugins.action import ActionBase
+from ansible.utils.boolean import boolean
+
+# The test modules which are loaded into the check agent.
+AGENT_MODULES = ('test_command', 'test_http', 'test_pidfile', 'test_port', 'test_ps', 'test_rpm', 'test_service', 'test_systemd')
+
+# The test modules whose checks have inputs for the incremental mode.
+# See CHECK_INPUTS in library/test_bundle.py
+INCREMENTAL_MODULES = ('test_rpm', 'test_service', 'test_systemd')
+
+# NOTE: The check agent is started with this script by `python -c`.
+# It reads a frame of the zip file which has library/test_bundle.py and
+# the module_utils files it imports, and runs test_bundle.serve() with
+# the rest of stdin. This must run on python 2.6 for CentOS 6.
+AGENT_BOOTSTRAP = '''
+import os, sys, tempfile
+data = b''
+while b'\\n' not in data or len(data) < data.index(b'\\n') + 1 + int(data[:data.index(b'\\n')]):
+    chunk = os.read(0, 65536)
+    if not chunk:
+        sys.exit(1)
+    data += chunk
+pos = data.index(b'\\n')
+end = pos + 1 + int(data[:pos])
+fd, path = tempfile.mkstemp(suffix='.zip')
+try:
+    os.write(fd, data[pos + 1:end])
+    os.close(fd)
+    sys.path.insert(0, path)
+    import test_bundle
+    test_bundle.serve(data[end:], idle_timeout=%(idle_timeout)d)
+finally:
+    os.unlink(path)
+'''
+
+
+class FrameReader(object):
+    ''' splits data read from a stream into frames (same as library/test_bundle.py) '''
+
+    def __init__(self):
+        self._buf = b''
+
+    def feed(self, data):
+        self._buf += data
+        frames = []
+        while True:
+            pos = self._buf.find(b'\n')
+            if pos < 0:
+                break
+            end = pos + 1 + int(self._buf[:pos])
+            if len(self._buf) < end:
+                break
+            frames.append(self._buf[pos + 1:end])
+            self._buf = self._buf[end:]
+        return frames
+
+
+def frame(b_data):
+    return to_bytes('%d\n' % len(b_data)) + b_data
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def rpm_labels(package):
+    ''' returns the names by which `rpm -q` finds a package of the snapshot '''
+    name, epoch, version, release, arch = package
+    labels = [name, '%s.%s' % (name, arch), '%s-%s' % (name, version),
+              '%s-%s-%s' % (name, version, release), '%s-%s-%s.%s' % (name, version, release, arch)]
+    if epoch is not None:
+        labels.extend(['%s-%s:%s-%s' % (name, epoch, version, release),
+                       '%s-%s:%s-%s.%s' % (name, epoch, version, release, arch)])
+    return labels
+
+
+def build_agent_zip(sources):
+    ''' returns the zip file of library/test_bundle.py and the module_utils files the test modules import '''
+    zipoutput = BytesIO()
+    zf = zipfile.ZipFile(zipoutput, mode='w', compression=zipfile.ZIP_DEFLATED)
+    zf.writestr('ansible/__init__.py', b'')
+    zf.writestr('ansible/module_utils/__init__.py', b'')
+    py_module_names = set()
+    py_module_cache = {('__init__',): b''}
+    for name in sorted(sources):
+        recursive_finder(name, to_bytes(sources[name]), py_module_names, py_module_cache, zf)
+    zf.writestr('test_bundle.py', to_bytes(sources['test_bundle']))
+    zf.close()
+    return zipoutput.getvalue()
+
+
+def run_relay(sock_path, cmd, b_zip, idle_timeout, run_pid):
+    '''
+    Runs the check agent with cmd and relays requests from the action plugins
+    in the worker processes, which connect to the unix domain socket at
+    sock_path, to the agent. Exits when idle for idle_timeout seconds,
+    when the agent exits, or when the ansible-playbook process exits.
+    '''
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(64)
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+    agent_in = proc.stdin.fileno()
+    agent_out = proc.stdout.fileno()
+    write_all(agent_in, frame(b_zip))
+
+    agent_reader = FrameReader()
+    clients = {}   # socket -> FrameReader
+    pending = {}   # request id -> (socket, original request id)
+    loaded = {}    # module name -> SHA1 digest of the source the agent loaded
+    next_id = 0
+    last_active = time.time()
+    try:
+        while True:
+            readable = select.select([server, agent_out] + list(clients), [], [], 1.0)[0]
+            now = time.time()
+            if readable or pending:
+                last_active = now
+            elif now - last_active > idle_timeout:
+                break
+            try:
+                os.kill(run_pid, 0)
+            except OSError:
+                break
+
+            for r in readable:
+                if r is server:
+                    client = server.accept()[0]
+                    clients[client] = FrameReader()
+
+                elif r is agent_out:
+                    data = os.read(agent_out, 65536)
+                    if not data:
+                        return
+                    for b_response in agent_reader.feed(data):
+                        response = json.loads(to_text(b_response))
+                        loaded.update(response.pop('loaded', None) or {})
+                        client, client_id = pending.pop(response['id'], (None, None))
+                        if client in clients:
+                            response['id'] = client_id
+                            try:
+                                client.sendall(frame(to_bytes(json.dumps(response))))
+                            except socket.error:
+                                pass
+
+                else:
+                    try:
+                        data = r.recv(65536)
+                    except socket.error:
+                        data = b''
+                    if not data:
+                        del clients[r]
+                        r.close()
+                        continue
+                    for b_request in clients[r].feed(data):
+                        request = json.loads(to_text(b_request))
+                        next_id += 1
+                        pending[next_id] = (r, request.get('id'))
+                        request['id'] = next_id
+                        # NOTE: The agent keeps the modules it has loaded, so
+                        # leave out the sources which it reported loaded. A
+                        # source is sent again until a response reports it.
+                        sources = request.get('sources') or {}
+                        request['sources'] = dict((k, v) for k, v in sources.items()
+                                                  if loaded.get(k) != hashlib.sha1(to_bytes(v)).hexdigest())
+                        write_all(agent_in, frame(to_bytes(json.dumps(request))))
+    finally:
+        for client in clients:
+            client.close()
+        server.close()
+        try:
+            os.unlink(sock_path)
+        except OSError:
+            pass
+        proc.stdin.close()
+        proc.wait()
+
+
+class ActionModule(ActionBase):
+    ''' runs a test module, the base of the action plugins of the test modules (see README.md) '''
+
+    TRANSFERS_FILES = False
+
+    AGENT_CONNECTIONS = ('lxd', 'lxd_mux')
+
+    DEFAULT_PROFILE_TOP = 20
+
+    DEFAULT_CACHE_DIR = '~/.ansible/test_cache'
+
+    DEFAULT_SNAPSHOT_DIR = '~/.ansible/test_snapshots'
+
+    # The arguments of the test modules which are the expected values, not
+    # the inputs of the observation. The result of these modules has the
+    # observed state in state. The checks of the other modules, like the
+    # commands of test_command, are not shared.
+    WANT_ARGS = {
+        'test_pidfile': ('state',),
+        'test_ps': ('state',),
+        'test_rpm': ('state',),
+    }
+
+    def run(self, tmp=None, task_vars=None):
+        ''' handler for test operations '''
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        return self._run_test(result, task_vars)
+
+    def _run_test(self, result, task_vars):
+        ''' runs the test of the task and returns result updated with the test result (overridden by subclasses) '''
+        result.update(self._execute_probe(self._task.action, self._task.args.copy(), task_vars))
+        return result
+
+    def _get_probe_args(self, module_name, module_args):
+        ''' returns the arguments of the test module to observe what the task checks (overridden by subclasses) '''
+        return dict((k, v) for k, v in module_args.items() if k not in self.WANT_ARGS.get(module_name, ()))
+
+    def _evaluate(self, module_name, observation, module_args):
+        ''' returns the result of the task with module_args from the observation of its probe (overridden by subclasses) '''
+        result = dict(observation)
+        if 'state' in self.WANT_ARGS.get(module_name, ()):
+            result['changed'] = result.get('state') != module_args.get('state', 'present')
+        return result
+
+    def _execute_probe(self, module_name, module_args, task_vars):
+        ''' runs a test module, sharing the observation with the other tasks of the host in the play, and returns the result '''
+        if module_name not in self.WANT_ARGS:
+            return self._execute_check(module_name, module_args, task_vars)
+
+        probe_args = self._get_probe_args(module_name, module_args)
+        snapshot = self._load_snapshot(task_vars)
+        observation = snapshot and self._evaluate_snapshot(module_name, probe_args, snapshot)
+        if observation:
+            result = self._evaluate(module_name, observation, module_args)
+            result['invocation'] = dict(module_args=module_args)
+            result['snapshot_time'] = snapshot['time']
+            return result
+
+        if not boolean(self._templar.template(task_vars.get('test_dedupe', False))):
+            return self._execute_check(module_name, module_args, task_vars)
+
+        observation, reused = self._observe(module_name, probe_args, task_vars)
+        if observation.get('failed') or observation.get('unreachable'):
+            if probe_args == module_args:
+                return observation
+            return self._execute_check(module_name, module_args, task_vars)
+
+        result = self._evaluate(module_name, observation, module_args)
+        result['invocation'] = dict(module_args=module_args)
+        if reused:
+            result['reused'] = True
+            # NOTE: The time was spent by the task which ran the probe.
+            if '_timing' in result:
+                result['_timing'] = []
+        return result
+
+    def _observe(self, module_name, probe_args, task_vars):
+        ''' returns the observation of a probe, running it if no other task of the host in the play has, and whether it is reused '''
+        target = self._task.delegate_to or task_vars.get('inventory_hostname', '')
+        play = getattr(self._task._parent, '_play', None)
+        # NOTE: The values are compared as text, so that name=foo state=True
+        # and {name: foo, state: true} are the same probe.
+        key = json.dumps([target, module_name, dict((k, to_text(v)) for k, v in probe_args.items())], sort_keys=True)
+        memo_dir = os.path.join(C.DEFAULT_LOCAL_TMP, 'test_probes')
+        memo_path = os.path.join(memo_dir, '%s-%s.json' % (play and play._uuid or 'noplay', hashlib.sha1(to_bytes(key)).hexdigest()))
+        b_memo_path = to_bytes(memo_path, errors='surrogate_or_strict')
+        try:
+            if not os.path.isdir(memo_dir):
+                os.makedirs(memo_dir)
+        except OSError:
+            pass # another worker created it
+
+        with open(to_bytes(memo_path + '.lock', errors='surrogate_or_strict'), 'w') as lock:
+            # NOTE: Wait for the worker running the same probe, if any.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(b_memo_path, 'r') as f:
+                    observation = json.load(f)
+                self._display.vvvv("test_check.ActionModule reusing the observation of %s %s" % (module_name, key), host=target)
+                return observation, True
+            except (IOError, OSError, ValueError):
+                pass
+
+            observation = self._execute_check(module_name, probe_args, task_vars)
+            if not observation.get('failed') and not observation.get('unreachable'):
+                b_tmp_path = to_bytes('%s.%d' % (memo_path, os.getpid()), errors='surrogate_or_strict')
+                try:
+                    with open(b_tmp_path, 'w') as f:
+                        json.dump(observation, f)
+                    os.rename(b_tmp_path, b_memo_path)
+                except (IOError, OSError, TypeError) as e:
+                    self._display.debug("could not save the observation of %s: %s" % (key, e))
+            return observation, False
+
+    def _evaluate_snapshot(self, module_name, probe_args, snapshot):
+        ''' returns the observation of a probe from the snapshot of the host, or None if the snapshot does not cover it (overridden by subclasses) '''
+        if module_name == 'test_rpm':
+            if snapshot.get('packages') is None:
+                return None
+            name = probe_args.get('name')
+            found = ['%s-%s-%s.%s' % (p[0], p[2], p[3], p[4]) for p in snapshot['packages'] if name in rpm_labels(p)]
+            return dict(name=name, state=found and 'present' or 'absent',
+                        stdout=found and '\n'.join(found) or 'package %s is not installed' % name,
+                        _ansible_verbose_always=True)
+
+        if module_name == 'test_ps':
+            name = probe_args.get('name')
+            if name == '*':
+                return None
+            match_full = boolean(probe_args.get('match_full', False))
+            try:
+                pattern = re.compile(name)
+            except re.error:
+                return None
+            # NOTE: pgrep -f matches the command line with the arguments
+            # separated by spaces, and pgrep the name of the process.
+            found = [(pid, cmdline) for pid, comm, cmdline in snapshot['processes']
+                     if pattern.search(match_full and (cmdline.replace('\0', ' ').rstrip() or comm) or comm)]
+            return dict(name=name, state=found and 'present' or 'absent', pids=[pid for pid, cmdline in found],
+                        stdout=''.join('%d %s\n' % (pid, cmdline.replace('\0', ' ').rstrip()) for pid, cmdline in found),
+                        _ansible_verbose_always=True)
+
+        if module_name == 'test_pidfile':
+            name = probe_args.get('name', '')
+            dirs = [os.path.normpath(d) for d in snapshot['pidfile_dirs']]
+            parent = os.path.dirname(os.path.normpath(name))
+            if parent not in dirs and os.path.dirname(parent) not in dirs:
+                return None
+            try:
+                pattern = re.compile(probe_args.get('pattern', ''))
+            except re.error:
+                return None
+            result = dict(name=name, state='absent', _ansible_verbose_always=True)
+            content = snapshot['pidfiles'].get(name)
+            if content is None:
+                return result
+            result['pid'] = pid = content.strip()
+            # NOTE: These follow main() of library/test_pidfile.py, which
+            # matches the pattern to the raw command line with match_full.
+            match_full = boolean(probe_args.get('match_full', False))
+            for process in snapshot['processes']:
+                if pid and str(process[0]) == pid:
+                    target = match_full and process[2] or process[1]
+                    if pattern.search(target):
+                        result['state'] = 'present'
+                    break
+            return result
+
+        return None
+
+    def _load_snapshot(self, task_vars):
+        ''' returns the snapshot of the host if the test_snapshot variable is true, or None '''
+        if not boolean(self._templar.template(task_vars.get('test_snapshot', False))):
+            return None
+        try:
+            return self._get_snapshot(task_vars)[0]
+        except AnsibleError as e:
+            self._display.vvv("test_check.ActionModule not using the snapshot: %s" % e)
+            return None
+
+    def _get_snapshot(self, task_vars, refresh=False, module_args=None):
+        '''
+        returns the snapshot of the host, collecting it with the test_snapshot
+        module unless a fresh one is kept, and whether it was collected
+        '''
+        target = self._task.delegate_to or task_vars.get('inventory_hostname', '')
+        name = hashlib.sha1(to_bytes(target)).hexdigest()[:16]
+        snapshot_dir = os.path.expanduser(self._templar.template(task_vars.get('test_snapshot_dir', self.DEFAULT_SNAPSHOT_DIR)))
+        max_age = int(self._templar.template(task_vars.get('test_snapshot_max_age', 0)))
+        path = os.path.join(snapshot_dir, '%s.json.z' % name)
+        b_path = to_bytes(path, errors='surrogate_or_strict')
+        # NOTE: The memo in the local temporary directory of the run tells
+        # that the snapshot was collected, or failed, in this run.
+        memo_dir = os.path.join(C.DEFAULT_LOCAL_TMP, 'test_snapshots')
+        b_memo_path = to_bytes(os.path.join(memo_dir, name), errors='surrogate_or_strict')
+        for d, mode in ((snapshot_dir, 0o700), (memo_dir, 0o755)):
+            try:
+                if not os.path.isdir(d):
+                    os.makedirs(d, mode)
+            except OSError:
+                pass # another worker created it
+
+        with open(to_bytes(path + '.lock', errors='surrogate_or_strict'), 'w') as lock:
+            # NOTE: Wait for the worker collecting the snapshot of the host, if any.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(b_memo_path, 'r') as f:
+                    memo = f.read()
+            except (IOError, OSError):
+                memo = None
+            if memo and memo != 'ok' and not refresh:
+                raise AnsibleError(memo)
+
+            if not refresh and os.path.exists(b_path) and \
+                    (memo or (max_age > 0 and time.time() - os.path.getmtime(b_path) < max_age)):
+                with open(b_path, 'rb') as f:
+                    return json.loads(to_text(zlib.decompress(f.read()))), False
+
+            self._display.vvv("test_check.ActionModule collecting the snapshot", host=target)
+            result = self._execute_module(module_name='test_snapshot', module_args=module_args or dict(), task_vars=task_vars)
+            if result.get('failed') or result.get('unreachable') or 'snapshot' not in result:
+                memo = "could not collect the snapshot of %s: %s" % (target, result.get('msg', 'no snapshot'))
+                b_data = None
+            else:
+                memo = 'ok'
+                b_data = base64.b64decode(result['snapshot'])
+                b_tmp_path = to_bytes('%s.%d' % (path, os.getpid()), errors='surrogate_or_strict')
+                with open(b_tmp_path, 'wb') as f:
+                    f.write(b_data)
+                os.rename(b_tmp_path, b_path)
+            with open(b_memo_path, 'w') as f:
+                f.write(memo)
+            if b_data is None:
+                raise AnsibleError(memo)
+            return json.loads(to_text(zlib.decompress(b_data))), True
+
+    def _use_agent(self, task_vars):
+        if self._play_context.connection not in self.AGENT_CONNECTIONS:
+            return False
+        return boolean(self._templar.template(task_vars.get('test_agent', False)))
+
+    def _get_profile(self, task_vars):
+        ''' returns the number of the top functions in the profiles of the checks (0 for no profiling) and whether to return the stats '''
+        value = self._templar.template(task_vars.get('test_profile', 0))
+        if isinstance(value, bool):
+            top = value and self.DEFAULT_PROFILE_TOP or 0
+        else:
+            try:
+                top = int(value)
+            except (TypeError, ValueError):
+                top = boolean(value) and self.DEFAULT_PROFILE_TOP or 0
+        return max(top, 0), boolean(self._templar.template(task_vars.get('test_profile_stats', False)))
+
+    def _get_cache(self, task_vars):
+        ''' returns the directory of the cache of the last results on the host (None if not incremental) and its max age '''
+        if not boolean(self._templar.template(task_vars.get('test_incremental', False))):
+            return None, 0
+        cache = self._templar.template(task_vars.get('test_incremental_dir', self.DEFAULT_CACHE_DIR))
+        return cache, int(self._templar.template(task_vars.get('test_incremental_max_age', 0)))
+
+    def _is_load_test(self, module_name, module_args):
+        ''' returns whether a check is a load test of test_http, which runs for duration seconds in forked processes '''
+        if module_name != 'test_http':
+            return False
+        try:
+            return float(module_args.get('duration') or 0) > 0
+        except (TypeError, ValueError):
+            # NOTE: Let the module report the invalid duration.
+            return True
+
+    def _execute_check(self, module_name, module_args, task_vars):
+        ''' runs a test module and returns the result '''
+        use_bundle = self._use_agent(task_vars) or self._get_profile(task_vars)[0] or \
+            boolean(self._templar.template(task_vars.get('test_timing', False))) or \
+            (module_name in INCREMENTAL_MODULES and self._get_cache(task_vars)[0] is not None)
+        if not use_bundle or self._is_load_test(module_name, module_args):
+            return self._execute_module(module_name=module_name, module_args=module_args, task_vars=task_vars)
+
+        bundle = self._execute_bundle([dict(name=module_name, module=module_name, args=module_args)], 1, task_vars)
+        if not bundle.get('checks'):
+            return bundle
+        return bundle['checks'][0]['result']
+
+    def _execute_bundle(self, checks, workers, task_vars, fail_fast=False):
+        ''' runs checks with the test_bundle module, or the check agent, and returns the result '''
+        sources = self._get_sources(set(check['module'] for check in checks))
+        profile, profile_stats = self._get_profile(task_vars)
+        cache, cache_max_age = self._get_cache(task_vars)
+        if not self._use_agent(task_vars):
+            return self._execute_module(module_name='test_bundle', module_args=dict(checks=checks, sources=sources, workers=workers,
+                                        profile=profile, profile_stats=profile_stats, cache=cache,
+                                        cache_max_age=cache_max_age, fail_fast=fail_fast), task_vars=task_vars)
+
+        extra_params = dict(
+            _ansible_check_mode=self._play_context.check_mode,
+            _ansible_no_log=self._play_context.no_log or C.DEFAULT_NO_TARGET_SYSLOG,
+            _ansible_debug=C.DEFAULT_DEBUG,
+            _ansible_diff=self._play_context.diff,
+            _ansible_verbosity=self._display.verbosity,
+        )
+        request = dict(id=0, checks=checks, sources=sources, workers=workers, extra_params=extra_params,
+                       profile=profile, profile_stats=profile_stats, cache=cache, cache_max_age=cache_max_age,
+                       fail_fast=fail_fast)
+
+        host = self._play_context.remote_addr
+        self._display.vvv("test_check.ActionModule sending %d checks to the check agent" % len(checks), host=host)
+        sock = self._connect_agent(host, task_vars)
+        try:
+            sock.sendall(frame(to_bytes(json.dumps(request))))
+            reader = FrameReader()
+            frames = []
+            while not frames:
+                data = sock.recv(65536)
+                if not data:
+                    return dict(failed=True, msg="the check agent for %s exited" % host)
+                frames = reader.feed(data)
+        finally:
+            sock.close()
+
+        result = json.loads(to_text(frames[0]))['result']
+        result['_ansible_parsed'] = True
+        return result
+
+    def _get_sources(self, module_names):
+        ''' returns the dictionary of the module names to their sources '''
+        sources = dict()
+        for name in module_names:
+            module_path = self._shared_loader_obj.module_loader.find_plugin(name)
+            if module_path is None:
+                raise AnsibleError("module %s is not found" % name)
+            with open(to_bytes(module_path, errors='surrogate_or_strict'), 'rb') as f:
+                sources[name] = to_text(f.read())
+        return sources
+
+    def _connect_agent(self, host, task_vars):
+        ''' connects to the relay process of the check agent, starting it if it is not running '''
+        name = hashlib.sha1(to_bytes(host)).hexdigest()[:16]
+        sock_path = os.path.join(C.DEFAULT_LOCAL_TMP, 'test_agent-%s.sock' % name)
+
+        sock = self._try_connect(sock_path)
+        if sock is not None:
+            return sock
+
+        with open(sock_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # NOTE: Another worker may have started it while we were waiting for the lock.
+            sock = self._try_connect(sock_path)
+            if sock is not None:
+                return sock
+
+            self._start_relay(host, sock_path, task_vars)
+            for _ in range(300):
+                sock = self._try_connect(sock_path)
+                if sock is not None:
+                    return sock
+                time.sleep(0.01)
+
+        raise AnsibleError("could not connect to the check agent for %s at %s" % (host, sock_path))
+
+    def _try_connect(self, sock_path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sock_path)
+            return sock
+        except socket.error as e:
+            sock.close()
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            return None
+
+    def _start_relay(self, host, sock_path, task_vars):
+        lxc = self._templar.template(task_vars.get('test_agent_lxc', 'lxc'))
+        python = self._templar.template(task_vars.get('ansible_python_interpreter', '/usr/bin/python'))
+        idle_timeout = int(self._templar.template(task_vars.get('test_agent_idle_timeout', 60)))
+        # NOTE: The relay closes the stdin of the agent when it is idle. The agent
+        # has a longer timeout of its own in case the relay was killed.
+        cmd = [lxc, 'exec', host, '--', python, '-c', AGENT_BOOTSTRAP % dict(idle_timeout=idle_timeout * 2)]
+        b_zip = build_agent_zip(self._get_sources(('test_bundle',) + AGENT_MODULES))
+        # NOTE: The worker processes are forked from the ansible-playbook process.
+        run_pid = os.getppid()
+
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+
+        self._display.vvv("test_check.ActionModule starting the check agent: %s" % ' '.join(cmd[:-1]), host=host)
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+
+        # double fork so that the relay is not a child of the worker process
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.closerange(3, 1024)
+            run_relay(sock_path, cmd, b_zip, idle_timeout, run_pid)
+        finally:
+            os._exit(0)
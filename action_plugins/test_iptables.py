@@ -26,10 +26,14 @@ import time
 from ansible import constants as C
 from ansible.errors import AnsibleError
 from ansible.module_utils._text import to_bytes, to_native, to_text
-from ansible.plugins.action import ActionBase
+from ansible.plugins import action_loader
 from ansible.utils.boolean import boolean
 from ansible.module_utils.six import b
 
+# NOTE: Inherit the test_check action plugin so that the ruleset can be
+# taken from the snapshot of the host. See action_plugins/test_check.py
+TestCheckAction = action_loader.get('test_check', class_only=True)
+
 
 def cook_iptables_save_for_comparision(stdout):
     counter = re.compile(r'\[\d+:\d+\]$')
@@ -45,17 +49,12 @@ def cook_iptables_save_for_comparision(stdout):
         lines.append(line)
     return '\n'.join(lines)
 
-class ActionModule(ActionBase):
+class ActionModule(TestCheckAction):
 
     TRANSFERS_FILES = False
 
-    def run(self, tmp=None, task_vars=None):
+    def _run_test(self, result, task_vars):
         ''' handler for template operations '''
-        if task_vars is None:
-            task_vars = dict()
-
-        result = super(ActionModule, self).run(tmp, task_vars)
-
         source = self._task.args.get('src', None)
         executable = self._task.args.get('executable', 'iptables-save')
 
@@ -130,14 +129,22 @@ class ActionModule(ActionBase):
             result['msg'] = type(e).__name__ + ": " + str(e)
             return result
 
-        cmd_result = self._low_level_execute_command(cmd=executable, sudoable=True)
-        if cmd_result['rc'] != 0:
-            result['failed'] = True
-            result['msg'] = '%s failed with rc=%d, stderr=%s' % (executable, cmd_result['rc'], cmd_result['stderr'])
-            return result
+        stdout = None
+        if executable == 'iptables-save':
+            snapshot = self._load_snapshot(task_vars)
+            if snapshot and snapshot.get('iptables') is not None:
+                stdout = snapshot['iptables']
+                result['snapshot_time'] = snapshot['time']
+        if stdout is None:
+            cmd_result = self._low_level_execute_command(cmd=executable, sudoable=True)
+            if cmd_result['rc'] != 0:
+                result['failed'] = True
+                result['msg'] = '%s failed with rc=%d, stderr=%s' % (executable, cmd_result['rc'], cmd_result['stderr'])
+                return result
+            stdout = cmd_result['stdout']
 
         want = resultant
-        got = cook_iptables_save_for_comparision(cmd_result['stdout'])
+        got = cook_iptables_save_for_comparision(stdout)
         if got == want:
             result['changed'] = False
         else:
@@ -0,0 +1,163 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# test_sample.py is a third party action plugin for Ansible
+#
+# test_sample.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# test_sample.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import math
+import os
+import time
+
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.six import string_types
+from ansible.plugins.action import ActionBase
+
+
+class ActionModule(ActionBase):
+    '''
+    Selects the hosts of the play to verify in this run, a fraction of the
+    hosts of each stratum. Run it with run_once, and it sets the
+    test_sample_hosts fact, the list of the selected hosts, on all the
+    hosts. See testbook.yml
+
+        - test_sample: fraction=0.25 state=test-sample.json
+          run_once: yes
+
+    The hosts are stratified by the fingerprint of their configuration, the
+    values of their variables whose names start with test_, which are what
+    the test roles check, so that every distinct configuration is verified
+    in every run. Give vars, the list of the names of the variables, to
+    stratify by others, e.g. vars=group_names to stratify by the groups.
+
+    The state file, relative to the directory of the playbook unless it is
+    absolute, keeps the number of the runs and the run in which each
+    host was last selected. Of each stratum, the hosts selected least
+    recently (never first, then by name) are selected, at least one. So the
+    rotation is deterministic and every host is verified at least once
+    every ceil(1 / fraction) runs while the strata are unchanged. The state
+    is saved only in check mode, as the test play fails without -C.
+
+    The result has sample, the summary of the selection which the test
+    callback plugin shows in the recap. With fraction 1 (the default), all
+    the hosts are selected and the state file is not used.
+    '''
+
+    TRANSFERS_FILES = False
+
+    DEFAULT_STATE_FILE = 'test-sample.json'
+
+    VAR_PREFIX = 'test_'
+
+    def run(self, tmp=None, task_vars=None):
+        ''' handler for sampling the hosts '''
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        try:
+            fraction = float(self._task.args.get('fraction', 1))
+        except (TypeError, ValueError):
+            fraction = 0
+        if not 0 < fraction <= 1:
+            result['failed'] = True
+            result['msg'] = "fraction must be a number more than 0 and not more than 1: %s" % self._task.args.get('fraction')
+            return result
+
+        hosts = list(task_vars.get('ansible_play_hosts') or [])
+        if fraction == 1:
+            result['changed'] = False
+            result['ansible_facts'] = dict(test_sample_hosts=hosts)
+            result['sample'] = dict(fraction=fraction, hosts=len(hosts), sampled=len(hosts), strata=None,
+                                    period=1, never_sampled=0, max_age=0)
+            return result
+
+        state_path = self._loader.path_dwim(self._task.args.get('state', self.DEFAULT_STATE_FILE))
+        state = self._load_state(state_path)
+        run = state.get('run', 0) + 1
+        last_sampled = state.setdefault('sampled', {})
+
+        strata = {}
+        for host in hosts:
+            strata.setdefault(self._fingerprint(task_vars['hostvars'][host]), []).append(host)
+
+        selected = []
+        for members in strata.values():
+            # NOTE: Subtract a little so that 0.1 * 30 does not round up to 4.
+            count = max(1, int(math.ceil(fraction * len(members) - 1e-9)))
+            members.sort(key=lambda host: (last_sampled.get(host, 0), host))
+            selected.extend(members[:count])
+        selected.sort()
+
+        for host in selected:
+            last_sampled[host] = run
+        state['run'] = run
+        state['last_run'] = dict(run=run, time=time.time(), fraction=fraction, hosts=selected)
+        if self._play_context.check_mode:
+            try:
+                self._save_state(state_path, state)
+            except (IOError, OSError) as e:
+                result['failed'] = True
+                result['msg'] = "could not save the sampling state to %s: %s" % (state_path, e)
+                return result
+
+        ages = [run - last_sampled[host] for host in hosts if host in last_sampled]
+        result['changed'] = False
+        result['ansible_facts'] = dict(test_sample_hosts=selected)
+        result['sample'] = dict(
+            run=run,
+            fraction=fraction,
+            hosts=len(hosts),
+            sampled=len(selected),
+            strata=len(strata),
+            period=int(math.ceil(1 / fraction - 1e-9)),
+            never_sampled=len(hosts) - len(ages),
+            max_age=max(ages or [0]),
+        )
+        result['msg'] = "verifying %d of %d hosts in %d strata in run %d" % (len(selected), len(hosts), len(strata), run)
+        if not self._play_context.check_mode:
+            result['msg'] += " (the state is not saved without check mode)"
+        return result
+
+    def _fingerprint(self, host_vars):
+        ''' returns the fingerprint of the configuration of a host from its hostvars '''
+        names = self._task.args.get('vars')
+        if names is None:
+            names = [name for name in host_vars if name.startswith(self.VAR_PREFIX) and not name.startswith('test_sample')]
+        elif isinstance(names, string_types):
+            names = [name.strip() for name in names.split(',')]
+        values = {}
+        for name in names:
+            # NOTE: hostvars templates the values, and leaves undefined
+            # variables in them as they are.
+            values[name] = host_vars.get(name)
+        return hashlib.sha1(to_bytes(json.dumps(values, sort_keys=True, default=repr))).hexdigest()
+
+    def _load_state(self, path):
+        try:
+            with open(to_bytes(path, errors='surrogate_or_strict'), 'r') as f:
+                return json.loads(to_text(f.read()))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_state(self, path, state):
+        b_path = to_bytes(path, errors='surrogate_or_strict')
+        b_tmp_path = to_bytes('%s.%d' % (path, os.getpid()), errors='surrogate_or_strict')
+        with open(b_tmp_path, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.rename(b_tmp_path, b_path)
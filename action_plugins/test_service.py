@@ -17,49 +17,195 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import os
+import re
 
-from ansible.plugins.action import ActionBase
+from ansible import constants as C
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.plugins import action_loader
+from ansible.utils.boolean import boolean
 
+# NOTE: Inherit the test_check action plugin so that the test can be run
+# through the check agent. See action_plugins/test_check.py
+TestCheckAction = action_loader.get('test_check', class_only=True)
 
-class ActionModule(ActionBase):
 
-    TRANSFERS_FILES = False
+class ActionModule(TestCheckAction):
 
     UNUSED_PARAMS = {
         'systemd': ['pattern', 'runlevel', 'sleep', 'arguments', 'args'],
     }
 
-    def run(self, tmp=None, task_vars=None):
-        ''' handler for package operations '''
-        if task_vars is None:
-            task_vars = dict()
+    # NOTE: The probe of a service observes all of them, so that the tasks
+    # checking different aspects of the same service share it.
+    SERVICE_WANTS = ('defined', 'state', 'enabled')
+    PROBE_WANTS = dict(defined=True, state='started', enabled=True)
+
+    WANT_ARGS = dict(TestCheckAction.WANT_ARGS,
+                     test_service=SERVICE_WANTS,
+                     test_systemd=SERVICE_WANTS)
+
+    # The suffixes of the unit names to which systemctl does not add .service
+    UNIT_SUFFIX_RE = re.compile(r'\.(service|socket|target|device|mount|automount|swap|path|timer|slice|scope)$')
 
-        result = super(ActionModule, self).run(tmp, task_vars)
+    # The LSB exit codes of the status action which mean not running
+    NOT_RUNNING_RCS = (1, 2, 3, 4, 69)
 
+    def _run_test(self, result, task_vars):
+        ''' handler for package operations '''
         module = self._task.args.get('use', 'auto').lower()
 
         if module == 'auto':
-            try:
-                if self._task.delegate_to: # if we delegate, we should use delegated host's facts
-                    module = self._templar.template("{{hostvars['%s']['ansible_service_mgr']}}" % self._task.delegate_to)
+            module, detected = self._get_service_mgr(task_vars)
+            # NOTE: Store the detected service manager as a fact so that later
+            # tasks (and the fact cache) pick it up from the template above.
+            # When delegating without delegate_facts, the fact would be stored
+            # on the wrong host, so we rely on the per-run memo file instead.
+            if detected and (not self._task.delegate_to or self._task.delegate_facts):
+                result['ansible_facts'] = dict(ansible_service_mgr=module)
+
+        test_module, new_module_args = self._get_test_module_args(module, self._task.args)
+
+        self._display.vvvv("test_service.ActionModule Running service %s" % test_module)
+        result.update(self._execute_probe(test_module, new_module_args, task_vars))
+
+        return result
+
+    def _get_probe_args(self, module_name, module_args):
+        probe_args = super(ActionModule, self)._get_probe_args(module_name, module_args)
+        if module_name in ('test_service', 'test_systemd'):
+            probe_args.update(self.PROBE_WANTS)
+        return probe_args
+
+    def _evaluate(self, module_name, observation, module_args):
+        ''' returns the result which the test module would return with module_args from the observation of all the aspects '''
+        if module_name not in ('test_service', 'test_systemd'):
+            return super(ActionModule, self)._evaluate(module_name, observation, module_args)
+
+        wants = {}
+        for aspect in self.SERVICE_WANTS:
+            want = module_args.get(aspect)
+            if want is not None and aspect != 'state':
+                want = boolean(want)
+            wants[aspect] = want
+
+        result = dict(observation)
+        for aspect in self.SERVICE_WANTS:
+            if aspect in result:
+                result[aspect] = dict((k, v) for k, v in result[aspect].items() if k not in ('want', 'changed'))
+
+        # NOTE: These follow main() of library/test_service.py and
+        # library/test_systemd.py respectively.
+        if module_name == 'test_service':
+            result['defined']['want'] = wants['defined']
+            result['defined']['changed'] = changed = result['defined']['got'] != wants['defined']
+            if result['defined']['got']:
+                if wants['state']:
+                    result['state']['want'] = wants['state']
+                    result['state']['changed'] = result['state']['got'] != wants['state']
+                    changed = changed or result['state']['changed']
                 else:
-                    module = self._templar.template('{{ansible_service_mgr}}')
-            except:
-                pass # could not get it from template!
+                    del result['state']
+                result['enabled']['want'] = wants['enabled']
+                result['enabled']['changed'] = result['enabled']['got'] != wants['enabled']
+                changed = changed or result['enabled']['changed']
+        else:
+            changed = False
+            for aspect in self.SERVICE_WANTS:
+                if wants[aspect] is None:
+                    if aspect != 'defined':
+                        result[aspect] = {}
+                    continue
+                result[aspect]['want'] = wants[aspect]
+                if 'got' in result[aspect]:
+                    result[aspect]['changed'] = result[aspect]['got'] != wants[aspect]
+                    changed = changed or result[aspect]['changed']
 
-        if module == 'auto':
-            facts = self._execute_module(module_name='setup', module_args=dict(gather_subset='!all', filter='ansible_service_mgr'), task_vars=task_vars)
-            self._display.debug("Facts %s" % facts)
-            if 'ansible_facts' in facts and  'ansible_service_mgr' in facts['ansible_facts']:
-                module = facts['ansible_facts']['ansible_service_mgr']
+        result['changed'] = changed
+        return result
 
+    def _evaluate_snapshot(self, module_name, probe_args, snapshot):
+        ''' returns the observation of all the aspects of a service from the snapshot, or None if the snapshot does not cover it '''
+        name = probe_args.get('name', '')
+        if module_name == 'test_systemd':
+            units = snapshot.get('units')
+            if units is None or boolean(probe_args.get('user', False)):
+                return None
+            unit = self.UNIT_SUFFIX_RE.search(name) and name or '%s.service' % name
+            # NOTE: A unit without a unit file, like the one generated for a
+            # SysV init script, is examined by test_systemd.
+            if unit not in units or units[unit][2] is None:
+                return None
+            load_state, active_state, file_state = units[unit]
+            return dict(name=name, module='test_systemd', _ansible_verbose_always=True,
+                        defined=dict(got=True),
+                        state=dict(got=active_state == 'active' and 'started' or 'stopped'),
+                        enabled=dict(got=file_state == 'enabled'))
+
+        if module_name != 'test_service':
+            return super(ActionModule, self)._evaluate_snapshot(module_name, probe_args, snapshot)
+
+        sysv = snapshot.get('sysv')
+        if sysv is None or name in sysv['upstart']:
+            return None
+        initscript = '/etc/init.d/%s' % name
+        got_defined = name in sysv['initscripts']
+        result = dict(name=name, _ansible_verbose_always=True, tools=dict(succeeded=True),
+                      defined=dict(got=got_defined, method="SysV's chkconfig",
+                                   condition='initscript %s %s' % (initscript, got_defined and 'exists' or 'not exist')))
+        if not got_defined:
+            return result
+
+        # NOTE: test_service fails when chkconfig does not list the service.
+        if name not in sysv['status'] or name not in sysv['levels']:
+            return None
+        cmd, rc, stdout, stderr = sysv['status'][name]
+        running = self._sysv_running(name, rc, stdout)
+        result['state'] = dict(cmd=cmd, rc=rc, stdout=stdout, stderr=stderr, running=running,
+                               got=running and 'started' or 'stopped')
+        levels = sysv['levels'][name]
+        result['enabled'] = dict(got='3' in levels and '5' in levels, method="SysV's chkconfig")
+        return result
+
+    def _sysv_running(self, name, rc, stdout):
+        ''' returns whether a service is running from the result of its status command '''
+        # NOTE: This follows get_service_status() of library/test_service.py
+        # for the init scripts which are not upstart jobs.
+        if rc in self.NOT_RUNNING_RCS:
+            return False
+
+        if stdout.count('\n') <= 1:
+            cleanout = stdout.lower().replace(name.lower(), '')
+            if "stop" in cleanout:
+                return False
+            elif "run" in cleanout:
+                return not ("not " in cleanout)
+            elif "start" in cleanout and "not " not in cleanout:
+                return True
+            elif 'could not access pid file' in cleanout:
+                return False
+            elif 'is dead and pid file exists' in cleanout:
+                return False
+            elif 'dead but subsys locked' in cleanout:
+                return False
+            elif 'dead but pid file exists' in cleanout:
+                return False
+
+        if rc == 0:
+            return True
+
+        if name == 'iptables' and "ACCEPT" in stdout:
+            return True
+        return None
+
+    def _get_test_module_args(self, module, args):
+        ''' returns (test module name, module args) to examine a service with the service manager '''
         if module and module != 'auto' and ('test_%s' % module) in self._shared_loader_obj.module_loader:
             test_module = 'test_%s' % module
         else:
             test_module = 'test_service'
 
-        # run the 'service' module
-        new_module_args = self._task.args.copy()
+        new_module_args = args.copy()
         if 'use' in new_module_args:
             del new_module_args['use']
 
@@ -73,7 +219,54 @@ class ActionModule(ActionBase):
                     del new_module_args[unused]
                     self._display.warning('Ignoring "%s" as it is not used in "%s"' % (unused, module))
 
-        self._display.vvvv("test_service.ActionModule Running service %s" % test_module)
-        result.update(self._execute_module(module_name=test_module, module_args=new_module_args, task_vars=task_vars))
+        return test_module, new_module_args
 
-        return result
+    def _get_service_mgr(self, task_vars):
+        ''' returns (service manager, whether it was detected by this call) for the target host '''
+        try:
+            if self._task.delegate_to: # if we delegate, we should use delegated host's facts
+                module = self._templar.template("{{hostvars['%s']['ansible_service_mgr']}}" % self._task.delegate_to)
+            else:
+                module = self._templar.template('{{ansible_service_mgr}}')
+        except:
+            module = 'auto' # could not get it from template!
+        if module != 'auto':
+            return module, False
+
+        # The action plugin runs in a forked worker per task, so the memo has to
+        # live on disk. DEFAULT_LOCAL_TMP is created once per ansible-playbook run.
+        target = self._task.delegate_to or task_vars.get('inventory_hostname', '')
+        play = getattr(self._task._parent, '_play', None)
+        memo_dir = os.path.join(C.DEFAULT_LOCAL_TMP, 'test_service_mgr')
+        memo_path = os.path.join(memo_dir, '%s-%s' % (play and play._uuid or 'noplay', target))
+        b_memo_path = to_bytes(memo_path, errors='surrogate_or_strict')
+        try:
+            with open(b_memo_path, 'r') as f:
+                module = to_text(f.read()).strip()
+            if module:
+                self._display.vvvv("test_service.ActionModule using memoized service manager %s for %s" % (module, target))
+                return module, False
+        except (IOError, OSError):
+            pass
+
+        facts = self._execute_module(module_name='setup', module_args=dict(gather_subset='!all', filter='ansible_service_mgr'), task_vars=task_vars)
+        self._display.debug("Facts %s" % facts)
+        if 'ansible_facts' in facts and  'ansible_service_mgr' in facts['ansible_facts']:
+            module = facts['ansible_facts']['ansible_service_mgr']
+        if module == 'auto':
+            return module, False
+
+        try:
+            if not os.path.isdir(memo_dir):
+                os.makedirs(memo_dir)
+        except OSError:
+            pass # another worker created it
+        b_tmp_path = to_bytes('%s.%d' % (memo_path, os.getpid()), errors='surrogate_or_strict')
+        try:
+            with open(b_tmp_path, 'w') as f:
+                f.write(module)
+            os.rename(b_tmp_path, b_memo_path)
+        except (IOError, OSError) as e:
+            self._display.debug("could not memoize service manager for %s: %s" % (target, e))
+
+        return module, True
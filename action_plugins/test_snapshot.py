@@ -0,0 +1,64 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# test_snapshot.py is a third party action plugin for Ansible
+#
+# test_snapshot.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# test_snapshot.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import time
+
+from ansible.errors import AnsibleError
+from ansible.module_utils._text import to_native
+from ansible.plugins import action_loader
+from ansible.utils.boolean import boolean
+
+# NOTE: The snapshots are kept by the test_check action plugin.
+# See action_plugins/test_check.py
+TestCheckAction = action_loader.get('test_check', class_only=True)
+
+
+class ActionModule(TestCheckAction):
+    '''
+    Collects the snapshot of the host with the test_snapshot module and
+    keeps it on the controller, so that the checks of the run with the
+    test_snapshot variable are evaluated against it. A fresh snapshot kept
+    already (see test_snapshot_max_age) is used unless refresh is true.
+    The other arguments are passed to the module.
+
+        - test_snapshot: refresh=yes
+
+    The result has snapshot, the summary of the snapshot, and collected,
+    whether the host was accessed.
+    '''
+
+    def _run_test(self, result, task_vars):
+        module_args = self._task.args.copy()
+        refresh = boolean(module_args.pop('refresh', False))
+        try:
+            snapshot, collected = self._get_snapshot(task_vars, refresh=refresh, module_args=module_args)
+        except AnsibleError as e:
+            result['failed'] = True
+            result['msg'] = to_native(e)
+            return result
+
+        summary = dict(time=snapshot['time'], age=max(time.time() - snapshot['time'], 0))
+        for part in ('packages', 'units', 'processes', 'pidfiles', 'sockets'):
+            summary[part] = len(snapshot[part]) if snapshot.get(part) is not None else None
+        summary['initscripts'] = len(snapshot['sysv']['initscripts']) if snapshot.get('sysv') else None
+        summary['iptables'] = snapshot.get('iptables') is not None
+        result['changed'] = False
+        result['collected'] = collected
+        result['snapshot'] = summary
+        return result
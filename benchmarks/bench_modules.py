@@ -0,0 +1,148 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# bench_modules.py is a part of the benchmarks of the third party test modules for Ansible
+#
+# bench_modules.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bench_modules.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Benchmarks of the test modules on the simulated host. See conftest.py
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import sys
+
+import pytest
+
+from conftest import LIBRARY_DIR
+
+
+# NOTE: The arguments match the state of the simulated host, so each check
+# passes and a changed or failed result means the benchmark is broken.
+
+# the checks whose work grows with the processes on the host
+PROCESS_CHECKS = [
+    ('test_ps', dict(name='nginx', state='present')),
+    ('test_ps', dict(name='worker', state='present', match_full=True)),
+    ('test_ps', dict(name='*', state='present')),
+    ('test_pidfile', dict(name='/run/nginx.pid', pattern='nginx', state='present')),
+    ('test_pidfile', dict(name='/run/nginx.pid', pattern='/usr/sbin/nginx', state='present', match_full=True)),
+]
+
+CHECKS = [
+    ('test_rpm', dict(name='bash', state='present')),
+    ('test_rpm', dict(name='telnet-server', state='absent')),
+    ('test_service', dict(name='crond', defined=True, state='started', enabled=True)),
+    ('test_service', dict(name='iptables', defined=True, state='stopped', enabled=False)),
+    ('test_systemd', dict(name='nginx.service', state='started', enabled=True)),
+    ('test_systemd', dict(name='postfix.service', state='stopped', enabled=False)),
+    ('test_command', dict(cmd='true', want_rc=0)),
+]
+
+# the checks of the listening sockets, run among the established connections
+PORT_CHECKS = [
+    ('listeners', dict(listeners=[22, dict(port=80, process='nginx')])),
+    ('exclusive', dict(allowed=[22, 80], exclusive=True)),
+    ('owners', dict(listeners=[22, 80], owners=True)),
+]
+
+
+def first_checks(checks):
+    ''' returns the first check of each module '''
+    firsts = []
+    for check in checks:
+        if check[0] not in [module for module, args in firsts]:
+            firsts.append(check)
+    return firsts
+
+# the checks run as processes by test_payloads
+PAYLOAD_CHECKS = first_checks(PROCESS_CHECKS + CHECKS)
+
+# imports a test module without running main() and prints the seconds taken
+STARTUP_SOURCE = '''
+import sys
+import time
+start = time.time()
+path = sys.argv[1]
+source = open(path).read()
+exec(compile(source, path, 'exec'), {'__name__': '__startup__'})
+sys.stdout.write('%.6f' % (time.time() - start))
+'''
+
+
+# the rounds of the benchmarks which start a process, after 2 warmup rounds
+PROCESS_ROUNDS = 20
+
+
+def check_id(check):
+    module, args = check
+    return '%s:%s' % (module, ','.join('%s=%s' % (k, args[k]) for k in sorted(args)))
+
+
+def run_benchmark(benchmark, run_check, check_allocations, module, args):
+    result = benchmark(run_check, module, args)
+    assert not result.get('failed'), result.get('msg')
+    assert not result['changed'], result
+    check_allocations(run_check, module, args)
+
+
+@pytest.mark.parametrize('module,args', PROCESS_CHECKS, ids=[check_id(c) for c in PROCESS_CHECKS])
+def test_process_checks(benchmark, run_check, check_allocations, process_count, module, args):
+    run_benchmark(benchmark, run_check, check_allocations, module, args)
+
+
+@pytest.mark.parametrize('module,args', CHECKS, ids=[check_id(c) for c in CHECKS])
+def test_checks(benchmark, run_check, check_allocations, process_count, module, args):
+    run_benchmark(benchmark, run_check, check_allocations, module, args)
+
+
+@pytest.mark.parametrize('args', [a for i, a in PORT_CHECKS], ids=[i for i, a in PORT_CHECKS])
+def test_port_checks(benchmark, run_check, check_allocations, process_count, connection_count, args):
+    run_benchmark(benchmark, run_check, check_allocations, 'test_port', args)
+
+
+def test_process_snapshot(benchmark, run_check, check_allocations, process_count):
+    ''' the snapshot of the host which the checks of test_snapshot are evaluated against '''
+    result = benchmark(run_check, 'test_snapshot', {})
+    assert not result.get('failed'), result.get('msg')
+    check_allocations(run_check, 'test_snapshot', {})
+    benchmark.extra_info['snapshot_bytes'] = result['size']
+
+
+def test_http_probes(benchmark, run_check, check_allocations, http_server, process_count):
+    ''' the probes of all the vhosts of the stand-in HTTP server '''
+    args = dict(url='http://127.0.0.1:%d/' % http_server.port, vhosts=sorted(http_server.vhosts))
+    run_benchmark(benchmark, run_check, check_allocations, 'test_http', args)
+    benchmark.extra_info['vhosts'] = len(http_server.vhosts)
+
+
+@pytest.mark.parametrize('module', [m for m, a in PAYLOAD_CHECKS])
+def test_startup(benchmark, run_process, process_count, module):
+    ''' the interpreter start and the imports of a test module '''
+    path = os.path.join(LIBRARY_DIR, '%s.py' % module)
+    seconds = benchmark.pedantic(run_process, args=([sys.executable, '-c', STARTUP_SOURCE, path],),
+                                 rounds=PROCESS_ROUNDS, warmup_rounds=2)
+    benchmark.extra_info['import_seconds'] = float(seconds)
+
+
+@pytest.mark.parametrize('module,args', PAYLOAD_CHECKS, ids=[check_id(c) for c in PAYLOAD_CHECKS])
+def test_payloads(benchmark, module_payload, run_process, process_count, module, args):
+    ''' the AnsiballZ payload of a test module from the interpreter start to the result '''
+    path, size = module_payload(module, args)
+    benchmark.extra_info['payload_bytes'] = size
+    result = json.loads(benchmark.pedantic(run_process, args=([sys.executable, path],),
+                                           rounds=PROCESS_ROUNDS, warmup_rounds=2))
+    assert not result.get('failed'), result.get('msg')
+    assert not result['changed'], result
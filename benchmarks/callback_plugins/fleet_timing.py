@@ -0,0 +1,74 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# fleet_timing.py is a third party callback plugin for Ansible
+#
+# fleet_timing.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fleet_timing.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    '''
+    Records when each task started and when its results arrived, and writes
+    them to the JSON file FLEET_TIMING_FILE at the end of the playbook.
+    The load harness (benchmarks/fleet.py) whitelists this callback and
+    computes the throughput of each task from them.
+    '''
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'fleet_timing'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self._path = os.environ.get('FLEET_TIMING_FILE')
+        self._tasks = []
+        self._by_uuid = {}
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        # NOTE: The test_fast strategy starts a task once for each host.
+        if task._uuid not in self._by_uuid:
+            record = {'name': task.get_name(), 'action': task.action, 'start': time.time(), 'end': None, 'results': 0}
+            self._by_uuid[task._uuid] = record
+            self._tasks.append(record)
+
+    def _record_result(self, result):
+        record = self._by_uuid.get(result._task._uuid)
+        if record is not None:
+            record['results'] += 1
+            record['end'] = time.time()
+
+    def v2_runner_on_ok(self, result):
+        self._record_result(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record_result(result)
+
+    def v2_runner_on_skipped(self, result):
+        self._record_result(result)
+
+    def v2_runner_on_unreachable(self, result):
+        self._record_result(result)
+
+    def v2_playbook_on_stats(self, stats):
+        if self._path:
+            with open(self._path, 'w') as f:
+                json.dump(self._tasks, f)
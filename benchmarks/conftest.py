@@ -0,0 +1,346 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# conftest.py is a part of the benchmarks of the third party test modules for Ansible
+#
+# conftest.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# conftest.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Fixtures of the microbenchmarks of the test modules.
+
+The benchmarks run the main() of library/test_*.py in this process with the
+CheckLoader of library/test_bundle.py, as the test_bundle module and the
+check agent do, against a simulated host (see fakehost.py) in a temporary
+directory, of --bench-procs processes and whose stub executables sleep
+--bench-latency seconds and print --bench-output-size more bytes. The checks
+of test_port run on the hosts of --bench-connections established
+connections, too.
+
+The paths under /proc, /etc and /run which the modules read are mapped to
+the simulated host, and get_bin_path finds only the stub executables.
+
+The checks of test_http probe the --bench-vhosts vhosts of a stand-in HTTP
+server on 127.0.0.1 (see httpserver.py).
+
+The startup and payload benchmarks run the modules as processes on the
+simulated host instead: the AnsiballZ payload which Ansible builds for them
+is run with this python, as Ansible runs it on a remote node.
+
+Run in this directory with pytest-benchmark and Ansible installed:
+
+    pytest --bench-procs=100,5000,50000
+
+The results are saved in .benchmarks. If a run of this machine is saved
+there, the results are compared with the last one, and a benchmark whose
+median is slower by more than 50% than the median change of the run fails
+(see RunRegressionCheck). The first run only saves the baseline. The peak
+memory allocated by each check (python 3) is compared with the baseline given
+with --bench-alloc-baseline, which --bench-alloc-save writes.
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import glob
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LIBRARY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'library')
+sys.path.insert(0, LIBRARY_DIR)
+
+import test_bundle
+
+from ansible.executor.module_common import modify_module
+from ansible.module_utils._text import to_native
+
+from pytest_benchmark.utils import PercentageRegressionCheck, get_machine_id
+
+from fakehost import CONNECTIONS, FakeHost, FakeOs
+from httpserver import StubServer, vhost_names
+
+
+class RunRegressionCheck(PercentageRegressionCheck):
+    '''
+    A check of --benchmark-compare-fail which fails a benchmark whose field
+    changed by more than threshold percent than the median change of the
+    field over the benchmarks of the run.
+
+    The speed of a shared machine drifts between runs, so all the benchmarks
+    of a run are often 20% slower or faster than in the last one. A slowdown
+    of every benchmark can not be told from a slower machine, and is not
+    detected.
+    '''
+
+    # the fewest benchmarks compared whose median change is taken as the drift
+    MIN_BENCHMARKS = 5
+
+    def __init__(self, field, threshold, config):
+        super(RunRegressionCheck, self).__init__(field, threshold)
+        self._config = config
+        self._drift = None
+
+    def drift(self):
+        ''' returns the median ratio of the field to the compared run over the benchmarks of the run '''
+        if self._drift is None:
+            session = self._config._benchmarksession
+            ratios = []
+            for bench in session.benchmarks:
+                for compared_mapping in session.compared_mapping.values():
+                    compared = compared_mapping.get(bench.fullname)
+                    if bench and compared and compared['stats'][self.field]:
+                        ratios.append(bench[self.field] / compared['stats'][self.field])
+            ratios.sort()
+            self._drift = len(ratios) >= self.MIN_BENCHMARKS and ratios[len(ratios) // 2] or 1.0
+        return self._drift
+
+    def compute(self, current, compared):
+        val = compared[self.field]
+        if not val:
+            return float('inf')
+        return current[self.field] / (val * self.drift()) * 100 - 100
+
+
+class AllocationBaseline(object):
+    '''
+    The peak memory allocated by each benchmark, compared with a saved
+    baseline with a relative threshold.
+    '''
+
+    def __init__(self, path, threshold):
+        self.path = path
+        self.threshold = threshold
+        self.baseline = {}
+        self.peaks = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.baseline = json.load(f)
+
+    def record(self, name, peak):
+        ''' records the peak of a benchmark and returns the error message if it regressed '''
+        self.peaks[name] = peak
+        base = self.baseline.get(name)
+        if base and peak > base * (1 + self.threshold):
+            return 'peak allocation %d bytes exceeds the baseline %d bytes by more than %d%%' % (
+                peak, base, self.threshold * 100)
+        return None
+
+    def save(self):
+        baseline = dict(self.baseline)
+        baseline.update(self.peaks)
+        with open(self.path, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('test modules benchmarks')
+    group.addoption('--bench-procs', default='100,5000',
+                    help='comma separated process counts of the simulated hosts (default: 100,5000)')
+    group.addoption('--bench-connections', default='%d,10000' % CONNECTIONS,
+                    help='comma separated established connection counts of the simulated hosts for test_port (default: %d,10000)' % CONNECTIONS)
+    group.addoption('--bench-latency', type=float, default=0.0,
+                    help='seconds the stub executables sleep before answering (default: 0)')
+    group.addoption('--bench-output-size', type=int, default=0,
+                    help='bytes added to the output of the listing stub executables (default: 0)')
+    group.addoption('--bench-vhosts', type=int, default=200,
+                    help='vhosts of the stand-in HTTP server which test_http probes (default: 200)')
+    group.addoption('--bench-alloc-baseline', default=None,
+                    help='JSON file of the baseline peak allocations of the benchmarks')
+    group.addoption('--bench-alloc-threshold', type=float, default=0.2,
+                    help='allowed relative increase of the peak allocations (default: 0.2)')
+    group.addoption('--bench-alloc-save', action='store_true', default=False,
+                    help='save the peak allocations to --bench-alloc-baseline')
+
+
+def saved_runs(config):
+    ''' returns the paths of the runs of this machine saved in the file storage of pytest-benchmark '''
+    storage = config.getoption('benchmark_storage')
+    if storage.startswith('file://'):
+        storage = storage[len('file://'):]
+    elif '://' in storage:
+        return []
+    return glob.glob(os.path.join(storage, get_machine_id(), '[0-9][0-9][0-9][0-9]_*.json'))
+
+
+def pytest_configure(config):
+    # NOTE: This runs before pytest-benchmark loads the run to compare with,
+    # and --benchmark-compare-fail fails the session without one.
+    if not config.getoption('benchmark_compare') and saved_runs(config):
+        config.option.benchmark_compare = True
+        if not config.getoption('benchmark_compare_fail'):
+            config.option.benchmark_compare_fail = [RunRegressionCheck('median', 50, config)]
+    config._bench_allocations = AllocationBaseline(config.getoption('--bench-alloc-baseline'),
+                                                   config.getoption('--bench-alloc-threshold'))
+
+
+def pytest_unconfigure(config):
+    allocations = getattr(config, '_bench_allocations', None)
+    if allocations and allocations.path and config.getoption('--bench-alloc-save'):
+        allocations.save()
+
+
+def process_counts(config):
+    return [int(n) for n in config.getoption('--bench-procs').split(',') if n.strip()]
+
+
+def connection_counts(config):
+    return [int(n) for n in config.getoption('--bench-connections').split(',') if n.strip()]
+
+
+def pytest_generate_tests(metafunc):
+    if 'process_count' in metafunc.fixturenames:
+        counts = process_counts(metafunc.config)
+        if metafunc.function.__name__.startswith('test_process'):
+            metafunc.parametrize('process_count', counts, ids=['procs=%d' % n for n in counts])
+        else:
+            # NOTE: The other checks do not depend on the processes.
+            metafunc.parametrize('process_count', counts[:1], ids=['procs=%d' % counts[0]])
+    if 'connection_count' in metafunc.fixturenames:
+        counts = connection_counts(metafunc.config)
+        metafunc.parametrize('connection_count', counts, ids=['conns=%d' % n for n in counts])
+
+
+_hosts = {}
+
+@pytest.fixture
+def fake_host(request, tmpdir_factory, process_count):
+    '''
+    the simulated host of process_count processes, and of connection_count
+    connections if the test has it, built once per session
+    '''
+    connections = CONNECTIONS
+    if 'connection_count' in request.fixturenames:
+        connections = request.getfixturevalue('connection_count')
+    key = (process_count, connections)
+    if key not in _hosts:
+        root = str(tmpdir_factory.mktemp('host%d_%d' % key))
+        _hosts[key] = FakeHost(root, process_count,
+                               latency=request.config.getoption('--bench-latency'),
+                               output_size=request.config.getoption('--bench-output-size'),
+                               connections=connections)
+    return _hosts[key]
+
+
+@pytest.fixture(scope='session')
+def http_server(request):
+    ''' the stand-in HTTP server of --bench-vhosts vhosts, started once per session '''
+    server = StubServer(vhosts=vhost_names(request.config.getoption('--bench-vhosts')))
+    server.start()
+    request.addfinalizer(server.stop)
+    return server
+
+
+_loader = test_bundle.CheckLoader()
+
+@pytest.fixture
+def run_check(fake_host, monkeypatch):
+    '''
+    Returns the function which runs a test module with the arguments on the
+    simulated host and returns the result.
+    '''
+    def get_bin_path(module, arg, required=False, opt_dirs=[]):
+        path = os.path.join(fake_host.bin_dir, arg)
+        if os.path.exists(path):
+            return path
+        if required:
+            module.fail_json(msg='Failed to find required executable %s' % arg)
+        return None
+
+    def check_open(path, *args, **kwargs):
+        return test_bundle._check_open(fake_host.map(path), *args, **kwargs)
+
+    monkeypatch.setattr(test_bundle.CheckModule, 'get_bin_path', get_bin_path)
+    fake_os = FakeOs(fake_host)
+
+    def run(module, args):
+        if not _loader.loaded(module):
+            with open(os.path.join(LIBRARY_DIR, '%s.py' % module)) as f:
+                _loader.load(module, f.read())
+        namespace = _loader.namespace(module)
+        namespace['open'] = check_open
+        namespace['os'] = fake_os
+        params = dict(args)
+        params.update(_ansible_check_mode=True)
+        return _loader.run(module, params)
+
+    return run
+
+
+@pytest.fixture
+def run_process(fake_host):
+    '''
+    Returns the function which runs a command as a process on the simulated
+    host and returns its standard output.
+    '''
+    env = fake_host.environ()
+
+    def run(args):
+        p = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        # NOTE: A failed check exits with 1 and its result in stdout.
+        if not stdout:
+            pytest.fail('%s exited with %d: %s' % (args[-1], p.returncode, to_native(stderr)))
+        return to_native(stdout)
+
+    return run
+
+
+@pytest.fixture
+def module_payload(tmpdir):
+    '''
+    Returns the function which writes the AnsiballZ payload of a test module
+    with the arguments, as Ansible builds it for this python, and returns its
+    path and size.
+    '''
+    def build(module, args):
+        params = dict(args)
+        params.update(_ansible_check_mode=True)
+        data = modify_module(module, os.path.join(LIBRARY_DIR, '%s.py' % module), params,
+                             task_vars=dict(ansible_python_interpreter=sys.executable),
+                             module_compression='ZIP_DEFLATED')[0]
+        path = str(tmpdir.join('%s.py' % module))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path, len(data)
+
+    return build
+
+
+@pytest.fixture
+def check_allocations(request, benchmark):
+    '''
+    Returns the function which runs a function once with tracemalloc, adds its
+    peak allocation to the extra info of the benchmark and fails the test if
+    it exceeds the baseline.
+    '''
+    def check(func, *args):
+        if tracemalloc is None:
+            return
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info['peak_alloc_bytes'] = peak
+        error = request.config._bench_allocations.record(request.node.name, peak)
+        if error:
+            pytest.fail(error)
+
+    return check
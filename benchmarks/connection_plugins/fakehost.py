@@ -0,0 +1,47 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# fakehost.py is a third party connection plugin for Ansible
+#
+# fakehost.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fakehost.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import pipes
+
+from ansible.module_utils._text import to_native
+from ansible.plugins.connection.local import Connection as LocalConnection
+
+
+class Connection(LocalConnection):
+    '''
+    Local connection to a simulated host of the load harness (see
+    benchmarks/fleet.py). The address of the host (ansible_host) is its
+    directory built by benchmarks/fakehost.py.
+
+    The commands run as local processes with the stub executables of the
+    host first in PATH, and its usercustomize, which overlays the files of
+    the host on /proc, /etc and /run for the python processes.
+    '''
+
+    transport = 'fakehost'
+
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        root = self._play_context.remote_addr
+        env = 'export FAKE_HOST_ROOT=%s PYTHONPATH=%s PATH=%s:"$PATH"; ' % (
+            pipes.quote(root),
+            pipes.quote(os.path.join(root, 'site')),
+            pipes.quote(os.path.join(root, 'bin')))
+        # NOTE: The local connection runs a string command with the shell.
+        return super(Connection, self).exec_command(env + to_native(cmd), in_data=in_data, sudoable=sudoable)
@@ -0,0 +1,411 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# fakehost.py is a part of the benchmarks of the third party test modules for Ansible
+#
+# fakehost.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fakehost.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+A simulated host in a directory, for the benchmarks of the test modules.
+
+  - proc/<pid>/{stat,cmdline} of the processes
+  - proc/net/{tcp,tcp6,udp,udp6} with the LISTENERS of the daemons and
+    the established connections (CONNECTIONS by default), and proc/<pid>/fd/<fd> links to
+    their sockets
+  - etc/init.d/<service>, etc/redhat-release and run/<name>.pid
+    (var/run is a link to run)
+  - bin/ with the stub executables ps, pgrep, rpm, systemctl, chkconfig,
+    service and iptables-save, which answer from the files of the host
+    after sleeping the latency, including the listings which test_snapshot
+    collects. The listing commands (ps auxww, rpm -qa and iptables-save)
+    print output_size more bytes.
+  - rpmdb.txt, the synthetic rpm -qa listing, and iptables.rules
+  - site/usercustomize.py, which makes a python process whose PYTHONPATH
+    includes site/ and whose FAKE_HOST_ROOT is the directory see the host:
+    see CUSTOMIZE_SOURCE
+
+The microbenchmarks (conftest.py) map the paths in the modules run in
+process instead, and the load harness (fleet.py) runs the modules on the
+hosts with the fakehost connection (connection_plugins/fakehost.py).
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import stat
+import sys
+
+
+# the daemons of the simulated host; the other processes are workers
+DAEMONS = (
+    ('sshd', '/usr/sbin/sshd -D'),
+    ('crond', '/usr/sbin/crond -n'),
+    ('nginx', 'nginx: master process /usr/sbin/nginx -c /etc/nginx/nginx.conf'),
+    ('mysqld', '/usr/sbin/mysqld --basedir=/usr'),
+    ('rsyslogd', '/usr/sbin/rsyslogd -n'),
+)
+PACKAGES = ('bash', 'coreutils', 'nginx', 'openssh-server', 'cronie', 'rsyslog', 'mysql-server')
+SERVICES = {
+    'crond': dict(running=True, enabled=True),
+    'nginx': dict(running=True, enabled=True),
+    'iptables': dict(running=False, enabled=False),
+}
+UNITS = {
+    'nginx.service': dict(active=True, enabled=True),
+    'sshd.service': dict(active=True, enabled=True),
+    'postfix.service': dict(active=False, enabled=False),
+}
+# the listening sockets (proto, address, port) of the daemons; the other
+# sockets in /proc/net/tcp are connections to them
+LISTENERS = {
+    'sshd': [('tcp', '00000000', 22)],
+    'nginx': [('tcp', '00000000', 80), ('tcp6', '00000000000000000000000000000000', 80)],
+    'mysqld': [('tcp', '0100007F', 3306)],
+}
+CONNECTIONS = 3
+IPTABLES_RULES = '''\
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT
+COMMIT
+'''
+
+STUB_SOURCE = '''\
+import json, os, re, sys, time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))
+with open(os.path.join(root, 'host.json')) as f:
+    host = json.load(f)
+time.sleep(host['latency'])
+name = os.path.basename(sys.argv[0])
+args = [a for a in sys.argv[1:] if a != '--user']
+out = sys.stdout.write
+
+def procs():
+    with open(os.path.join(root, 'procs.txt')) as f:
+        for line in f:
+            yield line.rstrip('\\n').split('\\t')
+
+def ps_line(pid, comm, cmdline):
+    return 'root     %6s  0.0  0.1  10000  2000 ?        Ss   00:00   0:00 %s\\n' % (pid, cmdline)
+
+def padding():
+    return ''.join('# padding %53d\\n' % i for i in range(host['output_size'] // 64))
+
+if name == 'ps':
+    out('USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND\\n')
+    if args[0] == 'auxww':
+        for pid, comm, cmdline in procs():
+            out(ps_line(pid, comm, cmdline))
+        out(padding())
+    else:
+        wanted = set(' '.join(args[2:]).replace(',', ' ').split())
+        found = [p for p in procs() if p[0] in wanted]
+        for pid, comm, cmdline in found:
+            out(ps_line(pid, comm, cmdline))
+        sys.exit(not found and 1 or 0)
+
+elif name == 'pgrep':
+    pattern = re.compile(args[-1])
+    pids = [pid for pid, comm, cmdline in procs() if pattern.search('-f' in args and cmdline or comm)]
+    out(''.join('%s\\n' % pid for pid in pids))
+    sys.exit(not pids and 1 or 0)
+
+elif name == 'rpm':
+    with open(os.path.join(root, 'rpmdb.txt')) as f:
+        packages = f.read().splitlines()
+    if args == ['-qa']:
+        out(''.join('%s\\n' % p for p in packages) + padding())
+    elif args[0] == '-qa':
+        # --qf of the name, epoch, version, release and arch
+        for p in packages:
+            nv, release = p.rsplit('-', 1)
+            n, version = nv.rsplit('-', 1)
+            release, arch = release.rsplit('.', 1)
+            out('%s\\t(none)\\t%s\\t%s\\t%s\\n' % (n, version, release, arch))
+    else:
+        found = [p for p in packages if re.match(re.escape(args[-1]) + r'($|-[0-9])', p)]
+        out(found and '%s\\n' % found[0] or 'package %s is not installed\\n' % args[-1])
+        sys.exit(not found and 1 or 0)
+
+elif name == 'systemctl':
+    unit = host['units'].get(args[-1])
+    if args[0] == 'list-unit-files':
+        for unit_name, unit in sorted(host['units'].items()):
+            out('%s %s\\n' % (unit_name, unit['enabled'] and 'enabled' or 'disabled'))
+    elif args[0] == 'list-units':
+        for unit_name, unit in sorted(host['units'].items()):
+            out('%s loaded %s\\n' % (unit_name, unit['active'] and 'active running' or 'inactive dead'))
+    elif args[0] == 'show':
+        out('LoadState=%s\\n' % (unit and 'loaded' or 'not-found'))
+    elif args[0] == 'is-active':
+        out(unit and unit['active'] and 'active\\n' or 'inactive\\n')
+        sys.exit(not (unit and unit['active']) and 3 or 0)
+    elif args[0] == 'is-enabled':
+        out(unit and unit['enabled'] and 'enabled\\n' or 'disabled\\n')
+        sys.exit(not (unit and unit['enabled']) and 1 or 0)
+
+elif name == 'chkconfig' and args == ['--list']:
+    for service_name, service in sorted(host['services'].items()):
+        level = service['enabled'] and 'on' or 'off'
+        out('%s\\t0:off\\t1:off\\t2:%s\\t3:%s\\t4:%s\\t5:%s\\t6:off\\n' % (service_name, level, level, level, level))
+
+elif name == 'chkconfig':
+    service = host['services'].get(args[-1])
+    if service is None:
+        sys.stderr.write('error reading information on service %s: No such file or directory\\n' % args[-1])
+        sys.exit(1)
+    level = service['enabled'] and 'on' or 'off'
+    out('%s\\t0:off\\t1:off\\t2:%s\\t3:%s\\t4:%s\\t5:%s\\t6:off\\n' % (args[-1], level, level, level, level))
+
+elif name == 'service':
+    service = host['services'].get(args[0])
+    if service and service['running']:
+        out('%s (pid  100) is running...\\n' % args[0])
+    else:
+        out('%s is stopped\\n' % args[0])
+        sys.exit(3)
+
+elif name == 'iptables-save':
+    with open(os.path.join(root, 'iptables.rules')) as f:
+        out('# Generated by iptables-save v1.4.7\\n' + f.read() + '# Completed\\n' + padding())
+'''
+
+STUBS = ('ps', 'pgrep', 'rpm', 'systemctl', 'chkconfig', 'service', 'iptables-save')
+# the system tools which the python processes on the host do not see: the
+# stubs in PATH instead, and the service tools of the other distributions
+HIDDEN_TOOLS = STUBS + ('update-rc.d', 'insserv', 'rc-service', 'rc-update', 'initctl')
+
+# NOTE: This runs in every python process of the modules on the host, so it
+# must run on the python versions of the remote nodes (2.6 and later). It is
+# usercustomize because the module wrapper of Ansible puts its sitecustomize
+# first in PYTHONPATH.
+CUSTOMIZE_SOURCE = '''\
+import os
+import sys
+
+root = os.environ.get('FAKE_HOST_ROOT')
+if root:
+    import atexit
+    import resource
+    try:
+        import __builtin__ as builtins
+    except ImportError:
+        import builtins
+
+    OVERLAID = ('/proc/', '/etc/', '/run/', '/var/run/')
+    SYSTEM_BIN_DIRS = ('/sbin', '/usr/sbin', '/usr/local/sbin', '/bin', '/usr/bin', '/usr/local/bin')
+    STRING_TYPES = (str, type(u''))
+    HIDDEN = set(os.path.join(d, name) for d in SYSTEM_BIN_DIRS for name in %(hidden)r)
+
+    _open = builtins.open
+    _exists = os.path.exists
+    _lexists = os.path.lexists
+    _isfile = os.path.isfile
+    _isdir = os.path.isdir
+    _listdir = os.listdir
+    _stat = os.stat
+    _access = os.access
+    _readlink = os.readlink
+
+    def overlay(path):
+        # the files of the host shadow the files of the same paths
+        if isinstance(path, STRING_TYPES) and path.startswith(OVERLAID) and _lexists(root + path):
+            return root + path
+        return path
+
+    def fake_open(path, *args, **kwargs):
+        return _open(overlay(path), *args, **kwargs)
+
+    def fake_exists(path):
+        return path not in HIDDEN and _exists(overlay(path))
+
+    def fake_listdir(path):
+        # the directories of the host replace the directories of the same paths
+        if isinstance(path, STRING_TYPES) and (path.rstrip('/') + '/').startswith(OVERLAID) and _isdir(root + path):
+            return _listdir(root + path)
+        return _listdir(path)
+
+    def record_usage():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        fd = os.open(os.path.join(root, 'usage.log'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 420)
+        try:
+            os.write(fd, ('%%.6f\\n' %% (usage.ru_utime + usage.ru_stime)).encode('ascii'))
+        finally:
+            os.close(fd)
+
+    builtins.open = fake_open
+    os.path.exists = fake_exists
+    os.path.isfile = lambda path: _isfile(overlay(path))
+    os.path.isdir = lambda path: _isdir(overlay(path))
+    os.listdir = fake_listdir
+    os.stat = lambda path, *args, **kwargs: _stat(overlay(path), *args, **kwargs)
+    os.access = lambda path, mode, *args, **kwargs: _access(overlay(path), mode, *args, **kwargs)
+    os.readlink = lambda path: _readlink(overlay(path))
+    atexit.register(record_usage)
+''' % dict(hidden=HIDDEN_TOOLS)
+
+
+class FakeHost(object):
+    '''
+    A simulated host in a directory.
+    '''
+
+    MAPPED_PREFIXES = ('/proc/', '/etc/', '/run/', '/var/run/')
+
+    def __init__(self, root, process_count, latency=0.0, output_size=0,
+                 packages=None, services=None, units=None, iptables_rules=None, release=None,
+                 connections=CONNECTIONS):
+        self.root = root
+        self.process_count = process_count
+        self.connections = connections
+        self.bin_dir = os.path.join(root, 'bin')
+        self.site_dir = os.path.join(root, 'site')
+        self.daemon_pids = {}
+
+        procs = []
+        for i in range(process_count):
+            pid = i + 1
+            if i < len(DAEMONS):
+                comm, cmdline = DAEMONS[i]
+                self.daemon_pids[comm] = pid
+            else:
+                comm = 'worker'
+                cmdline = 'worker --id %d --queue jobs' % pid
+            procs.append((pid, comm, cmdline))
+            proc_dir = os.path.join(root, 'proc', str(pid))
+            os.makedirs(proc_dir)
+            self._write(os.path.join(proc_dir, 'stat'), '%d (%s) S 1 %d %d 0 -1 4202752 0 0 0 0 0 0 0 0 20 0 1 0 100\n' % (pid, comm, pid, pid))
+            self._write(os.path.join(proc_dir, 'cmdline'), cmdline.replace(' ', '\0') + '\0')
+        self._write(os.path.join(root, 'procs.txt'), ''.join('%d\t%s\t%s\n' % p for p in procs))
+        self._write_sockets()
+
+        os.makedirs(os.path.join(root, 'run'))
+        os.makedirs(os.path.join(root, 'var'))
+        os.symlink('../run', os.path.join(root, 'var', 'run'))
+        for comm, pid in self.daemon_pids.items():
+            self._write(os.path.join(root, 'run', '%s.pid' % comm), '%d\n' % pid)
+
+        if services is None:
+            services = SERVICES
+        os.makedirs(os.path.join(root, 'etc', 'init.d'))
+        for name in services:
+            self._write(os.path.join(root, 'etc', 'init.d', name), '#!/bin/sh\n')
+        if release is not None:
+            self._write(os.path.join(root, 'etc', 'redhat-release'), release + '\n')
+
+        if packages is None:
+            packages = ['%s-1.0-1.el7.x86_64' % p for p in PACKAGES]
+        packages = list(packages) + ['lib%05d-1.0-1.el7.x86_64' % i for i in range(max(process_count // 10, 100))]
+        self._write(os.path.join(root, 'rpmdb.txt'), '\n'.join(sorted(packages)) + '\n')
+        self._write(os.path.join(root, 'iptables.rules'), iptables_rules or IPTABLES_RULES)
+
+        self._write(os.path.join(root, 'host.json'), json.dumps(dict(
+            latency=latency, output_size=output_size, services=services,
+            units=units is None and UNITS or units)))
+
+        os.makedirs(self.bin_dir)
+        stub = os.path.join(self.bin_dir, 'stub.py')
+        self._write(stub, '#!%s\n%s' % (sys.executable, STUB_SOURCE))
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        for name in STUBS:
+            os.symlink('stub.py', os.path.join(self.bin_dir, name))
+
+        os.makedirs(self.site_dir)
+        self._write(os.path.join(self.site_dir, 'usercustomize.py'), CUSTOMIZE_SOURCE)
+
+    def _write_sockets(self):
+        ''' writes proc/net/* and the proc/<pid>/fd links of the listening sockets of the daemons '''
+        os.makedirs(os.path.join(self.root, 'proc', 'net'))
+        rows = dict(tcp=[], tcp6=[], udp=[], udp6=[])
+        inode = 10000
+        for comm, pid in sorted(self.daemon_pids.items()):
+            fd_dir = os.path.join(self.root, 'proc', str(pid), 'fd')
+            os.makedirs(fd_dir)
+            for fd, (proto, addr, port) in enumerate(LISTENERS.get(comm, [])):
+                inode += 1
+                remote = '0' * len(addr)
+                rows[proto].append((addr, port, remote, 0, '0A', inode))
+                os.symlink('socket:[%d]' % inode, os.path.join(fd_dir, str(fd + 3)))
+        # NOTE: The kernel lists the listening sockets first.
+        for i in range(self.connections):
+            rows['tcp'].append(('0100000A', 22, '0200000A', 40000 + i % 20000, '01', 0))
+        for proto, proto_rows in rows.items():
+            lines = ['  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode']
+            for i, (addr, port, remote, remote_port, state, row_inode) in enumerate(proto_rows):
+                lines.append('%4d: %s:%04X %s:%04X %s 00000000:00000000 00:00000000 00000000     0        0 %d 1 0000000000000000 100 0 0 10 0'
+                             % (i, addr, port, remote, remote_port, state, row_inode))
+            self._write(os.path.join(self.root, 'proc', 'net', proto), '\n'.join(lines) + '\n')
+
+    def _write(self, path, data):
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def map(self, path):
+        ''' returns the path in the simulated host of an absolute path on the remote node '''
+        if (path.rstrip('/') + '/').startswith(self.MAPPED_PREFIXES):
+            return os.path.join(self.root, path[1:])
+        return path
+
+    def environ(self):
+        ''' returns the environment of a python process run on the host '''
+        env = dict(os.environ)
+        env['FAKE_HOST_ROOT'] = self.root
+        env['PYTHONPATH'] = os.pathsep.join(p for p in (self.site_dir, env.get('PYTHONPATH')) if p)
+        env['PATH'] = os.pathsep.join(p for p in (self.bin_dir, env.get('PATH')) if p)
+        return env
+
+    def cpu_time(self):
+        ''' returns the CPU seconds of the python processes run on the host with site/ '''
+        path = os.path.join(self.root, 'usage.log')
+        if not os.path.exists(path):
+            return 0.0
+        with open(path) as f:
+            return sum(float(line) for line in f if line.strip())
+
+
+class FakeOs(object):
+    ''' the os module whose os.path functions, listdir and readlink see the files of the simulated host '''
+
+    def __init__(self, host):
+        self._host = host
+        self.path = FakeOsPath(host)
+
+    def listdir(self, path):
+        return os.listdir(self._host.map(path))
+
+    def readlink(self, path):
+        return os.readlink(self._host.map(path))
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
+class FakeOsPath(object):
+
+    def __init__(self, host):
+        self._host = host
+
+    def exists(self, path):
+        return os.path.exists(self._host.map(path))
+
+    def isfile(self, path):
+        return os.path.isfile(self._host.map(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self._host.map(path))
+
+    def __getattr__(self, name):
+        return getattr(os.path, name)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# fleet.py is a part of the benchmarks of the third party test modules for Ansible
+#
+# fleet.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fleet.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Runs testbook.yml in check mode against a generated fleet of simulated
+hosts and reports the wall time, the CPU time and the RSS of the controller,
+and the throughput of each task.
+
+usage: fleet.py [options]
+
+Each host is a directory built by fakehost.py, reached with the fakehost
+connection (connection_plugins/fakehost.py): its commands run as local
+processes which see the processes, packages, services and iptables rules
+of the host. The hosts are in the groups centos6 or centos7 and rackNN,
+whose group_vars differ, and the packages, services and iptables rules
+of each host match its group_vars. The vhosts which the hosts probe are
+served by one stand-in server on 127.0.0.1 (see httpserver.py).
+
+The controller CPU time is the CPU time of ansible-playbook and its
+children minus the CPU time of the python processes run on the hosts,
+which their usercustomize records. The RSS is the peak of the
+ansible-playbook process and the peak of the sum of it and its workers.
+
+Run with the python of Ansible (the host directories get stub executables
+of this python), for example:
+
+    python benchmarks/fleet.py -n 10,100,1000 -f 50
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import jinja2
+import yaml
+
+from fakehost import FakeHost
+from httpserver import StubServer, vhost_names
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+DISTROS = {
+    'centos6': dict(
+        release='CentOS release 6.9 (Final)',
+        test_iptables_version='iptables-1.4.7-16.el6.x86_64',
+        test_nginx_version='nginx-1.11.9-6.el6.ngx.x86_64',
+    ),
+    'centos7': dict(
+        release='CentOS Linux release 7.3.1611 (Core)',
+        test_iptables_version='iptables-1.4.21-17.el7.x86_64',
+        test_nginx_version='nginx-1.11.9-8.el7.centos.ngx.x86_64',
+    ),
+}
+CONTAINERS_VARS = dict(
+    allowed_ports_for_specific_addresses=[{'address': '192.168.1.0/24', 'port': 22}],
+)
+SERVICES = {
+    'iptables': dict(running=True, enabled=True),
+    'nginx': dict(running=True, enabled=True),
+    'crond': dict(running=True, enabled=True),
+}
+SAMPLE_INTERVAL = 0.2
+
+
+def rack_vars(rack):
+    return dict(worldwide_allowed_ports=[80, 443, 8000 + rack])
+
+
+class Fleet(object):
+    '''
+    The working directory of a run: the hosts, the inventory and its
+    group_vars, and the playbook.
+    '''
+
+    def __init__(self, workdir, count, options):
+        os.makedirs(workdir)
+        self.workdir = workdir
+        self.hosts = []
+        self.playbook = os.path.join(workdir, 'testbook.yml')
+        self.inventory = os.path.join(workdir, 'hosts')
+        self.timing_file = os.path.join(workdir, 'timing.json')
+        self.log_file = os.path.join(workdir, 'ansible.log')
+
+        template = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.join(REPO_DIR, 'roles', 'test-iptables', 'templates')),
+            trim_blocks=True, keep_trailing_newline=True).get_template('iptables.conf.j2')
+
+        groups = dict((name, []) for name in DISTROS)
+        racks = dict((rack, []) for rack in range(options.racks))
+        for i in range(count):
+            name = 'fake%04d' % (i + 1)
+            distro = i % 2 and 'centos7' or 'centos6'
+            rack = i % options.racks
+            distro_vars = DISTROS[distro]
+            host_vars = dict(CONTAINERS_VARS)
+            host_vars.update(rack_vars(rack))
+            host = FakeHost(os.path.join(workdir, 'hosts.d', name), options.procs,
+                            latency=options.latency, output_size=options.output_size,
+                            packages=[distro_vars['test_iptables_version'], distro_vars['test_nginx_version']],
+                            services=SERVICES, iptables_rules=template.render(**host_vars),
+                            release=distro_vars['release'])
+            self.hosts.append(host)
+            groups[distro].append((name, host))
+            racks[rack].append((name, host))
+
+        with open(self.inventory, 'w') as f:
+            for group, members in sorted(groups.items()):
+                f.write('[%s]\n' % group)
+                for name, host in members:
+                    f.write('%s ansible_host=%s\n' % (name, host.root))
+            for rack, members in sorted(racks.items()):
+                f.write('[rack%02d]\n' % rack)
+                f.write(''.join('%s\n' % name for name, host in members))
+            f.write('[containers:children]\n')
+            f.write(''.join('%s\n' % group for group in sorted(groups)))
+            f.write(''.join('rack%02d\n' % rack for rack in sorted(racks)))
+            f.write('[containers:vars]\nansible_connection=fakehost\nansible_python_interpreter=%s\n' % options.python)
+
+        # NOTE: JSON is YAML.
+        group_vars = dict((name, dict((k, v) for k, v in distro_vars.items() if k != 'release'))
+                          for name, distro_vars in DISTROS.items())
+        group_vars['containers'] = dict(CONTAINERS_VARS, test_nginx_http_url=options.http_url,
+                                        test_nginx_vhosts=vhost_names(options.vhosts))
+        if options.load_duration:
+            group_vars['containers']['test_nginx_load_duration'] = options.load_duration
+        group_vars.update(('rack%02d' % rack, rack_vars(rack)) for rack in racks)
+        os.makedirs(os.path.join(workdir, 'group_vars'))
+        for group, group_vars in group_vars.items():
+            with open(os.path.join(workdir, 'group_vars', '%s.yml' % group), 'w') as f:
+                json.dump(group_vars, f)
+
+        with open(options.playbook) as f:
+            plays = yaml.safe_load(f)
+        if options.strategy:
+            for play in plays:
+                play['strategy'] = options.strategy
+        with open(self.playbook, 'w') as f:
+            yaml.safe_dump(plays, f, default_flow_style=False, allow_unicode=True)
+
+    def environ(self, options):
+        def plugin_path(kind, *dirs):
+            return os.pathsep.join(os.path.join(d, kind) for d in dirs)
+
+        env = dict(os.environ)
+        env.update(
+            ANSIBLE_LIBRARY=os.path.join(REPO_DIR, 'library'),
+            ANSIBLE_ROLES_PATH=os.path.join(REPO_DIR, 'roles'),
+            ANSIBLE_ACTION_PLUGINS=plugin_path('action_plugins', REPO_DIR),
+            ANSIBLE_CALLBACK_PLUGINS=plugin_path('callback_plugins', REPO_DIR, BENCHMARKS_DIR),
+            ANSIBLE_CONNECTION_PLUGINS=plugin_path('connection_plugins', REPO_DIR, BENCHMARKS_DIR),
+            ANSIBLE_STRATEGY_PLUGINS=plugin_path('strategy_plugins', REPO_DIR),
+            ANSIBLE_STDOUT_CALLBACK=options.callback,
+            ANSIBLE_CALLBACK_WHITELIST='fleet_timing',
+            ANSIBLE_FORCE_HANDLERS='True',
+            ANSIBLE_RETRY_FILES_ENABLED='False',
+            FLEET_TIMING_FILE=self.timing_file,
+        )
+        return env
+
+    def host_cpu_time(self):
+        return sum(host.cpu_time() for host in self.hosts)
+
+
+def read_proc_status(pid):
+    ''' returns the fields of /proc/<pid>/status in kB, or None if the process is gone '''
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except (IOError, OSError):
+        return None
+    return dict((k, int(v.split()[0])) for k, v in fields.items() if k in ('VmRSS', 'VmHWM'))
+
+
+def controller_pids(pid):
+    ''' returns the pids of the process and its descendants with the same command line (the forked workers) '''
+    def read(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    cmdline = read('/proc/%d/cmdline' % pid)
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        stat = read('/proc/%s/stat' % name)
+        if stat is None:
+            continue
+        ppid = int(stat[stat.rindex(b')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    pids = []
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        pids.append(p)
+        todo.extend(c for c in children.get(p, []) if read('/proc/%d/cmdline' % c) == cmdline)
+    return pids
+
+
+def run_playbook(fleet, options):
+    ''' runs the playbook and returns the measurements '''
+    cmd = [options.ansible_playbook, '-C', '-i', fleet.inventory, '-f', str(options.forks), fleet.playbook]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    with open(fleet.log_file, 'w') as log:
+        p = subprocess.Popen(cmd, cwd=fleet.workdir, env=fleet.environ(options), stdout=log, stderr=subprocess.STDOUT)
+        peak_rss = peak_total_rss = 0
+        while p.poll() is None:
+            status = read_proc_status(p.pid)
+            if status:
+                peak_rss = max(peak_rss, status.get('VmHWM', 0))
+                total = 0
+                for pid in controller_pids(p.pid):
+                    total += (read_proc_status(pid) or {}).get('VmRSS', 0)
+                peak_total_rss = max(peak_total_rss, total)
+            time.sleep(SAMPLE_INTERVAL)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    host_cpu = fleet.host_cpu_time()
+    tasks = []
+    if os.path.exists(fleet.timing_file):
+        with open(fleet.timing_file) as f:
+            for task in json.load(f):
+                span = task['end'] and task['end'] - task['start'] or 0.0
+                task['span'] = span
+                task['throughput'] = span and task['results'] / span or None
+                tasks.append(task)
+    return dict(
+        hosts=len(fleet.hosts),
+        forks=options.forks,
+        rc=p.returncode,
+        wall=wall,
+        controller_cpu=cpu - host_cpu,
+        host_cpu=host_cpu,
+        controller_rss_kb=peak_rss,
+        controller_total_rss_kb=peak_total_rss,
+        results=sum(task['results'] for task in tasks),
+        tasks=tasks,
+        log=fleet.log_file,
+    )
+
+
+def print_run(run):
+    print('%d hosts (rc=%d, log: %s)' % (run['hosts'], run['rc'], run['log']))
+    print('    %-40s %8s %9s %11s' % ('task', 'results', 'span', 'results/s'))
+    for task in run['tasks']:
+        throughput = task['throughput'] and '%11.1f' % task['throughput'] or '%11s' % '-'
+        print('    %-40s %8d %8.2fs %s' % (task['name'][:40], task['results'], task['span'], throughput))
+
+
+def print_summary(runs):
+    print('%6s %6s %9s %9s %9s %10s %10s %8s %10s' % (
+        'hosts', 'forks', 'wall', 'ctl cpu', 'host cpu', 'ctl rss', 'total rss', 'results', 'results/s'))
+    for run in runs:
+        print('%6d %6d %8.1fs %8.1fs %8.1fs %9.1fM %9.1fM %8d %10.1f' % (
+            run['hosts'], run['forks'], run['wall'], run['controller_cpu'], run['host_cpu'],
+            run['controller_rss_kb'] / 1024.0, run['controller_total_rss_kb'] / 1024.0,
+            run['results'], run['results'] / run['wall']))
+
+
+def main(args):
+    parser = OptionParser(usage=__doc__.strip())
+    parser.add_option('-n', '--hosts', default='10,100',
+                      help='comma separated numbers of hosts to run with (default: 10,100)')
+    parser.add_option('-f', '--forks', type='int', default=50, help='the forks of ansible-playbook (default: 50)')
+    parser.add_option('--strategy', default=None, help='the strategy of the plays (default: as in the playbook)')
+    parser.add_option('--callback', default='test', help='the stdout callback (default: test)')
+    parser.add_option('--procs', type='int', default=50, help='the processes on each host (default: 50)')
+    parser.add_option('--racks', type='int', default=10, help='the rackNN groups of the hosts (default: 10)')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds the stub executables of the hosts sleep before answering (default: 0)')
+    parser.add_option('--output-size', type='int', default=0,
+                      help='bytes added to the output of the listing stub executables (default: 0)')
+    parser.add_option('--vhosts', type='int', default=20, help='the vhosts which the hosts probe (default: 20)')
+    parser.add_option('--load-duration', type='float', default=0,
+                      help='seconds of the load of the vhosts from each host (default: 0, no load)')
+    parser.add_option('--playbook', default=os.path.join(REPO_DIR, 'testbook.yml'),
+                      help='the playbook (default: testbook.yml)')
+    parser.add_option('--ansible-playbook', default='ansible-playbook', help='the ansible-playbook command')
+    parser.add_option('--python', default=sys.executable,
+                      help='ansible_python_interpreter of the hosts (default: this python)')
+    parser.add_option('--workdir', default=None,
+                      help='the directory of the hosts and the logs, which is kept (default: a temporary directory)')
+    parser.add_option('--json', default=None, help='write the measurements to this JSON file')
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error('no arguments are accepted')
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='fleet-')
+    server = StubServer(vhosts=vhost_names(options.vhosts))
+    server.start()
+    options.http_url = 'http://127.0.0.1:%d/' % server.port
+    runs = []
+    try:
+        for count in [int(n) for n in options.hosts.split(',') if n.strip()]:
+            fleet = Fleet(os.path.join(workdir, 'n%d' % count), count, options)
+            run = run_playbook(fleet, options)
+            print_run(run)
+            runs.append(run)
+    finally:
+        server.stop()
+        if options.workdir is None:
+            # NOTE: Keep the logs of the runs only.
+            for name in os.listdir(workdir):
+                shutil.rmtree(os.path.join(workdir, name, 'hosts.d'), ignore_errors=True)
+
+    print()
+    print_summary(runs)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(runs, f, indent=4)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,168 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# httpserver.py is a third party benchmark tool for Ansible
+#
+# httpserver.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# httpserver.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+A stand-in of nginx for the test_http module: a HTTP/1.1 server with
+keep-alive which serves vhosts.
+
+usage: httpserver.py [options]
+
+The server answers a GET or HEAD of any path of a vhost with 200 and the
+body of the vhost, and of an unknown vhost with 404. The body of a vhost
+is body_size bytes starting with its name, and the response waits delay
+seconds. The Server header is nginx-stub.
+
+It counts the connections and the requests, so that the reuse of the
+keep-alive connections can be seen. Run it in a thread with StubServer:
+
+    server = StubServer(vhosts=vhost_names(200))
+    server.start()
+    # probe 'http://127.0.0.1:%d/' % server.port
+    server.stop()
+
+or as a process:
+
+    python benchmarks/httpserver.py --port 8080 --vhosts 200
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+def vhost_names(count):
+    ''' returns the names of count vhosts '''
+    return ['vhost%03d.example.com' % i for i in range(count)]
+
+
+def vhost_body(name, size):
+    ''' returns the body of a vhost, size bytes starting with its name '''
+    line = ('%s\n' % name).encode('ascii')
+    return (line * (size // len(line) + 1))[:max(size, len(line))]
+
+
+def body_checksum(name, size):
+    ''' returns the checksum of the body of a vhost as the checksum option of test_http '''
+    return 'sha256:%s' % hashlib.sha256(vhost_body(name, size)).hexdigest()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'nginx-stub'
+    sys_version = ''
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # NOTE: The headers and the body are written separately, so
+        # disable the Nagle algorithm as nginx does (tcp_nodelay on).
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.count('connections')
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def _respond(self, with_body):
+        self.server.count('requests')
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        name = (self.headers.get('Host') or '').split(':')[0]
+        if name in self.server.vhosts:
+            status, body = 200, self.server.bodies[name]
+        else:
+            status, body = 404, b'not found\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    ''' the server in a thread, listening on a free port of 127.0.0.1 unless port is given '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, vhosts=('localhost', '127.0.0.1'), delay=0.0, body_size=612):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.port = self.server_address[1]
+        self.vhosts = set(vhosts)
+        self.bodies = dict((name, vhost_body(name, body_size)) for name in vhosts)
+        self.delay = delay
+        self.counts = dict(connections=0, requests=0)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+
+def main(args):
+    parser = OptionParser(usage=__doc__.strip())
+    parser.add_option('--port', type='int', default=8080, help='the port on 127.0.0.1 (default: 8080)')
+    parser.add_option('--vhosts', type='int', default=10,
+                      help='the number of the vhosts vhostNNN.example.com besides localhost (default: 10)')
+    parser.add_option('--delay', type='float', default=0.0, help='seconds each response waits (default: 0)')
+    parser.add_option('--body-size', type='int', default=612, help='bytes of the body of each vhost (default: 612)')
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error('no arguments are accepted')
+
+    server = StubServer(options.port, ['localhost', '127.0.0.1'] + vhost_names(options.vhosts),
+                        options.delay, options.body_size)
+    print('serving %d vhosts on http://127.0.0.1:%d/' % (len(server.vhosts), server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('%(connections)d connections, %(requests)d requests' % server.counts)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
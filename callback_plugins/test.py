@@ -19,9 +19,369 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import atexit
+import base64
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+from functools import wraps
+from xml.sax.saxutils import escape, quoteattr
+
 from ansible import constants as C
+from ansible.executor.task_result import TaskResult
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.six import string_types
+from ansible.module_utils.six.moves import queue
 from ansible.plugins.callback import CallbackBase
 from ansible.utils.color import colorize, hostcolor
+from ansible.utils.display import logger as display_logger
+from ansible.vars import strip_internal_keys
+
+
+class LatencyHistogram(object):
+    '''
+    Streaming histogram of latencies in seconds with bounded memory.
+    Values are counted in buckets whose bounds grow by PRECISION, so a
+    percentile is within that relative error and a day needs less than
+    400 buckets.
+    '''
+
+    PRECISION = 0.05
+    MIN_VALUE = 0.001
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        index = int(math.log(max(value, self.MIN_VALUE) / self.MIN_VALUE) / math.log(1 + self.PRECISION))
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def percentile(self, p):
+        ''' returns the p-th percentile (0 < p <= 100) of the values '''
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                # the geometric middle of the bucket
+                return min(self.MIN_VALUE * (1 + self.PRECISION) ** (index + 0.5), self.max)
+        return self.max
+
+
+class TraceWriter(object):
+    '''
+    Writes a trace-event JSON file for the Chrome trace viewer and Perfetto,
+    with a track (thread) per host and a slice per task.
+
+    Events are written as they come through a buffered file in the JSON
+    array format. The viewers accept the array without the closing bracket,
+    so the file can be loaded even when the run was interrupted.
+    '''
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        self._file = open(to_bytes(path, errors='surrogate_or_strict'), 'wb', self.BUFFER_SIZE)
+        self._file.write(b'[\n')
+        self._pid = os.getpid()
+        self._tids = {}
+        self._write(dict(ph='M', name='process_name', pid=self._pid, tid=0, args=dict(name='ansible-playbook')))
+
+    def _write(self, event):
+        self._file.write(to_bytes(json.dumps(event)) + b',\n')
+
+    def _tid(self, host):
+        if host not in self._tids:
+            self._tids[host] = len(self._tids) + 1
+            self._write(dict(ph='M', name='thread_name', pid=self._pid, tid=self._tids[host], args=dict(name=host)))
+        return self._tids[host]
+
+    def slice(self, host, name, category, start, duration, args):
+        ''' writes a complete event of start and duration in seconds '''
+        self._write(dict(ph='X', name=name, cat=category, pid=self._pid, tid=self._tid(host),
+                         ts=int(start * 1000000), dur=int(duration * 1000000), args=args))
+
+    def close(self):
+        # NOTE: The last event has no trailing comma so that the file is strict JSON.
+        self._file.write(to_bytes(json.dumps(dict(ph='M', name='process_sort_index', pid=self._pid, tid=0,
+                                                  args=dict(sort_index=0)))) + b'\n]\n')
+        self._file.close()
+
+
+class JsonLinesWriter(object):
+    '''
+    Writes the records of the test results to a file as they come, a JSON
+    object per line, through a buffered file.
+    '''
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        self._file = open(to_bytes(path, errors='surrogate_or_strict'), 'wb', self.BUFFER_SIZE)
+
+    def write(self, record):
+        self._file.write(to_bytes(json.dumps(record, sort_keys=True, default=repr)) + b'\n')
+
+    def close(self):
+        self._file.close()
+
+
+class JUnitWriter(object):
+    '''
+    Writes a JUnit XML file of the test results, with a test case per
+    check of each host. As in the recap, a changed result is a failure of
+    the test. A failed or unreachable result is an error.
+
+    The counts in the testsuite element are known only at the end, so the
+    test cases are written to a temporary file as they come, and close()
+    writes the XML file with the counts and copies the test cases into it.
+    '''
+
+    INVALID_XML_CHARS_RE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    def __init__(self, path):
+        self._path = path
+        self._cases = tempfile.TemporaryFile()
+        self._counts = dict(tests=0, failures=0, errors=0, skipped=0)
+        self._time = 0.0
+
+    def write(self, record):
+        name = record['task']
+        if record['check']:
+            name += u' (%s)' % record['check']
+        duration = record['duration'] or 0.0
+        self._counts['tests'] += 1
+        self._time += duration
+
+        case = u'<testcase classname=%s name=%s time="%.3f">' % (quoteattr(record['host']), quoteattr(name), duration)
+        details = escape(json.dumps(record['actual'], indent=4, sort_keys=True, default=repr))
+        message = quoteattr(u'%s' % (record['msg'] or record['status']))
+        if record['status'] == 'changed':
+            self._counts['failures'] += 1
+            case += u'<failure message=%s>%s</failure>' % (message, details)
+        elif record['status'] in ('failed', 'unreachable'):
+            self._counts['errors'] += 1
+            case += u'<error message=%s>%s</error>' % (message, details)
+        elif record['status'] == 'skipped':
+            self._counts['skipped'] += 1
+            case += u'<skipped/>'
+        case += u'</testcase>\n'
+        self._cases.write(to_bytes(self.INVALID_XML_CHARS_RE.sub(u'', case)))
+
+    def close(self):
+        f = open(to_bytes(self._path, errors='surrogate_or_strict'), 'wb')
+        try:
+            f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n')
+            f.write(to_bytes(u'<testsuite name="ansible-test" tests="%d" failures="%d" errors="%d" skipped="%d" time="%.3f">\n' % (
+                self._counts['tests'], self._counts['failures'], self._counts['errors'], self._counts['skipped'], self._time)))
+            self._cases.seek(0)
+            shutil.copyfileobj(self._cases, f)
+            f.write(b'</testsuite>\n</testsuites>\n')
+        finally:
+            f.close()
+            self._cases.close()
+
+
+class HistoryWriter(object):
+    '''
+    Writes the records of the test results to a SQLite database which keeps
+    the results of the runs, for the trend queries of test_history.py.
+
+    The records of a play are inserted in one transaction, which is
+    committed at the start of the next play and at the end of the run.
+    '''
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            playbook TEXT,
+            started REAL,
+            finished REAL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS results (
+            run_id INTEGER NOT NULL REFERENCES runs (id),
+            play TEXT,
+            host TEXT NOT NULL,
+            task TEXT NOT NULL,
+            module TEXT,
+            check_name TEXT,
+            status TEXT NOT NULL,
+            start REAL,
+            duration REAL,
+            expected TEXT,
+            msg TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS results_host_task ON results (host, task, check_name)',
+        'CREATE INDEX IF NOT EXISTS results_run ON results (run_id)',
+    )
+
+    def __init__(self, path):
+        # NOTE: The database is written in the display writer thread.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+        self._run_id = None
+
+    def begin_run(self, playbook):
+        cursor = self._db.execute('INSERT INTO runs (playbook, started) VALUES (?, ?)', (playbook, time.time()))
+        self._run_id = cursor.lastrowid
+
+    def write(self, record):
+        if self._run_id is None:
+            self.begin_run(None)
+        self._db.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            self._run_id, record['play'], record['host'], record['task'], record['module'], record['check'],
+            record['status'], record['start'], record['duration'],
+            record['expected'] is not None and json.dumps(record['expected'], sort_keys=True, default=repr) or None,
+            record['msg'] is not None and u'%s' % record['msg'] or None))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        if self._run_id is not None:
+            self._db.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), self._run_id))
+        self._db.commit()
+        self._db.close()
+
+
+class DisplayWriter(threading.Thread):
+    '''
+    Runs the rendering and the writing of the output in a background
+    thread, so that the strategy does not wait for the terminal or the log
+    file while the workers have results to send.
+
+    The calls are run in the order they are queued. The queue is bounded,
+    so a terminal which cannot keep up makes the callback wait instead of
+    using up memory.
+    '''
+
+    QUEUE_SIZE = 1000
+
+    def __init__(self, display):
+        super(DisplayWriter, self).__init__(name='test-callback-display')
+        self.daemon = True
+        self._display = display
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+
+    def put(self, func, *args, **kwargs):
+        self._queue.put((func, args, kwargs))
+
+    def flush(self):
+        ''' waits until all the queued calls are done '''
+        self._queue.join()
+
+    def run(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                self._display.warning(u"failure in displaying the output: %s" % traceback.format_exc())
+            finally:
+                self._queue.task_done()
+
+
+def deferred(func):
+    ''' makes a method of CallbackModule run in the display writer thread '''
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self._writer.put(func, self, *args, **kwargs)
+    return wrapper
+
+
+HOST_NUMBER_RE = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+def compress_hosts(names):
+    '''
+    Returns the host names joined with commas, with the runs of numbered
+    names compressed to the inventory range syntax. For example, web01,
+    web02, web03 and db1 become db1,web[01:03].
+    '''
+    numbered = {}
+    others = []
+    for name in set(names):
+        m = HOST_NUMBER_RE.match(name)
+        if m is None:
+            others.append(name)
+        else:
+            prefix, digits, suffix = m.groups()
+            numbered.setdefault((prefix, suffix), []).append((int(digits), digits))
+
+    parts = []
+    for (prefix, suffix), numbers in numbered.items():
+        numbers.sort()
+        runs = []
+        for number, digits in numbers:
+            if runs:
+                start, end, width = runs[-1]
+                if number == end[0] + 1 and '%0*d' % (width, number) == digits:
+                    runs[-1] = (start, (number, digits), width)
+                    continue
+            runs.append(((number, digits), (number, digits), digits.startswith('0') and len(digits) or 0))
+        for start, end, width in runs:
+            if start == end:
+                parts.append(u'%s%s%s' % (prefix, start[1], suffix))
+            else:
+                parts.append(u'%s[%s:%s]%s' % (prefix, start[1], end[1], suffix))
+    return u','.join(sorted(parts + others))
+
+
+class OutcomeGroups(object):
+    '''
+    Groups the hosts whose results of a task are identical, so that the
+    results of a fleet are displayed once per distinct outcome. Only a
+    sample result is kept for each outcome.
+    '''
+
+    # NOTE: These keys differ between hosts even if the results are the same.
+    # They are removed also from the dictionaries in the results, like the
+    # probes of test_http.
+    VOLATILE_KEYS = ('start', 'end', 'delta', '_timing', 'cached', 'reused', 'snapshot_time',
+                     'elapsed', 'latency', 'ttfb', 'connections', 'histogram', 'load')
+
+    def __init__(self, task):
+        self.task = task
+        self._groups = {}
+        self._keys = []
+
+    def add(self, host, status, label, result):
+        abridged = dict((k, self._abridge(v)) for k, v in result.items()
+                        if not k.startswith('_ansible_') and k not in self.VOLATILE_KEYS)
+        digest = hashlib.sha1(to_bytes(json.dumps(abridged, sort_keys=True, default=repr))).hexdigest()
+        key = (label, status, digest)
+        if key not in self._groups:
+            self._groups[key] = (status, label, result, [])
+            self._keys.append(key)
+        self._groups[key][3].append(host)
+
+    def _abridge(self, value):
+        if isinstance(value, dict):
+            return dict((k, self._abridge(v)) for k, v in value.items() if k not in self.VOLATILE_KEYS)
+        if isinstance(value, list):
+            return [self._abridge(v) for v in value]
+        return value
+
+    def groups(self):
+        ''' returns the list of (status, label, sample result, hosts) in the order they came '''
+        return [self._groups[key] for key in self._keys]
+
 
 class CallbackModule(CallbackBase):
 
@@ -34,15 +394,421 @@ class CallbackModule(CallbackBase):
     CALLBACK_TYPE = 'stdout'
     CALLBACK_NAME = 'test'
 
+    # NOTE: With these strategies, the results of a task do not come right
+    # after its banner, so the banner is printed with the results.
+    FREE_STRATEGIES = ('free', 'test_fast')
+
+    # the number of the slowest checks and hosts shown in the recap
+    SLOWEST_CHECKS = 10
+    SLOWEST_HOSTS = 5
+
+    # the trace-event JSON file is written to this path if it is set
+    TRACE_FILE_ENV = 'TEST_CALLBACK_TRACE_FILE'
+
+    # the records of the test results are written to these paths if they are set
+    JSONL_FILE_ENV = 'TEST_CALLBACK_JSONL_FILE'
+    JUNIT_FILE_ENV = 'TEST_CALLBACK_JUNIT_FILE'
+    HISTORY_DB_ENV = 'TEST_CALLBACK_HISTORY_DB'
+
+    # NOTE: The profiles of the checks run with the test_profile variable
+    # are saved in this directory as <host>/<task>[-<check>].json, and .prof
+    # for the pstats data with test_profile_stats.
+    PROFILE_DIR_ENV = 'TEST_CALLBACK_PROFILE_DIR'
+    DEFAULT_PROFILE_DIR = 'test_profiles'
+    PROFILE_NAME_RE = re.compile(r'[^\w.-]+', re.UNICODE)
+
+    # NOTE: The strings in these fields of a result are truncated to this
+    # number of characters on the screen (0 for no limit). The full results
+    # are still written to log_path.
+    MAX_FIELD_SIZE_ENV = 'TEST_CALLBACK_MAX_FIELD_SIZE'
+    DEFAULT_MAX_FIELD_SIZE = 8192
+    TRUNCATED_FIELDS = ('stdout', 'stdout_lines', 'stderr', 'stderr_lines', 'diff')
+
+    # NOTE: If this is true, the results of the hosts are grouped by their
+    # outcome and each task is displayed when it is done, with a line per
+    # distinct outcome. The details are displayed only for the failures and
+    # for the outcomes of fewer hosts than the most common one.
+    AGGREGATE_ENV = 'TEST_CALLBACK_AGGREGATE'
+
+    # status of a result -> the name and the color in the output
+    OUTCOME_DISPLAY = {
+        'ok': ('ok', C.COLOR_OK),
+        'changed': ('changed', C.COLOR_CHANGED),
+        'failed': ('failed', C.COLOR_ERROR),
+        'ignored': ('failed', C.COLOR_ERROR),
+        'unreachable': ('unreachable', C.COLOR_UNREACHABLE),
+        'skipped': ('skipping', C.COLOR_SKIP),
+    }
+
     def __init__(self):
 
         self._play = None
         self._last_task_banner = None
+        self._task_starts = {}
+        self._host_starts = {}
+        self._module_latency = {}
+        self._host_latency = {}
+        self._slowest_checks = []
+        self._handler_uuids = set()
+        self._item_ends = {}
+        self._trace = None
+        if os.environ.get(self.TRACE_FILE_ENV):
+            self._trace = TraceWriter(os.environ[self.TRACE_FILE_ENV])
+        self._sinks = []
+        if os.environ.get(self.JSONL_FILE_ENV):
+            self._sinks.append(JsonLinesWriter(os.environ[self.JSONL_FILE_ENV]))
+        if os.environ.get(self.JUNIT_FILE_ENV):
+            self._sinks.append(JUnitWriter(os.environ[self.JUNIT_FILE_ENV]))
+        self._history = None
+        if os.environ.get(self.HISTORY_DB_ENV):
+            self._history = HistoryWriter(os.environ[self.HISTORY_DB_ENV])
+            self._sinks.append(self._history)
+        self._profile_dir = os.environ.get(self.PROFILE_DIR_ENV, self.DEFAULT_PROFILE_DIR)
+        self._max_field_size = int(os.environ.get(self.MAX_FIELD_SIZE_ENV, self.DEFAULT_MAX_FIELD_SIZE))
+        self._aggregate = C.mk_boolean(os.environ.get(self.AGGREGATE_ENV))
+        self._outcomes = {}
+        self._outcome_tasks = []
+        self._sample = None
         super(CallbackModule, self).__init__()
 
+        self._writer = DisplayWriter(self._display)
+        self._writer.start()
+        # NOTE: Display the queued output when the run ends without the stats.
+        atexit.register(self._writer.flush)
+
+    def _truncate(self, value):
+        ''' returns the value with long strings and lists cut down to the size limit, and whether it was cut '''
+        size = self._max_field_size
+        if isinstance(value, string_types):
+            if len(value) > size:
+                return value[:size] + u'... (%d characters truncated)' % (len(value) - size), True
+            return value, False
+        if isinstance(value, list):
+            items = []
+            total = 0
+            cut = False
+            for item in value:
+                if total >= size:
+                    items.append(u'... (%d items truncated)' % (len(value) - len(items)))
+                    return items, True
+                item, item_cut = self._truncate(item)
+                total += isinstance(item, string_types) and len(item) or 1
+                cut = cut or item_cut
+                items.append(item)
+            return items, cut
+        if isinstance(value, dict):
+            items = {}
+            cut = False
+            for key, item in value.items():
+                items[key], item_cut = self._truncate(item)
+                cut = cut or item_cut
+            return items, cut
+        return value, False
+
+    def _truncate_result(self, result):
+        ''' returns a copy of the result with the large fields truncated, or the result itself if none is large '''
+        if not self._max_field_size:
+            return result
+        truncated = None
+        for key in self.TRUNCATED_FIELDS:
+            if key not in result:
+                continue
+            value, cut = self._truncate(result[key])
+            if cut:
+                if truncated is None:
+                    truncated = dict(result)
+                truncated[key] = value
+        return truncated is None and result or truncated
+
+    def _dump_results(self, result, indent=None, sort_keys=True, keep_invocation=False):
+        # NOTE: The spans of the commands and file reads of the checks are shown with -vv.
+        if self._display.verbosity < 2:
+            if '_timing' in result:
+                result = dict(result)
+                del result['_timing']
+        return super(CallbackModule, self)._dump_results(result, indent=indent, sort_keys=sort_keys, keep_invocation=keep_invocation)
+
+    def _display_result(self, msg, result, color=None, keep_invocation=False):
+        ''' displays msg followed by the dump of the result, with the large fields truncated on the screen '''
+        truncated = self._truncate_result(result)
+        if truncated is result:
+            self._display.display(msg + self._dump_results(result, keep_invocation=keep_invocation), color=color)
+            return
+        self._display.display(msg + self._dump_results(truncated, keep_invocation=keep_invocation), color=color, screen_only=True)
+        if display_logger:
+            self._display.display(msg + self._dump_results(result, keep_invocation=keep_invocation), color=color, log_only=True)
+
+    def _display_diff(self, diff):
+        ''' displays the diff, truncated on the screen if it is large '''
+        if not diff:
+            return
+        truncated, cut = self._max_field_size and self._truncate(diff) or (diff, False)
+        if not cut:
+            self._display.display(diff)
+            return
+        self._display.display(truncated, screen_only=True)
+        if display_logger:
+            self._display.display(diff, log_only=True)
+
+    def _host_name(self, result):
+        delegated_vars = result._result.get('_ansible_delegated_vars', None)
+        if delegated_vars:
+            return "%s -> %s" % (result._host.get_name(), delegated_vars['ansible_host'])
+        return result._host.get_name()
+
+    def _add_outcome(self, result, status, label=u'', outcome=None):
+        ''' adds the result, or the outcome of a part of it, to the outcomes of the task '''
+        task = result._task
+        if task._uuid not in self._outcomes:
+            self._outcomes[task._uuid] = OutcomeGroups(task)
+            self._outcome_tasks.append(task._uuid)
+        self._outcomes[task._uuid].add(self._host_name(result), status, label, outcome or result._result)
+
+    def _aggregate_result(self, result, status):
+        if result._task.action in ('include', 'include_role'):
+            return
+        if result._task.loop and 'results' in result._result:
+            # NOTE: The items are added by the item callbacks.
+            self._process_items(result)
+        elif result._task.action == 'test_bundle' and 'checks' in result._result:
+            for check in result._result['checks']:
+                self._add_outcome(result, self._check_status(check['result']), u" => (check=%s)" % check['name'], check['result'])
+            del result._result['checks']
+        else:
+            self._add_outcome(result, status)
+
+    def _print_outcomes(self):
+        ''' displays the grouped results of the tasks added since the last call '''
+        for uuid in self._outcome_tasks:
+            outcomes = self._outcomes[uuid]
+            if self._last_task_banner != uuid:
+                self._print_task_banner(outcomes.task)
+
+            groups = outcomes.groups()
+            largest = {}
+            for status, label, result, hosts in groups:
+                largest[label] = max(largest.get(label, 0), len(hosts))
+
+            for status, label, result, hosts in groups:
+                name, color = self.OUTCOME_DISPLAY[status]
+                msg = u"%s: [%s]" % (name, compress_hosts(hosts))
+                if len(hosts) > 1:
+                    msg += u" (%d hosts)" % len(hosts)
+                msg += label
+                verbose = (self._display.verbosity > 0 or '_ansible_verbose_always' in result) and not '_ansible_verbose_override' in result
+                if status in ('failed', 'ignored', 'unreachable') or (verbose and len(hosts) < largest[label]):
+                    self._display_result(msg + u" => ", result, color=color, keep_invocation=True)
+                else:
+                    self._display.display(msg, color=color)
+                if status == 'ignored':
+                    self._display.display("...ignoring", color=C.COLOR_SKIP)
+                self._handle_warnings(result)
+
+        self._outcomes = {}
+        self._outcome_tasks = []
+
+    @deferred
+    def _print_banner(self, msg):
+        self._print_outcomes()
+        self._display.banner(msg)
+
+    def _task_start(self, result):
+        '''
+        Returns the time the task of the result started on its host, or None.
+        The free strategies start a task on each host separately, and only
+        test_fast tells on which host, so with free the start is unknown.
+        '''
+        key = (result._host.get_name(), result._task._uuid)
+        if key in self._host_starts:
+            return self._host_starts[key]
+        if self._play.strategy in self.FREE_STRATEGIES and result._task._uuid not in self._handler_uuids:
+            return None
+        return self._task_starts.get(result._task._uuid)
+
+    def _task_latency(self, result):
+        ''' returns the seconds from the start of the task on the host to the result '''
+        start = self._task_start(result)
+        self._host_starts.pop((result._host.get_name(), result._task._uuid), None)
+        if start is None:
+            return None
+        return time.time() - start
+
+    def _has_profile(self, result):
+        if '_profile' in result._result:
+            return True
+        return result._task.action == 'test_bundle' and any('_profile' in c.get('result', {}) for c in result._result.get('checks') or [])
+
+    def _save_profiles(self, result):
+        ''' saves the profiles in the result and removes them from it '''
+        host = result._host.get_name()
+        task = result._task.get_name().strip()
+        if '_profile' in result._result:
+            check = '_ansible_item_result' in result._result and u"item=%s" % self._get_item(result._result) or None
+            self._save_profile(host, task, result._task.action, check, result._result.pop('_profile'))
+        if result._task.action == 'test_bundle':
+            for check in result._result.get('checks') or []:
+                if '_profile' in check.get('result', {}):
+                    self._save_profile(host, task, check['module'], check['name'], check['result'].pop('_profile'))
+
+    def _save_profile(self, host, task, module, check, profile):
+        name = check is None and task or u'%s-%s' % (task, check)
+        directory = os.path.join(self._profile_dir, self.PROFILE_NAME_RE.sub(u'_', host))
+        path = os.path.join(directory, self.PROFILE_NAME_RE.sub(u'_', name)[:100])
+        b_path = to_bytes(path, errors='surrogate_or_strict')
+        try:
+            if not os.path.isdir(to_bytes(directory, errors='surrogate_or_strict')):
+                os.makedirs(to_bytes(directory, errors='surrogate_or_strict'))
+            stats = profile.pop('stats', None)
+            if stats:
+                with open(b_path + b'.prof', 'wb') as f:
+                    f.write(base64.b64decode(stats))
+            with open(b_path + b'.json', 'wb') as f:
+                f.write(to_bytes(json.dumps(dict(host=host, task=task, module=module, check=check, profile=profile),
+                                            indent=4, sort_keys=True)))
+        except (IOError, OSError) as e:
+            self._display.warning(u"could not save the profile to %s: %s" % (path, e))
+            return
+        self._display.vv(u"profile of %s saved to %s.json" % (name, path))
+
+    def _copy_result(self, result):
+        '''
+        Returns a copy of the result for the display writer, which removes the
+        checks, the items and the profiles from it while the strategy and the
+        other callbacks may still use the result.
+        '''
+        copy = TaskResult(result._host, result._task, result._result)
+        if result._task.action == 'test_bundle' and copy._result.get('checks'):
+            copy._result['checks'] = [dict(check, result=dict(check.get('result') or {})) for check in copy._result['checks']]
+        return copy
+
+    def _record_result(self, result, status):
+        if self._has_profile(result):
+            self._writer.put(self._save_profiles, result)
+        latency = self._task_latency(result)
+        module = result._task.action
+        # NOTE: The items of a loop are written by _trace_item.
+        if self._sinks and module not in ('include', 'include_role') and not (result._task.loop and 'results' in result._result):
+            self._writer.put(self._write_records, self._play.get_name().strip(), result, status, time.time(), latency)
+        if latency is None:
+            return
+
+        host = result._host.get_name()
+        name = result._task.get_name().strip()
+        if self._trace:
+            category = result._task._uuid in self._handler_uuids and 'handler' or 'task'
+            self._trace.slice(host, name, category, time.time() - latency, latency, dict(module=module, status=status))
+
+        if status == 'skipped' or module in ('include', 'include_role'):
+            return
+
+        for stats, key in ((self._module_latency, module), (self._host_latency, host)):
+            if key not in stats:
+                stats[key] = LatencyHistogram()
+            stats[key].add(latency)
+
+        # NOTE: Keep only the slowest checks in a min-heap.
+        check = (latency, host, name)
+        if len(self._slowest_checks) < self.SLOWEST_CHECKS:
+            heapq.heappush(self._slowest_checks, check)
+        else:
+            heapq.heappushpop(self._slowest_checks, check)
+
+    def _trace_item(self, result, status):
+        if '_profile' in result._result:
+            self._writer.put(self._save_profiles, result)
+        # NOTE: An item starts at the end of the previous item of the task on
+        # the host, or at the start of the task on the host for the first item.
+        if not self._trace and not self._sinks:
+            return
+        host = result._host.get_name()
+        key = (host, result._task._uuid)
+        start = self._task_start(result)
+        if start is not None and key not in self._item_ends:
+            self._item_ends[key] = start
+        start = self._item_ends.get(key)
+        now = time.time()
+        if self._sinks and result._task.action not in ('include', 'include_role'):
+            self._writer.put(self._write_records, self._play.get_name().strip(), result, status, now,
+                             start is not None and now - start or None, u"item=%s" % self._get_item(result._result))
+        if start is None:
+            return
+        if self._trace:
+            self._trace.slice(host, u"%s (item=%s)" % (result._task.get_name().strip(), self._get_item(result._result)),
+                              'item', start, now - start, dict(module=result._task.action, status=status))
+        self._item_ends[key] = now
+
+    def _check_status(self, check_result):
+        if check_result.get('failed', False):
+            return 'failed'
+        elif check_result.get('changed', False):
+            return 'changed'
+        elif check_result.get('skipped', False):
+            return 'skipped'
+        return 'ok'
+
+    def _check_duration(self, check_result, duration):
+        ''' returns the duration of a check of test_bundle, the sum of its spans, or the duration of the task '''
+        timing = check_result.get('_timing')
+        if timing is None:
+            return duration
+        return sum(span.get('wall', 0) for span in timing)
+
+    def _make_record(self, play, host, task, module, check, status, result, end, duration):
+        if result.get('_ansible_no_log', False):
+            expected = actual = "the output has been hidden due to the fact that 'no_log: true' was specified for this result"
+        else:
+            actual = strip_internal_keys(result)
+            expected = (actual.pop('invocation', None) or {}).get('module_args')
+        return dict(
+            play=play,
+            host=host,
+            task=task,
+            module=module,
+            check=check,
+            status=status,
+            changed=bool(result.get('changed', False)),
+            failed=bool(result.get('failed', False)),
+            start=duration is not None and end - duration or None,
+            duration=duration,
+            expected=expected,
+            actual=actual,
+            msg=result.get('msg'),
+        )
+
+    def _write_records(self, play, result, status, end, duration, check=None):
+        ''' writes the records of a result to the sinks, a record for each check of test_bundle '''
+        host = result._host.get_name()
+        task = result._task.get_name().strip()
+        if result._task.action == 'test_bundle' and 'checks' in result._result:
+            # NOTE: The checks run concurrently, so the duration of a check is
+            # the time of its commands and file reads. The test_bundle action
+            # plugin orders the checks by these durations.
+            records = [self._make_record(play, host, task, c['module'], c['name'], self._check_status(c['result']), c['result'],
+                                         end, self._check_duration(c['result'], duration))
+                       for c in result._result['checks']]
+        else:
+            records = [self._make_record(play, host, task, result._task.action, check, status, result._result, end, duration)]
+        for record in records:
+            for sink in self._sinks:
+                sink.write(record)
+
+    # NOTE: The timing of the results is recorded in the main thread, and
+    # the output is rendered and written in the display writer thread, which
+    # gets a copy of each result (see _copy_result).
+
     def v2_runner_on_failed(self, result, ignore_errors=False):
+        result = self._copy_result(result)
+        self._record_result(result, 'failed')
+        self._runner_on_failed(result, ignore_errors)
 
-        if self._play.strategy == 'free' and self._last_task_banner != result._task._uuid:
+    @deferred
+    def _runner_on_failed(self, result, ignore_errors):
+
+        if self._aggregate:
+            self._aggregate_result(result, ignore_errors and 'ignored' or 'failed')
+            return
+
+        if self._play.strategy in self.FREE_STRATEGIES and self._last_task_banner != result._task._uuid:
             self._print_task_banner(result._task)
 
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
@@ -59,21 +825,34 @@ class CallbackModule(CallbackBase):
         if result._task.loop and 'results' in result._result:
             self._process_items(result)
 
+        elif result._task.action == 'test_bundle' and 'checks' in result._result:
+            self._process_checks(result)
+
         else:
             if delegated_vars:
-                self._display.display("fatal: [%s -> %s]: FAILED! => %s" % (result._host.get_name(), delegated_vars['ansible_host'], self._dump_results(result._result)), color=C.COLOR_ERROR)
+                self._display_result("fatal: [%s -> %s]: FAILED! => " % (result._host.get_name(), delegated_vars['ansible_host']), result._result, color=C.COLOR_ERROR)
             else:
-                self._display.display("fatal: [%s]: FAILED! => %s" % (result._host.get_name(), self._dump_results(result._result)), color=C.COLOR_ERROR)
+                self._display_result("fatal: [%s]: FAILED! => " % result._host.get_name(), result._result, color=C.COLOR_ERROR)
 
         if ignore_errors:
             self._display.display("...ignoring", color=C.COLOR_SKIP)
 
     def v2_runner_on_ok(self, result):
+        result = self._copy_result(result)
+        if result._task.action == 'test_sample':
+            self._sample = result._result.get('sample')
+        self._record_result(result, result._result.get('changed', False) and 'changed' or 'ok')
+        self._runner_on_ok(result)
 
-        if self._play.strategy == 'free' and self._last_task_banner != result._task._uuid:
-            self._print_task_banner(result._task)
+    @deferred
+    def _runner_on_ok(self, result):
 
-        self._clean_results(result._result, result._task.action)
+        if self._aggregate:
+            self._aggregate_result(result, result._result.get('changed', False) and 'changed' or 'ok')
+            return
+
+        if self._play.strategy in self.FREE_STRATEGIES and self._last_task_banner != result._task._uuid:
+            self._print_task_banner(result._task)
 
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
         self._clean_results(result._result, result._task.action)
@@ -94,17 +873,28 @@ class CallbackModule(CallbackBase):
 
         if result._task.loop and 'results' in result._result:
             self._process_items(result)
+        elif result._task.action == 'test_bundle' and 'checks' in result._result:
+            self._process_checks(result)
         else:
 
             if (self._display.verbosity > 0 or '_ansible_verbose_always' in result._result) and not '_ansible_verbose_override' in result._result:
-                msg += " => %s" % (self._dump_results(result._result, keep_invocation=True),)
-            self._display.display(msg, color=color)
+                self._display_result(msg + " => ", result._result, color=color, keep_invocation=True)
+            else:
+                self._display.display(msg, color=color)
 
         self._handle_warnings(result._result)
 
     def v2_runner_on_skipped(self, result):
-        if C.DISPLAY_SKIPPED_HOSTS:
-            if self._play.strategy == 'free' and self._last_task_banner != result._task._uuid:
+        result = self._copy_result(result)
+        self._record_result(result, 'skipped')
+        self._runner_on_skipped(result)
+
+    @deferred
+    def _runner_on_skipped(self, result):
+        if C.DISPLAY_SKIPPED_HOSTS and self._aggregate:
+            self._aggregate_result(result, 'skipped')
+        elif C.DISPLAY_SKIPPED_HOSTS:
+            if self._play.strategy in self.FREE_STRATEGIES and self._last_task_banner != result._task._uuid:
                 self._print_task_banner(result._task)
 
             if result._task.loop and 'results' in result._result:
@@ -112,29 +902,52 @@ class CallbackModule(CallbackBase):
             else:
                 msg = "skipping: [%s]" % result._host.get_name()
                 if (self._display.verbosity > 0 or '_ansible_verbose_always' in result._result) and not '_ansible_verbose_override' in result._result:
-                    msg += " => %s" % self._dump_results(result._result)
-                self._display.display(msg, color=C.COLOR_SKIP)
+                    self._display_result(msg + " => ", result._result, color=C.COLOR_SKIP)
+                else:
+                    self._display.display(msg, color=C.COLOR_SKIP)
 
     def v2_runner_on_unreachable(self, result):
-        if self._play.strategy == 'free' and self._last_task_banner != result._task._uuid:
+        result = self._copy_result(result)
+        self._record_result(result, 'unreachable')
+        self._runner_on_unreachable(result)
+
+    @deferred
+    def _runner_on_unreachable(self, result):
+        if self._aggregate:
+            self._aggregate_result(result, 'unreachable')
+            return
+
+        if self._play.strategy in self.FREE_STRATEGIES and self._last_task_banner != result._task._uuid:
             self._print_task_banner(result._task)
 
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
         if delegated_vars:
-            self._display.display("fatal: [%s -> %s]: UNREACHABLE! => %s" % (result._host.get_name(), delegated_vars['ansible_host'], self._dump_results(result._result)), color=C.COLOR_UNREACHABLE)
+            self._display_result("fatal: [%s -> %s]: UNREACHABLE! => " % (result._host.get_name(), delegated_vars['ansible_host']), result._result, color=C.COLOR_UNREACHABLE)
         else:
-            self._display.display("fatal: [%s]: UNREACHABLE! => %s" % (result._host.get_name(), self._dump_results(result._result)), color=C.COLOR_UNREACHABLE)
+            self._display_result("fatal: [%s]: UNREACHABLE! => " % result._host.get_name(), result._result, color=C.COLOR_UNREACHABLE)
 
+    @deferred
     def v2_playbook_on_no_hosts_matched(self):
         self._display.display("skipping: no hosts matched", color=C.COLOR_SKIP)
 
+    @deferred
     def v2_playbook_on_no_hosts_remaining(self):
+        self._print_outcomes()
         self._display.banner("NO MORE HOSTS LEFT")
 
     def v2_playbook_on_task_start(self, task, is_conditional):
 
-        if self._play.strategy != 'free':
-            self._print_task_banner(task)
+        self._task_starts[task._uuid] = time.time()
+
+        if self._play.strategy not in self.FREE_STRATEGIES:
+            self._writer.put(self._print_task_start, task)
+
+    def v2_runner_on_start(self, host, task):
+        self._host_starts[(host.get_name(), task._uuid)] = time.time()
+
+    def _print_task_start(self, task):
+        self._print_outcomes()
+        self._print_task_banner(task)
 
     def _print_task_banner(self, task):
         # args can be specified as no_log in several places: in the task or in
@@ -158,11 +971,15 @@ class CallbackModule(CallbackBase):
 
         self._last_task_banner = task._uuid
 
+    @deferred
     def v2_playbook_on_cleanup_task_start(self, task):
+        self._print_outcomes()
         self._display.banner("CLEANUP TASK [%s]" % task.get_name().strip())
 
     def v2_playbook_on_handler_task_start(self, task):
-        self._display.banner("RUNNING HANDLER [%s]" % task.get_name().strip())
+        self._task_starts[task._uuid] = time.time()
+        self._handler_uuids.add(task._uuid)
+        self._print_banner("RUNNING HANDLER [%s]" % task.get_name().strip())
 
     def v2_playbook_on_play_start(self, play):
         name = play.get_name().strip()
@@ -172,25 +989,37 @@ class CallbackModule(CallbackBase):
             msg = u"PLAY [%s]" % name
 
         self._play = play
+        # NOTE: The last item of a task may come after the result of the task,
+        # so the end times of the items are kept until the end of the play.
+        self._item_ends = {}
 
-        self._display.banner(msg)
+        if self._history:
+            self._writer.put(self._history.commit)
+        self._print_banner(msg)
 
+    @deferred
     def v2_on_file_diff(self, result):
         if result._task.loop and 'results' in result._result:
             for res in result._result['results']:
                 if 'diff' in res and res['diff'] and res.get('changed', False):
-                    diff = self._get_diff(res['diff'])
-                    if diff:
-                        self._display.display(diff)
+                    self._display_diff(self._get_diff(res['diff']))
         elif 'diff' in result._result and result._result['diff'] and result._result.get('changed', False):
-            diff = self._get_diff(result._result['diff'])
-            if diff:
-                self._display.display(diff)
+            self._display_diff(self._get_diff(result._result['diff']))
 
     def v2_runner_item_on_ok(self, result):
+        result = self._copy_result(result)
+        self._trace_item(result, result._result.get('changed', False) and 'changed' or 'ok')
+        self._runner_item_on_ok(result)
+
+    @deferred
+    def _runner_item_on_ok(self, result):
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
         if result._task.action in ('include', 'include_role'):
             return
+        elif self._aggregate:
+            self._add_outcome(result, result._result.get('changed', False) and 'changed' or 'ok',
+                              u" => (item=%s)" % self._get_item(result._result))
+            return
         elif result._result.get('changed', False):
             msg = 'changed'
             color = C.COLOR_CHANGED
@@ -206,10 +1035,21 @@ class CallbackModule(CallbackBase):
         msg += " => (item=%s)" % (self._get_item(result._result),)
 
         if (self._display.verbosity > 0 or '_ansible_verbose_always' in result._result) and not '_ansible_verbose_override' in result._result:
-            msg += " => %s" % self._dump_results(result._result, keep_invocation=True)
-        self._display.display(msg, color=color)
+            self._display_result(msg + " => ", result._result, color=color, keep_invocation=True)
+        else:
+            self._display.display(msg, color=color)
 
     def v2_runner_item_on_failed(self, result):
+        result = self._copy_result(result)
+        self._trace_item(result, 'failed')
+        self._runner_item_on_failed(result)
+
+    @deferred
+    def _runner_item_on_failed(self, result):
+        if self._aggregate:
+            self._add_outcome(result, 'failed', u" => (item=%s)" % self._get_item(result._result))
+            return
+
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
         if 'exception' in result._result:
             if self._display.verbosity < 3:
@@ -227,24 +1067,74 @@ class CallbackModule(CallbackBase):
         else:
             msg += "[%s]" % (result._host.get_name())
 
-        self._display.display(msg + " (item=%s) => %s" % (self._get_item(result._result), self._dump_results(result._result)), color=C.COLOR_ERROR)
+        self._display_result(msg + " (item=%s) => " % self._get_item(result._result), result._result, color=C.COLOR_ERROR)
         self._handle_warnings(result._result)
 
+    def _process_checks(self, result):
+        # NOTE: Display each check of test_bundle like a separate test result.
+        delegated_vars = result._result.get('_ansible_delegated_vars', None)
+        if delegated_vars:
+            host = "%s -> %s" % (result._host.get_name(), delegated_vars['ansible_host'])
+        else:
+            host = result._host.get_name()
+
+        for check in result._result['checks']:
+            check_result = check['result']
+            if check_result.get('failed', False):
+                if 'exception' in check_result:
+                    error = check_result['exception'].strip().split('\n')[-1]
+                    self._display.display("An exception occurred during check execution. The error was: %s" % error, color=C.COLOR_ERROR)
+                self._display_result("failed: [%s] (check=%s) => " % (host, check['name']), check_result, color=C.COLOR_ERROR)
+            else:
+                if check_result.get('changed', False):
+                    msg = "changed: [%s] => (check=%s)" % (host, check['name'])
+                    color = C.COLOR_CHANGED
+                elif check_result.get('skipped', False):
+                    msg = "skipping: [%s] => (check=%s)" % (host, check['name'])
+                    color = C.COLOR_SKIP
+                else:
+                    msg = "ok: [%s] => (check=%s)" % (host, check['name'])
+                    color = C.COLOR_OK
+                if (self._display.verbosity > 0 or '_ansible_verbose_always' in check_result) and not '_ansible_verbose_override' in check_result:
+                    self._display_result(msg + " => ", check_result, color=color, keep_invocation=True)
+                else:
+                    self._display.display(msg, color=color)
+            self._handle_warnings(check_result)
+
+        # just remove them as now they are displayed individually
+        del result._result['checks']
+
     def v2_runner_item_on_skipped(self, result):
-        if C.DISPLAY_SKIPPED_HOSTS:
+        result = self._copy_result(result)
+        self._trace_item(result, 'skipped')
+        self._runner_item_on_skipped(result)
+
+    @deferred
+    def _runner_item_on_skipped(self, result):
+        if C.DISPLAY_SKIPPED_HOSTS and self._aggregate:
+            self._add_outcome(result, 'skipped', u" => (item=%s)" % self._get_item(result._result))
+        elif C.DISPLAY_SKIPPED_HOSTS:
             msg = "skipping: [%s] => (item=%s) " % (result._host.get_name(), self._get_item(result._result))
             if (self._display.verbosity > 0 or '_ansible_verbose_always' in result._result) and not '_ansible_verbose_override' in result._result:
-                msg += " => %s" % self._dump_results(result._result)
-            self._display.display(msg, color=C.COLOR_SKIP)
+                self._display_result(msg + " => ", result._result, color=C.COLOR_SKIP)
+            else:
+                self._display.display(msg, color=C.COLOR_SKIP)
 
+    @deferred
     def v2_playbook_on_include(self, included_file):
         msg = 'included: %s for %s' % (included_file._filename, ", ".join([h.name for h in included_file._hosts]))
         self._display.display(msg, color=C.COLOR_SKIP)
 
     def v2_playbook_on_stats(self, stats):
+        self._writer.put(self._print_stats, stats)
+        self._writer.flush()
+
+    def _print_stats(self, stats):
+        self._print_outcomes()
         self._display.banner("TEST RECAP")
 
         hosts = sorted(stats.processed.keys())
+        summaries = []
         for h in hosts:
             t = stats.summarize(h)
 
@@ -252,6 +1142,21 @@ class CallbackModule(CallbackBase):
             if t['changed'] > 0 and t['failures'] == 0:
                 t['failures'] = 1
 
+            summaries.append((h, t))
+
+        if self._aggregate:
+            # NOTE: Display a line for each group of hosts with the same stats.
+            groups = {}
+            for h, t in summaries:
+                groups.setdefault((t['ok'], t['changed'], t['unreachable'], t['failures']), []).append(h)
+            summaries = []
+            for (ok, changed, unreachable, failures), names in sorted(groups.items()):
+                label = compress_hosts(names)
+                if len(names) > 1:
+                    label += u" (%d hosts)" % len(names)
+                summaries.append((label, dict(ok=ok, changed=changed, unreachable=unreachable, failures=failures)))
+
+        for h, t in summaries:
             self._display.display(u"%s : %s %s %s %s" % (
                 hostcolor(h, t),
                 colorize(u'ok', t['ok'], C.COLOR_OK),
@@ -270,9 +1175,61 @@ class CallbackModule(CallbackBase):
                 log_only=True
             )
 
+        if self._sample:
+            self._print_sample()
+
+        self._display.display("", screen_only=True)
+
+        if self._module_latency:
+            self._print_latency()
+
+        if self._trace:
+            self._trace.close()
+            self._trace = None
+
+        for sink in self._sinks:
+            sink.close()
+        self._sinks = []
+        self._history = None
+
+    def _print_sample(self):
+        sample = self._sample
+        if sample.get('strata') is None:
+            self._display.display(u"verified all %d hosts" % sample['hosts'])
+            return
+
+        self._display.display(u"verified %d of %d hosts (%.0f%%) in %d strata in run %d" % (
+            sample['sampled'], sample['hosts'], 100.0 * sample['sampled'] / max(sample['hosts'], 1), sample['strata'], sample['run']))
+        self._display.display(u"every host is verified at least once every %d runs, the least recently verified %d runs ago, %d never verified" % (
+            sample['period'], sample['max_age'], sample['never_sampled']))
+
+    def _print_latency(self):
+        self._display.banner("TEST LATENCY")
+
+        self._display.display(u"%-30s %6s %8s %8s %8s" % (u'module', u'count', u'p50', u'p95', u'max'))
+        for module in sorted(self._module_latency):
+            h = self._module_latency[module]
+            self._display.display(u"%-30s %6d %7.2fs %7.2fs %7.2fs" % (module, h.count, h.percentile(50), h.percentile(95), h.max))
+
+        self._display.display(u"")
+        self._display.display(u"slowest checks:")
+        for latency, host, name in sorted(self._slowest_checks, reverse=True):
+            self._display.display(u"%7.2fs %s %s" % (latency, host, name))
+
+        self._display.display(u"")
+        self._display.display(u"slowest hosts:")
+        hosts = sorted(self._host_latency.items(), key=lambda item: item[1].total, reverse=True)
+        for host, h in hosts[:self.SLOWEST_HOSTS]:
+            self._display.display(u"%-30s total %7.2fs p50 %7.2fs p95 %7.2fs max %7.2fs" % (host, h.total, h.percentile(50), h.percentile(95), h.max))
+
         self._display.display("", screen_only=True)
 
+    # NOTE: This is not deferred, since the task queue manager checks the
+    # argument names of this method.
     def v2_playbook_on_start(self, playbook):
+        if self._history:
+            self._writer.put(self._history.begin_run, playbook._file_name)
+
         if self._display.verbosity > 1:
             from os.path import basename
             self._display.banner("PLAYBOOK: %s" % basename(playbook._file_name))
@@ -286,6 +1243,7 @@ class CallbackModule(CallbackBase):
                     if val:
                         self._display.vvvv('%s: %s' % (option,val))
 
+    @deferred
     def v2_runner_retry(self, result):
         msg = "FAILED - RETRYING: %s (%d retries left)." % (result._task, result._result['retries'] - result._result['attempts'])
         if (self._display.verbosity > 2 or '_ansible_verbose_always' in result._result) and not '_ansible_verbose_override' in result._result:
@@ -0,0 +1,416 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# lxd_mux.py is a third party connection plugin for Ansible
+#
+# lxd_mux.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lxd_mux.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import base64
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import select
+import socket
+import subprocess
+import time
+from distutils.spawn import find_executable
+
+from ansible import constants as C
+from ansible.errors import AnsibleError, AnsibleConnectionFailure, AnsibleFileNotFound
+from ansible.module_utils._text import to_bytes, to_native, to_text
+from ansible.plugins.connection import ConnectionBase
+
+# NOTE: The shell server is started in the container with this script by
+# `python -c`. It reads requests as framed JSON from stdin, runs each of
+# them in a thread and writes the responses as framed JSON to stdout.
+# A frame is the length of the data in decimal, a newline and the data.
+# This must run on python 2.6 for CentOS 6.
+SHELL_SERVER = '''
+import base64, json, os, subprocess, sys, threading, traceback
+
+write_lock = threading.Lock()
+
+def respond(response):
+    data = json.dumps(response).encode('utf-8')
+    data = ('%d\\n' % len(data)).encode('ascii') + data
+    write_lock.acquire()
+    try:
+        while data:
+            data = data[os.write(1, data):]
+    finally:
+        write_lock.release()
+
+def handle(request):
+    response = {'id': request['id'], 'rc': 0}
+    try:
+        data = base64.b64decode(request.get('data', '').encode('ascii'))
+        if request['op'] == 'exec':
+            p = subprocess.Popen([request['executable'], '-c', request['cmd']], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+            stdout, stderr = p.communicate(data)
+            response['rc'] = p.returncode
+            response['stdout'] = base64.b64encode(stdout).decode('ascii')
+            response['stderr'] = base64.b64encode(stderr).decode('ascii')
+        elif request['op'] == 'put':
+            f = open(request['path'], 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        elif request['op'] == 'fetch':
+            f = open(request['path'], 'rb')
+            try:
+                response['data'] = base64.b64encode(f.read()).decode('ascii')
+            finally:
+                f.close()
+    except Exception:
+        response['rc'] = 1
+        response['error'] = traceback.format_exc()
+    respond(response)
+
+buf = b''
+while True:
+    chunk = os.read(0, 65536)
+    if not chunk:
+        break
+    buf += chunk
+    while b'\\n' in buf:
+        pos = buf.index(b'\\n')
+        end = pos + 1 + int(buf[:pos])
+        if len(buf) < end:
+            break
+        t = threading.Thread(target=handle, args=(json.loads(buf[pos + 1:end].decode('utf-8')),))
+        t.daemon = True
+        t.start()
+        buf = buf[end:]
+'''
+
+
+class FrameReader(object):
+    ''' splits data read from a stream into frames '''
+
+    def __init__(self):
+        self._buf = b''
+
+    def feed(self, data):
+        self._buf += data
+        frames = []
+        while True:
+            pos = self._buf.find(b'\n')
+            if pos < 0:
+                break
+            end = pos + 1 + int(self._buf[:pos])
+            if len(self._buf) < end:
+                break
+            frames.append(self._buf[pos + 1:end])
+            self._buf = self._buf[end:]
+        return frames
+
+
+def frame(data):
+    b_data = to_bytes(json.dumps(data))
+    return to_bytes('%d\n' % len(b_data)) + b_data
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def run_relay(sock_path, cmd, err_path, idle_timeout, run_pid):
+    '''
+    Runs the shell server with cmd and relays requests from the connections
+    in the worker processes, which connect to the unix domain socket at
+    sock_path, to the server. Exits when idle for idle_timeout seconds,
+    when the server exits, or when the ansible-playbook process exits.
+    '''
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(64)
+
+    with open(err_path, 'wb') as err:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=err, close_fds=True)
+    shell_in = proc.stdin.fileno()
+    shell_out = proc.stdout.fileno()
+
+    shell_reader = FrameReader()
+    clients = {}   # socket -> FrameReader
+    pending = {}   # request id -> (socket, original request id)
+    next_id = 0
+    last_active = time.time()
+    try:
+        while True:
+            readable = select.select([server, shell_out] + list(clients), [], [], 1.0)[0]
+            now = time.time()
+            if readable or pending:
+                last_active = now
+            elif now - last_active > idle_timeout:
+                break
+            try:
+                os.kill(run_pid, 0)
+            except OSError:
+                break
+
+            for r in readable:
+                if r is server:
+                    client = server.accept()[0]
+                    clients[client] = FrameReader()
+
+                elif r is shell_out:
+                    data = os.read(shell_out, 65536)
+                    if not data:
+                        return
+                    for b_response in shell_reader.feed(data):
+                        response = json.loads(to_text(b_response))
+                        client, client_id = pending.pop(response['id'], (None, None))
+                        if client in clients:
+                            response['id'] = client_id
+                            try:
+                                client.sendall(frame(response))
+                            except socket.error:
+                                pass
+
+                else:
+                    try:
+                        data = r.recv(65536)
+                    except socket.error:
+                        data = b''
+                    if not data:
+                        del clients[r]
+                        r.close()
+                        continue
+                    for b_request in clients[r].feed(data):
+                        request = json.loads(to_text(b_request))
+                        next_id += 1
+                        pending[next_id] = (r, request.get('id'))
+                        request['id'] = next_id
+                        write_all(shell_in, frame(request))
+    finally:
+        for client in clients:
+            client.close()
+        server.close()
+        try:
+            os.unlink(sock_path)
+        except OSError:
+            pass
+        proc.stdin.close()
+        proc.wait()
+
+
+class Connection(ConnectionBase):
+    '''
+    lxd based connections which keep one shell server per container.
+
+    The stock lxd connection runs `lxc exec` for each command and
+    `lxc file push` for each file. This one starts a small python server
+    in the container with one `lxc exec` on the first command, and sends
+    commands and files to it as framed JSON over its stdin and stdout.
+    Each command runs in a thread of the server, so the commands of many
+    tasks for the container are run concurrently over the same pipe.
+
+    The forked workers share the server through a local relay process
+    listening on a unix domain socket in the local temporary directory.
+    The relay and the server exit when idle for
+    ANSIBLE_LXD_MUX_IDLE_TIMEOUT seconds (default: 60) or when
+    ansible-playbook exits. The shell server runs with the
+    ansible_python_interpreter of the host (default: /usr/bin/python).
+
+    Set ansible_pipelining to true so that modules are fed over stdin
+    without temporary files. The `lxc` command is looked up in PATH, so
+    this can be tried without lxd by putting benchmarks/, which has a
+    stand-in `lxc` script running the commands locally, in front of PATH.
+    '''
+
+    transport = 'lxd_mux'
+    has_pipelining = True
+
+    def __init__(self, play_context, new_stdin, *args, **kwargs):
+        super(Connection, self).__init__(play_context, new_stdin, *args, **kwargs)
+
+        self._host = self._play_context.remote_addr
+        self._lxc_cmd = find_executable('lxc')
+        name = hashlib.sha1(to_bytes(self._host)).hexdigest()[:16]
+        self._sock_path = os.path.join(C.DEFAULT_LOCAL_TMP, 'lxd_mux-%s.sock' % name)
+        self._sock = None
+        self._reader = None
+        self._next_id = 0
+        self._python = '/usr/bin/python'
+
+        if not self._lxc_cmd:
+            raise AnsibleError("lxc command not found in PATH")
+
+        if self._play_context.remote_user is not None and self._play_context.remote_user != 'root':
+            self._display.warning('lxd does not support remote_user, using container default: root')
+
+    def set_host_overrides(self, host, hostvars=None):
+        ''' takes the python interpreter of the shell server from the host variables '''
+        self._python = (hostvars or {}).get('ansible_python_interpreter', self._python)
+
+    def _connect(self):
+        ''' connects to the relay process of the shell server, starting it if it is not running '''
+        super(Connection, self)._connect()
+
+        if not self._connected:
+            self._display.vvv(u"ESTABLISH LXD_MUX CONNECTION FOR USER: root", host=self._host)
+            self._sock = self._connect_relay(self._sock_path)
+            self._reader = FrameReader()
+            self._connected = True
+        return self
+
+    def _connect_relay(self, sock_path):
+        sock = self._try_connect(sock_path)
+        if sock is not None:
+            return sock
+
+        with open(sock_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # NOTE: Another worker may have started it while we were waiting for the lock.
+            sock = self._try_connect(sock_path)
+            if sock is not None:
+                return sock
+
+            self._start_relay(sock_path)
+            for _ in range(300):
+                sock = self._try_connect(sock_path)
+                if sock is not None:
+                    return sock
+                time.sleep(0.01)
+
+        raise AnsibleConnectionFailure("could not connect to the shell server for %s at %s" % (self._host, sock_path))
+
+    def _try_connect(self, sock_path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sock_path)
+            return sock
+        except socket.error as e:
+            sock.close()
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            return None
+
+    def _start_relay(self, sock_path):
+        idle_timeout = int(os.environ.get('ANSIBLE_LXD_MUX_IDLE_TIMEOUT', 60))
+        cmd = [self._lxc_cmd, 'exec', self._host, '--', self._python, '-c', SHELL_SERVER]
+        # NOTE: The worker processes are forked from the ansible-playbook process.
+        run_pid = os.getppid()
+
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+
+        self._display.vvv(u"START SHELL SERVER: %s" % ' '.join(cmd[:-1]), host=self._host)
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+
+        # double fork so that the relay is not a child of the worker process
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.closerange(3, 1024)
+            run_relay(sock_path, cmd, sock_path + '.err', idle_timeout, run_pid)
+        finally:
+            os._exit(0)
+
+    def _request(self, request):
+        ''' sends a request to the shell server and returns the response '''
+        self._connect()
+        self._next_id += 1
+        request['id'] = self._next_id
+        try:
+            self._sock.sendall(frame(request))
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                for b_response in self._reader.feed(data):
+                    response = json.loads(to_text(b_response))
+                    if response['id'] == request['id']:
+                        return response
+        except socket.error as e:
+            raise AnsibleConnectionFailure("lost the shell server for %s: %s" % (self._host, to_native(e)))
+
+        self.close()
+        try:
+            with open(self._sock_path + '.err', 'rb') as f:
+                stderr = to_text(f.read())
+        except (IOError, OSError):
+            stderr = u''
+        if stderr == "error: Container is not running.\n":
+            raise AnsibleConnectionFailure("container not running: %s" % self._host)
+        if stderr == "error: not found\n":
+            raise AnsibleConnectionFailure("container not found: %s" % self._host)
+        raise AnsibleConnectionFailure("the shell server for %s exited: %s" % (self._host, stderr))
+
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        ''' execute a command on the lxd host '''
+        super(Connection, self).exec_command(cmd, in_data=in_data, sudoable=sudoable)
+
+        self._display.vvv(u"EXEC {0}".format(cmd), host=self._host)
+
+        in_data = to_bytes(in_data or b'', errors='surrogate_or_strict')
+        response = self._request(dict(op='exec', executable=self._play_context.executable, cmd=cmd,
+                                      data=to_text(base64.b64encode(in_data))))
+        if 'error' in response:
+            raise AnsibleError("failed to run the command on %s: %s" % (self._host, response['error']))
+
+        stdout = to_text(base64.b64decode(response['stdout']))
+        stderr = to_text(base64.b64decode(response['stderr']))
+        return response['rc'], stdout, stderr
+
+    def put_file(self, in_path, out_path):
+        ''' put a file from local to lxd '''
+        super(Connection, self).put_file(in_path, out_path)
+
+        self._display.vvv(u"PUT {0} TO {1}".format(in_path, out_path), host=self._host)
+
+        b_in_path = to_bytes(in_path, errors='surrogate_or_strict')
+        if not os.path.isfile(b_in_path):
+            raise AnsibleFileNotFound("input path is not a file: %s" % in_path)
+
+        with open(b_in_path, 'rb') as f:
+            data = f.read()
+        response = self._request(dict(op='put', path=out_path, data=to_text(base64.b64encode(data))))
+        if 'error' in response:
+            raise AnsibleError("failed to transfer file to %s: %s" % (out_path, response['error']))
+
+    def fetch_file(self, in_path, out_path):
+        ''' fetch a file from lxd to local '''
+        super(Connection, self).fetch_file(in_path, out_path)
+
+        self._display.vvv(u"FETCH {0} TO {1}".format(in_path, out_path), host=self._host)
+
+        response = self._request(dict(op='fetch', path=in_path))
+        if 'error' in response:
+            raise AnsibleError("failed to fetch file %s: %s" % (in_path, response['error']))
+
+        with open(to_bytes(out_path, errors='surrogate_or_strict'), 'wb') as f:
+            f.write(base64.b64decode(response['data']))
+
+    def close(self):
+        ''' close the connection to the relay (the shell server is kept) '''
+        super(Connection, self).close()
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._connected = False
@@ -0,0 +1,955 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: test_bundle
+short_description: Run many checks on a remote node in one module execution.
+description:
+     - Runs the main() of the test modules like test_rpm, test_ps, test_pidfile,
+       test_command, test_service and test_systemd in one interpreter,
+       independent checks in parallel threads.
+     - The result of each check has the C(_timing) key, the list of the spans of
+       the commands the check ran and the files it read, with the wall time in
+       seconds, the number of bytes read, and the rc of the commands.
+     - This module is called from the test_bundle action plugin, which builds
+       the list of checks from the task arguments and adds the source of the
+       test modules.
+options:
+  checks:
+    description:
+      - the list of checks. Each check is a dictionary with the C(name) of the check,
+        the C(module) name and the C(args) for the module.
+      - A check may have C(depends_on), the list of the names of the checks which must
+        run before it, and C(priority), a number. Of the checks whose prerequisites are
+        done, the one with the lowest priority runs first.
+    required: true
+  sources:
+    description:
+      - the dictionary of the module names to the source of the modules.
+    required: true
+  workers:
+    description:
+      - the maximum number of checks which are run concurrently.
+    required: false
+    default: 8
+  profile:
+    description:
+      - if this is more than 0, the main() of each check is run with cProfile and the
+        result of the check has the C(_profile) key with this number of the functions
+        with the largest cumulative time.
+    required: false
+    default: 0
+  profile_stats:
+    description:
+      - if this is true, C(_profile) also has C(stats), the base64 encoded marshal data
+        of the profile which pstats can load (with the same python version as the
+        remote node).
+    required: false
+    default: false
+  cache:
+    description:
+      - the directory of the last results of the checks on the remote node. If this is
+        set, a check of test_rpm, test_service or test_systemd whose inputs are unchanged
+        since its last run returns its last result with C(cached) true instead of running.
+        See the note below for the inputs.
+    required: false
+    default: null
+  cache_max_age:
+    description:
+      - the maximum age in seconds of a cached result which is returned. 0 means no limit.
+    required: false
+    default: 0
+  fail_fast:
+    description:
+      - if this is true, a check whose prerequisite in C(depends_on) failed, changed
+        or was skipped is skipped.
+    required: false
+    default: false
+note:
+    - A test_command check with C(chdir) is run after the other checks, one at a time.
+    - When the test_agent variable is true for a host with the lxd connection, this
+      file is also run as a long lived check agent in the container.
+      See README.md
+    - The C(changed) value in result is true if one or more checks are changed.
+    - The inputs of the checks for the C(cache) are the status (inode, size and
+      mtime) of the rpm database for test_rpm; the init script, the rc directories
+      and, for C(state), the lock file, the pid file and whether its process is alive
+      for test_service; the unit file, its drop-in directory, the wants directories
+      and, for C(state), the output of systemctl is-active for test_systemd.
+      The source of the module and the boot id are inputs of every check.
+      The other checks, like test_ps and test_pidfile, always run, and so does a
+      check with C(profile), C(user=yes) of test_systemd, or which failed last time.
+author:
+    - Hiroaki Nakamura
+'''
+
+EXAMPLES = '''
+# The test_bundle action plugin converts checks written like tasks to
+# the name, module and args dictionaries for this module.
+- test_bundle:
+    checks:
+      - name: Check nginx version
+        test_rpm: name=nginx state=present
+      - name: Check nginx process
+        test_ps: name=nginx state=present match_full=True
+      - name: Check nginx service state and enabled
+        test_service: name=nginx state=started enabled=True
+'''
+
+import base64
+import cProfile
+import hashlib
+import json
+import marshal
+import os
+import pstats
+import select
+import subprocess
+import threading
+import time
+import traceback
+
+from ansible.module_utils.basic import AnsibleModule, json_dict_bytes_to_unicode, remove_values
+# NOTE: The test modules are run in this interpreter, so import the module_utils
+# they use here too. Otherwise they are not included in the module payload.
+from ansible.module_utils._text import to_bytes, to_native
+from ansible.module_utils.six import b
+
+
+class CheckExit(Exception):
+    '''
+    Raised instead of printing the result and calling sys.exit()
+    when a test module running in this interpreter exits.
+    '''
+
+    def __init__(self, result):
+        super(CheckExit, self).__init__()
+        self.result = result
+
+
+class CheckModule(AnsibleModule):
+    '''
+    AnsibleModule for a test module running in this interpreter. The parameters
+    are given to the constructor instead of being read from stdin, and
+    exit_json and fail_json raise CheckExit.
+
+    The commands run with run_command are recorded in the spans of the check,
+    which are added to the result as _timing.
+    '''
+
+    def __init__(self, name, params, spans, argument_spec, **kwargs):
+        self._check_name = name
+        self._check_params = params
+        self._spans = spans
+        super(CheckModule, self).__init__(argument_spec, **kwargs)
+
+    def run_command(self, args, **kwargs):
+        start = time.time()
+        rc, out, err = super(CheckModule, self).run_command(args, **kwargs)
+        if not isinstance(args, (list, tuple)):
+            args = [args]
+        self._spans.append({
+            'cmd': ' '.join(to_native(a) for a in args),
+            'wall': round(time.time() - start, 6),
+            'bytes': len(out or '') + len(err or ''),
+            'rc': rc,
+        })
+        return rc, out, err
+
+    def _load_params(self):
+        self.params = dict(self._check_params)
+        self.params['_ansible_module_name'] = self._check_name
+
+    def exit_json(self, **kwargs):
+        if not 'changed' in kwargs:
+            kwargs['changed'] = False
+        self._exit_check(kwargs)
+
+    def fail_json(self, **kwargs):
+        assert 'msg' in kwargs, "implementation error -- msg to explain the error is required"
+        kwargs['failed'] = True
+        self._exit_check(kwargs)
+
+    def _exit_check(self, kwargs):
+        self.add_path_info(kwargs)
+        if 'invocation' not in kwargs:
+            kwargs['invocation'] = {'module_args': self.params}
+        kwargs['_timing'] = self._spans
+        raise CheckExit(remove_values(kwargs, self.no_log_values))
+
+
+class TimedFile(object):
+    ''' a file whose reads are recorded in the spans of the check '''
+
+    def __init__(self, f, path, spans):
+        self._file = f
+        self._path = path
+        self._spans = spans
+
+    def read(self, *args):
+        return self._timed(self._file.read, args, len)
+
+    def readline(self, *args):
+        return self._timed(self._file.readline, args, len)
+
+    def readlines(self, *args):
+        return self._timed(self._file.readlines, args, lambda lines: sum(len(line) for line in lines))
+
+    def _timed(self, func, args, size):
+        start = time.time()
+        data = func(*args)
+        self._spans.append({
+            'read': self._path,
+            'wall': round(time.time() - start, 6),
+            'bytes': size(data),
+        })
+        return data
+
+    def __iter__(self):
+        # NOTE: One span records the time spent in reading the lines, and is
+        # updated for each line as the caller may stop before the end.
+        span = {'read': self._path, 'wall': 0.0, 'bytes': 0}
+        self._spans.append(span)
+        lines = iter(self._file)
+        wall = 0.0
+        while True:
+            start = time.time()
+            try:
+                line = next(lines)
+            except StopIteration:
+                span['wall'] = round(wall + time.time() - start, 6)
+                return
+            wall += time.time() - start
+            span['wall'] = round(wall, 6)
+            span['bytes'] += len(line)
+            yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+# The test module which the current thread is running.
+_current_check = threading.local()
+
+def _check_module(argument_spec, **kwargs):
+    # NOTE: This replaces AnsibleModule in the namespace of the test modules.
+    return CheckModule(_current_check.name, _current_check.params, _current_check.spans, argument_spec, **kwargs)
+
+def _check_open(path, mode='r', *args, **kwargs):
+    # NOTE: This replaces open in the namespace of the test modules.
+    f = open(path, mode, *args, **kwargs)
+    if 'r' not in mode or '+' in mode:
+        return f
+    return TimedFile(f, path, _current_check.spans)
+
+
+class CheckLoader(object):
+    '''
+    Loads the test modules from their source once, and runs their main()
+    with the parameters of each check.
+    '''
+
+    def __init__(self):
+        self._modules = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def loaded(self, name):
+        return name in self._modules
+
+    def digest(self, name):
+        ''' returns the SHA1 digest of the source of a loaded module '''
+        return self._digests[name]
+
+    def namespace(self, name):
+        ''' returns the namespace of a loaded module '''
+        return self._modules[name]
+
+    def load(self, name, source):
+        ''' loads a module, again if its source is changed, and returns its namespace '''
+        digest = hashlib.sha1(to_bytes(source)).hexdigest()
+        self._lock.acquire()
+        try:
+            if self._digests.get(name) != digest:
+                namespace = {'__name__': name, '__file__': '%s.py' % name}
+                # NOTE: compile() rejects a unicode source with a coding declaration.
+                exec(compile(to_bytes(source), '%s.py' % name, 'exec'), namespace)
+                namespace['AnsibleModule'] = _check_module
+                namespace['open'] = _check_open
+                self._modules[name] = namespace
+                self._digests[name] = digest
+            return self._modules[name]
+        finally:
+            self._lock.release()
+
+    def run(self, name, params, profile=0, profile_stats=False):
+        ''' runs a test module and returns its result, with the profile of the top profile functions if profile > 0 '''
+        if not profile:
+            return self._run(name, params)
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        result = profiler.runcall(self._run, name, params)
+        elapsed = time.time() - start
+        result = dict(result)
+        result['_profile'] = profile_summary(profiler, profile, profile_stats)
+        result['_profile']['elapsed'] = elapsed
+        return result
+
+    def _run(self, name, params):
+        try:
+            namespace = self._modules[name]
+            _current_check.name = name
+            _current_check.params = params
+            _current_check.spans = []
+            namespace['main']()
+        except CheckExit as e:
+            return e.result
+        except SystemExit as e:
+            return {'failed': True, 'msg': 'check %s exited with %s' % (name, e)}
+        except Exception as e:
+            return {'failed': True, 'msg': 'check %s raised %s: %s' % (name, type(e).__name__, to_native(e)),
+                    'exception': traceback.format_exc()}
+        return {'failed': True, 'msg': 'check %s returned without a result' % name}
+
+
+def profile_summary(profiler, top, with_stats=False):
+    '''
+    Returns the top functions of the profile by cumulative time, and the
+    marshal data of the profile which pstats can load if with_stats is true.
+    '''
+    stats = pstats.Stats(profiler)
+    functions = []
+    for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+        functions.append({
+            'function': '%s:%d(%s)' % (filename, line, func),
+            'calls': nc,
+            'primitive_calls': cc,
+            'tottime': tt,
+            'cumtime': ct,
+        })
+    functions.sort(key=lambda f: f['cumtime'], reverse=True)
+    summary = {'total_time': stats.total_tt, 'functions': functions[:top]}
+    if with_stats:
+        summary['stats'] = base64.b64encode(marshal.dumps(stats.stats)).decode('ascii')
+    return summary
+
+
+def _path_state(path):
+    ''' returns the status of a path which changes when it is modified, or None if it does not exist '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [path, st.st_ino, st.st_size, st.st_mtime]
+
+
+def _read_file(path):
+    try:
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+
+def _command_output(args):
+    ''' returns the stripped output of a command, or None if it can not be run '''
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    except OSError:
+        return None
+    return to_native(p.communicate()[0]).strip()
+
+
+def _rpm_inputs(params):
+    return [_path_state('/var/lib/rpm/Packages'), _path_state('/var/lib/rpm/rpmdb.sqlite')]
+
+
+def _service_inputs(params):
+    name = params.get('name') or ''
+    inputs = [_path_state('/etc/init.d/%s' % name)]
+    for level in range(7):
+        inputs.append(_path_state('/etc/rc.d/rc%d.d' % level))
+        inputs.append(_path_state('/etc/rc%d.d' % level))
+    if params.get('state'):
+        pid = (_read_file('/var/run/%s.pid' % name) or '').strip()
+        inputs.append(_path_state('/var/lock/subsys/%s' % name))
+        inputs.append(_path_state('/var/run/%s.pid' % name))
+        inputs.append(pid.isdigit() and os.path.exists('/proc/%s' % pid))
+    return inputs
+
+
+def _systemd_inputs(params):
+    if params.get('user'):
+        return None
+    unit = params.get('name') or ''
+    if '.' not in unit:
+        unit += '.service'
+    inputs = []
+    for unit_dir in ('/etc/systemd/system', '/run/systemd/system', '/usr/lib/systemd/system', '/lib/systemd/system'):
+        inputs.append(_path_state('%s/%s' % (unit_dir, unit)))
+        inputs.append(_path_state('%s/%s.d' % (unit_dir, unit)))
+    inputs.append(_path_state('/etc/systemd/system'))
+    try:
+        for entry in sorted(os.listdir('/etc/systemd/system')):
+            if entry.endswith(('.wants', '.requires')):
+                inputs.append(_path_state('/etc/systemd/system/%s' % entry))
+    except OSError:
+        pass
+    if params.get('state'):
+        # NOTE: A oneshot unit with RemainAfterExit, like iptables.service,
+        # has no processes while it is active, so ask systemd for its state.
+        active = _command_output(['systemctl', 'is-active', unit])
+        if not active:
+            return None
+        inputs.append(active)
+    return inputs
+
+
+# The functions which return the inputs of the checks of the modules, whose
+# results are cached while the inputs are unchanged, or None if the check
+# must run. The checks of the other modules always run.
+CHECK_INPUTS = {
+    'test_rpm': _rpm_inputs,
+    'test_service': _service_inputs,
+    'test_systemd': _systemd_inputs,
+}
+
+
+class ResultCache(object):
+    '''
+    The last results of the checks on this host for the incremental mode.
+    Each result is a JSON file in the directory, named by the digest of the
+    module and the arguments of the check, with the fingerprint of the inputs
+    of the check when it ran.
+    '''
+
+    def __init__(self, path, max_age=0):
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+
+    def fingerprint(self, loader, name, params):
+        ''' returns the fingerprint of the inputs of a check, or None if the check must run '''
+        inputs = CHECK_INPUTS.get(name)
+        if inputs is None:
+            return None
+        values = inputs(params)
+        if values is None:
+            return None
+        boot_id = (_read_file('/proc/sys/kernel/random/boot_id') or '').strip()
+        return hashlib.sha1(to_bytes(json.dumps([loader.digest(name), boot_id, values]))).hexdigest()
+
+    def _file(self, name, params):
+        args = dict((k, v) for k, v in params.items() if not k.startswith('_ansible_'))
+        key = hashlib.sha1(to_bytes(json.dumps([name, args], sort_keys=True))).hexdigest()
+        return os.path.join(self.path, '%s.json' % key)
+
+    def get(self, name, params, fingerprint):
+        ''' returns the cached result of a check with the fingerprint, or None '''
+        data = _read_file(self._file(name, params))
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+        except ValueError:
+            return None
+        if entry.get('fingerprint') != fingerprint:
+            return None
+        if self.max_age and time.time() - entry.get('time', 0) > self.max_age:
+            return None
+        result = entry['result']
+        result['cached'] = True
+        result['_timing'] = []
+        return result
+
+    def put(self, name, params, fingerprint, result):
+        ''' saves the result of a check, ignoring errors as the cache is only an optimization '''
+        path = self._file(name, params)
+        tmp_path = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        result = dict((k, v) for k, v in result.items() if k != '_timing')
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            f = open(tmp_path, 'w')
+            try:
+                json.dump({'fingerprint': fingerprint, 'time': time.time(), 'result': result}, f)
+            finally:
+                f.close()
+            # NOTE: The checks of the same host may run in many processes at once.
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def run_check(loader, cache, name, params, profile=0, profile_stats=False):
+    ''' runs a check, or returns its cached result if the cache is given and its inputs are unchanged '''
+    fingerprint = None
+    if cache is not None:
+        try:
+            fingerprint = cache.fingerprint(loader, name, params)
+        except Exception:
+            fingerprint = None
+        if fingerprint is not None:
+            result = cache.get(name, params, fingerprint)
+            if result is not None:
+                return result
+
+    result = loader.run(name, params, profile, profile_stats)
+    if fingerprint is not None and not result.get('failed', False):
+        cache.put(name, params, fingerprint, result)
+    return result
+
+
+def is_independent(check):
+    '''
+    Returns whether a check can run concurrently with other checks.
+    A command with chdir changes the working directory of the whole process.
+    '''
+    return not (check['module'] == 'test_command' and (check.get('args') or {}).get('chdir'))
+
+
+# The C locale for the whole process, set before any check runs.
+C_LOCALE = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C')
+
+class CwdLock(object):
+    '''
+    Lets any number of independent checks run at once, or one check which
+    changes the working directory, across all the requests of the agent.
+    run_command saves the working directory and restores it afterwards, so
+    an independent check running meanwhile would restore the directory of the
+    other check.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    def acquire_shared(self):
+        self._cond.acquire()
+        try:
+            # NOTE: Let a waiting exclusive holder go first, or a busy agent
+            # would never run it.
+            while self._exclusive or self._waiting:
+                self._cond.wait()
+            self._shared += 1
+        finally:
+            self._cond.release()
+
+    def release_shared(self):
+        self._cond.acquire()
+        try:
+            self._shared -= 1
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def acquire(self):
+        self._cond.acquire()
+        try:
+            self._waiting += 1
+            while self._exclusive or self._shared:
+                self._cond.wait()
+            self._waiting -= 1
+            self._exclusive = True
+        finally:
+            self._cond.release()
+
+    def release(self):
+        self._cond.acquire()
+        try:
+            self._exclusive = False
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+
+_cwd_lock = CwdLock()
+
+
+def check_dependencies(checks):
+    '''
+    Returns the lists of the indexes of the prerequisites of the checks,
+    given by the names of the checks in their depends_on, and the error
+    message if a name is unknown or ambiguous or the dependencies are
+    circular.
+    '''
+    indexes = {}
+    for i, check in enumerate(checks):
+        indexes.setdefault(check.get('name') or check['module'], []).append(i)
+
+    depends = []
+    for check in checks:
+        prerequisites = []
+        for name in check.get('depends_on') or []:
+            if name not in indexes:
+                return None, 'check %s depends on unknown check %s' % (check.get('name') or check['module'], name)
+            if len(indexes[name]) > 1:
+                return None, 'check %s depends on %s, which names more than one check' % (check.get('name') or check['module'], name)
+            prerequisites.append(indexes[name][0])
+        depends.append(prerequisites)
+
+    # NOTE: Resolve the checks whose prerequisites are resolved until
+    # nothing changes. The checks left are in or after a cycle.
+    resolved = set()
+    while True:
+        ready = [i for i in range(len(checks)) if i not in resolved and not [d for d in depends[i] if d not in resolved]]
+        if not ready:
+            break
+        resolved.update(ready)
+    if len(resolved) < len(checks):
+        names = [checks[i].get('name') or checks[i]['module'] for i in range(len(checks)) if i not in resolved]
+        return None, 'circular dependencies among checks %s' % ', '.join(names)
+    return depends, None
+
+
+def is_failure(result):
+    ''' returns whether a result of a check is a failure of the test, which skips the dependent checks with fail_fast '''
+    return result.get('failed', False) or result.get('changed', False) or result.get('skipped', False)
+
+
+def run_checks(loader, checks, workers, extra_params, profile=0, profile_stats=False, cache=None,
+               depends=None, fail_fast=False):
+    '''
+    Runs checks and returns the list of results in the same order.
+    Independent checks run in up to workers threads, the other checks run
+    one by one after them. With the ResultCache cache, the checks whose
+    inputs are unchanged return their cached results.
+
+    A check runs after its prerequisites, the indexes in depends (see
+    check_dependencies), and of the checks which can run, the one with the
+    lowest priority in the check runs first. With fail_fast, a check whose
+    prerequisite failed, changed or was skipped is skipped.
+    '''
+    if depends is None:
+        depends = [[] for check in checks]
+    results = [None] * len(checks)
+    params = []
+    for check in checks:
+        check_params = dict(check.get('args') or {})
+        check_params.update(extra_params)
+        params.append(check_params)
+
+    # NOTE: A check which depends on a check run one by one is run one by
+    # one too, so that the threads do not wait for the serial checks.
+    independent = [is_independent(check) for check in checks]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(checks)):
+            if independent[i] and [d for d in depends[i] if not independent[d]]:
+                independent[i] = False
+                changed = True
+    parallel = [i for i in range(len(checks)) if independent[i]]
+    serial = [i for i in range(len(checks)) if not independent[i]]
+
+    def next_ready(pending):
+        ''' removes and returns the index of the check to run next in pending, or None if none can run '''
+        ready = [i for i in pending if not [d for d in depends[i] if results[d] is None]]
+        if not ready:
+            return None
+        i = min(ready, key=lambda i: (checks[i].get('priority', 0), i))
+        pending.remove(i)
+        return i
+
+    def run(i):
+        if fail_fast:
+            failed = [checks[d].get('name') or checks[d]['module'] for d in depends[i] if is_failure(results[d])]
+            if failed:
+                return {'skipped': True, 'changed': False, '_timing': [],
+                        'msg': 'skipped because the prerequisite %s did not pass' % ', '.join(failed)}
+        return run_check(loader, cache, checks[i]['module'], params[i], profile, profile_stats)
+
+    done = threading.Condition()
+
+    def worker():
+        while True:
+            done.acquire()
+            try:
+                while True:
+                    if not parallel:
+                        return
+                    i = next_ready(parallel)
+                    if i is not None:
+                        break
+                    # NOTE: Wait for the prerequisites running in the other threads.
+                    done.wait()
+            finally:
+                done.release()
+            _cwd_lock.acquire_shared()
+            try:
+                result = run(i)
+            finally:
+                _cwd_lock.release_shared()
+            done.acquire()
+            try:
+                results[i] = result
+                done.notify_all()
+            finally:
+                done.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(parallel)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    while serial:
+        i = next_ready(serial)
+        _cwd_lock.acquire()
+        try:
+            cwd = os.getcwd()
+            results[i] = run(i)
+            os.chdir(cwd)
+        finally:
+            _cwd_lock.release()
+
+    return results
+
+
+def run_bundle(loader, checks, sources, workers, extra_params, profile=0, profile_stats=False,
+               cache=None, cache_max_age=0, fail_fast=False):
+    ''' runs checks and returns the result of the bundle, with the ResultCache in the directory cache if it is set '''
+    result = {
+        'checks': [],
+        'changed': False,
+    }
+
+    for check in checks:
+        if not isinstance(check, dict) or 'module' not in check:
+            result['failed'] = True
+            result['msg'] = 'each check must be a dictionary with module and args: %s' % check
+            return result
+        if check['module'] not in sources:
+            if loader.loaded(check['module']):
+                continue
+            result['failed'] = True
+            result['msg'] = 'no source of module %s is given' % check['module']
+            return result
+        try:
+            loader.load(check['module'], sources[check['module']])
+        except Exception as e:
+            result['failed'] = True
+            result['msg'] = 'cannot load module %s: %s' % (check['module'], to_native(e))
+            result['exception'] = traceback.format_exc()
+            return result
+
+    # NOTE: The profile of a cached result would be stale.
+    result_cache = None
+    if cache and not profile:
+        result_cache = ResultCache(cache, cache_max_age)
+
+    depends, error = check_dependencies(checks)
+    if error:
+        result['failed'] = True
+        result['msg'] = error
+        return result
+
+    results = run_checks(loader, checks, workers, extra_params, profile, profile_stats, result_cache,
+                         depends, fail_fast)
+    for check, check_result in zip(checks, results):
+        result['checks'].append({
+            'name': check.get('name') or check['module'],
+            'module': check['module'],
+            'result': check_result,
+        })
+        if check_result.get('changed', False):
+            result['changed'] = True
+        if check_result.get('failed', False):
+            result['failed'] = True
+
+    if result.get('failed', False):
+        result['msg'] = 'one or more checks failed'
+    return result
+
+
+class FrameReader(object):
+    '''
+    Splits the data read from a stream into frames. A frame is the length
+    of the data in decimal, a newline and the data.
+    '''
+
+    def __init__(self):
+        self._buf = b('')
+
+    def feed(self, data):
+        ''' adds data and returns the list of completed frames '''
+        self._buf += data
+        frames = []
+        while True:
+            pos = self._buf.find(b('\n'))
+            if pos < 0:
+                break
+            end = pos + 1 + int(self._buf[:pos])
+            if len(self._buf) < end:
+                break
+            frames.append(self._buf[pos + 1:end])
+            self._buf = self._buf[end:]
+        return frames
+
+
+def frame(data):
+    ''' returns the frame of JSON serializable data '''
+    b_data = json.dumps(json_dict_bytes_to_unicode(data)).encode('utf-8')
+    return b('%d\n' % len(b_data)) + b_data
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def handle_request(loader, request, loaded, out_fd, write_lock):
+    try:
+        result = run_bundle(loader, request['checks'], {}, max(int(request.get('workers', 8)), 1),
+                            request.get('extra_params') or {}, int(request.get('profile', 0)),
+                            bool(request.get('profile_stats', False)), request.get('cache'),
+                            int(request.get('cache_max_age', 0)), bool(request.get('fail_fast', False)))
+    except Exception as e:
+        result = {'failed': True, 'msg': 'check agent error: %s' % to_native(e),
+                  'exception': traceback.format_exc()}
+    response = frame({'id': request.get('id'), 'result': result, 'loaded': loaded})
+    write_lock.acquire()
+    try:
+        write_all(out_fd, response)
+    finally:
+        write_lock.release()
+
+
+def serve(data=b(''), idle_timeout=120, in_fd=0, out_fd=1):
+    '''
+    Runs as the check agent. Reads requests from in_fd and writes responses
+    to out_fd, both framed JSON. A request is a dictionary of an id and the
+    checks, sources, workers, extra_params, profile, profile_stats, cache,
+    cache_max_age and fail_fast for run_bundle, and a response is a
+    dictionary of the id, the result and loaded, the SHA1 digests of the
+    sources of the request by the names of the modules loaded from them.
+
+    The test modules are loaded once and kept for the later requests, so the
+    sources of the modules which are already loaded can be left out. A
+    module is loaded again if its source is changed.
+    Each request runs in a thread of its own. Returns at the end of in_fd, or
+    when no request is received in idle_timeout seconds.
+    '''
+    # NOTE: run_command applies environ_update by modifying os.environ and
+    # restoring it afterwards, which races between the threads of the
+    # requests. Modules like test_rpm only use it to force the C locale, so
+    # set it once before any request runs.
+    os.environ.update(C_LOCALE)
+    loader = CheckLoader()
+    reader = FrameReader()
+    write_lock = threading.Lock()
+    threads = []
+
+    frames = reader.feed(data)
+    while True:
+        for b_request in frames:
+            request = json.loads(b_request.decode('utf-8'))
+            # NOTE: Load the modules here so that the following requests
+            # without their sources can use them.
+            loaded = {}
+            try:
+                for name, source in (request.get('sources') or {}).items():
+                    loader.load(name, source)
+                    loaded[name] = loader.digest(name)
+            except Exception as e:
+                response = frame({'id': request.get('id'), 'result': {
+                    'failed': True, 'msg': 'cannot load module %s: %s' % (name, to_native(e)),
+                    'exception': traceback.format_exc()}, 'loaded': loaded})
+                write_lock.acquire()
+                try:
+                    write_all(out_fd, response)
+                finally:
+                    write_lock.release()
+                continue
+            t = threading.Thread(target=handle_request, args=(loader, request, loaded, out_fd, write_lock))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        readable = select.select([in_fd], [], [], idle_timeout)[0]
+        threads = [t for t in threads if t.is_alive()]
+        if not readable:
+            if threads:
+                frames = []
+                continue
+            break
+
+        data = os.read(in_fd, 65536)
+        if not data:
+            break
+        frames = reader.feed(data)
+
+    for t in threads:
+        t.join()
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+          checks = dict(type='list', required=True),
+          sources = dict(type='dict', required=True),
+          workers = dict(type='int', default=8),
+          profile = dict(type='int', default=0),
+          profile_stats = dict(type='bool', default=False),
+          cache = dict(type='str', default=None),
+          cache_max_age = dict(type='int', default=0),
+          fail_fast = dict(type='bool', default=False),
+        ),
+        supports_check_mode = True
+    )
+
+    checks = module.params['checks']
+    workers = max(module.params['workers'], 1)
+    extra_params = dict(
+        _ansible_check_mode=module.check_mode,
+        _ansible_no_log=module.no_log,
+        _ansible_debug=module._debug,
+        _ansible_diff=module._diff,
+        _ansible_verbosity=module._verbosity,
+    )
+
+    os.environ.update(C_LOCALE)
+    result = run_bundle(CheckLoader(), checks, module.params['sources'], workers, extra_params,
+                        module.params['profile'], module.params['profile_stats'],
+                        module.params['cache'], module.params['cache_max_age'], module.params['fail_fast'])
+    # NOTE: Leave the sources of the modules out of the displayed result.
+    result['invocation'] = {'module_args': {'checks': checks, 'workers': workers}}
+    if result.get('failed', False):
+        module.fail_json(**result)
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,745 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: test_http
+short_description: Probe URLs or the vhosts of a web server from the remote node.
+description:
+     - Sends a request to each URL, or to C(url) with the name of each vhost in the
+       Host header, and checks the status, the headers and the body of the responses.
+     - The probes are sent concurrently by C(concurrency) threads, which share one
+       pool of keep-alive connections, so probing hundreds of vhosts of a server
+       takes a few connections and one module execution.
+     - With C(duration), the probes are sent repeatedly over C(concurrency) keep-alive
+       connections for C(duration) seconds instead, as a short load test, and the
+       latencies are recorded in a histogram. The result is changed if the median or
+       the 99th percentile of the latencies, or the rate of the probes which got
+       unexpected responses or errors, exceeds C(max_p50), C(max_p99) or
+       C(max_error_rate).
+options:
+  urls:
+    description:
+      - the list of the URLs to probe. Each is a URL, or a dictionary with C(url)
+        and optionally C(host), the Host header, C(method), C(status), C(headers),
+        C(checksum) and C(body), which override the options of the same names.
+    required: false
+    default: []
+  vhosts:
+    description:
+      - the list of the vhosts to probe at C(url). Each is the name sent in the Host
+        header, or a dictionary with C(name) and optionally C(path), C(method),
+        C(status), C(headers), C(checksum) and C(body).
+    required: false
+    default: []
+  url:
+    description:
+      - the URL at which the vhosts are probed. The path of a vhost with C(path)
+        replaces the path of this URL.
+    required: false
+    default: http://127.0.0.1/
+  method:
+    description:
+      - the method of the requests, GET or HEAD.
+    required: false
+    default: GET
+  status:
+    description:
+      - the expected status, or the list of the expected statuses.
+    required: false
+    default: 200
+  headers:
+    description:
+      - the dictionary of the names of the expected response headers to the patterns
+        which their values must match.
+    required: false
+    default: {}
+  checksum:
+    description:
+      - the expected checksum of the body, as C(<algorithm>:<hex digest>), e.g.
+        C(sha256:9f86d08...). The checksum of each body is returned with the
+        algorithm of this, or sha256.
+    required: false
+    default: null
+  body:
+    description:
+      - the pattern which the body must match.
+    required: false
+    default: null
+  concurrency:
+    description:
+      - the number of the probes in flight at once, which is also the maximum number
+        of the connections to each server. With C(duration), this is the number of
+        the connections of the load, at most 1024.
+    required: false
+    default: 16
+  timeout:
+    description:
+      - the timeout in seconds of connecting and of reading a response.
+    required: false
+    default: 10
+  validate_certs:
+    description:
+      - if this is false, the certificates of https URLs are not verified. The
+        certificate is verified for the host of the URL, not for the Host header.
+    required: false
+    default: no
+  duration:
+    description:
+      - the seconds to send the probes for as a load test, at most 300. The probes
+        are sent once unless this is more than 0.
+    required: false
+    default: 0
+  processes:
+    description:
+      - the number of the processes which send the load, among which the connections
+        are divided. If this is 0, it is the number of the CPUs.
+    required: false
+    default: 1
+  max_p50:
+    description:
+      - the maximum median of the latencies in seconds of the load.
+    required: false
+    default: null
+  max_p99:
+    description:
+      - the maximum 99th percentile of the latencies in seconds of the load.
+    required: false
+    default: null
+  max_error_rate:
+    description:
+      - the maximum rate of the probes of the load which got unexpected responses or
+        errors, from 0 to 1.
+    required: false
+    default: 0
+note:
+    - The C(changed) value in result is true if any probe got an unexpected response
+      or an error. Each of C(probes) has C(latency), the seconds from sending the
+      request to reading the whole body, C(ttfb), the seconds to the response
+      header, and C(msg), the list of the mismatches.
+    - A request on a keep-alive connection which the server has closed meanwhile is
+      retried once on a new connection.
+    - With C(duration), the result has C(load), the requests, the errors and the
+      rate, C(latency), the percentiles, C(histogram), the list of [the upper bound
+      in seconds, the count] of the buckets of the latencies, which are 1/64 of a
+      power of 2 microseconds wide like those of HdrHistogram, and C(slo), the
+      thresholds with the values. Each connection sends the next request when it
+      gets the response, so the latencies do not include the time which a request
+      at a fixed rate would have waited for a slow response.
+author:
+    - Hiroaki Nakamura
+'''
+
+EXAMPLES = '''
+- test_http:
+    url: http://127.0.0.1/
+    vhosts:
+      - www.example.com
+      - name: api.example.com
+        path: /healthz
+        body: ok
+    headers:
+      Server: ^nginx
+- test_http:
+    urls:
+      - url: http://127.0.0.1/robots.txt
+        checksum: sha256:3c9ad55147a7144f6067327c3b82ea70e7c5426add9ceea4d07dc2902239bf9e
+
+# Send the vhosts over 32 connections from 2 processes for 10 seconds, and
+# check the latencies and the errors.
+- test_http:
+    url: http://127.0.0.1/
+    vhosts: "{{ nginx_vhosts }}"
+    duration: 10
+    concurrency: 32
+    processes: 2
+    max_p50: 0.005
+    max_p99: 0.05
+    max_error_rate: 0.001
+'''
+
+import hashlib
+import json
+import math
+import os
+import re
+import socket
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from ansible.module_utils.basic import AnsibleModule
+
+READ_SIZE = 65536
+
+PROBE_KEYS = ('method', 'status', 'headers', 'checksum', 'body')
+
+# The bounds of the load.
+MAX_DURATION = 300
+MAX_CONNECTIONS = 1024
+
+# The number of the distinct error messages of the load in the result.
+MAX_ERRORS = 10
+
+
+class ConnectionPool(object):
+    ''' the idle keep-alive connections to each server, shared by the threads '''
+
+    def __init__(self, timeout, validate_certs):
+        self._timeout = timeout
+        self._validate_certs = validate_certs
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def get(self, scheme, netloc):
+        ''' returns an idle connection to the server, or a new one, and whether it is new '''
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), False
+            self.opened += 1
+        finally:
+            self._lock.release()
+        return self._connect(scheme, netloc), True
+
+    def put(self, scheme, netloc, conn):
+        self._lock.acquire()
+        try:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle = {}
+
+    def _connect(self, scheme, netloc):
+        if scheme != 'https':
+            return HTTPConnection(netloc, timeout=self._timeout)
+        kwargs = {}
+        # NOTE: python 2.7.9 and later verify the certificates by default.
+        if not self._validate_certs and hasattr(ssl, '_create_unverified_context'):
+            kwargs['context'] = ssl._create_unverified_context()
+        return HTTPSConnection(netloc, timeout=self._timeout, **kwargs)
+
+
+def parse_checksum(module, checksum):
+    ''' returns (algorithm, hex digest) of a checksum of the form <algorithm>:<hex digest> '''
+    if checksum is None:
+        return 'sha256', None
+    algorithm, sep, digest = str(checksum).partition(':')
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        sep = ''
+    if not sep or not digest:
+        module.fail_json(msg='checksum must be <algorithm>:<hex digest>: %s' % checksum)
+    return algorithm, digest.lower()
+
+
+def build_probes(module):
+    ''' returns the list of the probes from the urls and the vhosts '''
+    params = module.params
+    defaults = dict((key, params[key]) for key in PROBE_KEYS)
+    specs = []
+    for item in params['urls']:
+        if not isinstance(item, dict):
+            item = dict(url=item)
+        if not item.get('url'):
+            module.fail_json(msg='url is required for each of urls: %s' % item)
+        specs.append((item['url'], item.get('host'), item))
+    base = urlsplit(params['url'])
+    for item in params['vhosts']:
+        if not isinstance(item, dict):
+            item = dict(name=item)
+        if not item.get('name'):
+            module.fail_json(msg='name is required for each of vhosts: %s' % item)
+        url = params['url']
+        if item.get('path'):
+            url = '%s://%s%s' % (base.scheme, base.netloc, item['path'])
+        specs.append((url, item['name'], item))
+
+    probes = []
+    for url, host, item in specs:
+        probe = dict(defaults)
+        probe.update((key, item[key]) for key in PROBE_KEYS if key in item)
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            module.fail_json(msg='invalid URL: %s' % url)
+        probe['url'] = url
+        probe['host'] = host
+        probe['scheme'] = parts.scheme
+        probe['netloc'] = parts.netloc
+        probe['path'] = (parts.path or '/') + (parts.query and '?' + parts.query or '')
+        probe['method'] = str(probe['method']).upper()
+        if probe['method'] not in ('GET', 'HEAD'):
+            module.fail_json(msg='method must be GET or HEAD: %s' % probe['method'])
+        status = probe['status']
+        if not isinstance(status, list):
+            status = [status]
+        try:
+            probe['status'] = [int(s) for s in status]
+        except (TypeError, ValueError):
+            module.fail_json(msg='invalid status: %s' % probe['status'])
+        probe['algorithm'], probe['digest'] = parse_checksum(module, probe['checksum'])
+        probe['header_patterns'] = [(name, re.compile(str(pattern))) for name, pattern in (probe['headers'] or {}).items()]
+        probe['body_pattern'] = probe['body'] is not None and re.compile(str(probe['body'])) or None
+        probes.append(probe)
+    return probes
+
+
+def request(pool, probe):
+    ''' sends the request of a probe and returns (response, its body, its checksum, ttfb, latency) '''
+    headers = {}
+    if probe['host']:
+        headers['Host'] = probe['host']
+    while True:
+        conn, new = pool.get(probe['scheme'], probe['netloc'])
+        start = time.time()
+        try:
+            conn.request(probe['method'], probe['path'], headers=headers)
+            response = conn.getresponse()
+            ttfb = time.time() - start
+            digest = hashlib.new(probe['algorithm'])
+            chunks = []
+            while True:
+                chunk = response.read(READ_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if probe['body_pattern'] is not None:
+                    chunks.append(chunk)
+            latency = time.time() - start
+        except (HTTPException, socket.error):
+            conn.close()
+            # NOTE: The server may have closed the idle connection.
+            if new:
+                raise
+            continue
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(probe['scheme'], probe['netloc'], conn)
+        return response, b''.join(chunks), digest.hexdigest(), ttfb, latency
+
+
+def check(pool, probe):
+    ''' returns the result of a probe '''
+    result = dict(url=probe['url'], host=probe['host'], method=probe['method'])
+    try:
+        response, body, digest, ttfb, latency = request(pool, probe)
+    except (HTTPException, socket.error) as e:
+        result.update(changed=True, msg=['%s: %s' % (e.__class__.__name__, e)])
+        return result
+
+    msg = []
+    if response.status not in probe['status']:
+        msg.append('status %d is not %s' % (response.status, ' or '.join(str(s) for s in probe['status'])))
+    headers = {}
+    for name, pattern in probe['header_patterns']:
+        value = response.getheader(name)
+        headers[name] = value
+        if value is None:
+            msg.append('no header %s' % name)
+        elif not pattern.search(value):
+            msg.append('header %s: %s does not match %s' % (name, value, pattern.pattern))
+    checksum = '%s:%s' % (probe['algorithm'], digest)
+    if probe['digest'] is not None and digest != probe['digest']:
+        msg.append('checksum %s is not %s' % (checksum, probe['checksum']))
+    if probe['body_pattern'] is not None and not probe['body_pattern'].search(body.decode('utf-8', 'replace')):
+        msg.append('body does not match %s' % probe['body_pattern'].pattern)
+
+    result.update(
+        status=response.status,
+        headers=headers,
+        checksum=checksum,
+        ttfb=round(ttfb, 6),
+        latency=round(latency, 6),
+        changed=bool(msg),
+        msg=msg,
+    )
+    return result
+
+
+def run_probes(pool, probes, concurrency):
+    ''' returns the results of the probes, sent by the threads '''
+    results = [None] * len(probes)
+    pending = list(range(len(probes)))
+    pending.reverse()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                i = pending.pop()
+            finally:
+                lock.release()
+            results[i] = check(pool, probes[i])
+
+    threads = [threading.Thread(target=worker) for i in range(min(concurrency, len(probes)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Histogram(object):
+    '''
+    The counts of the latencies in buckets as those of HdrHistogram: the
+    latencies in microseconds of n bits are in the buckets 2 ** (n - 7)
+    microseconds wide, so the precision is 1/64 at any magnitude.
+    '''
+
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def _shift(self, us):
+        # NOTE: frexp gives the bit length of an integer, and works on python 2.6.
+        return max(0, math.frexp(us)[1] - self.SUB_BUCKET_BITS)
+
+    def record(self, seconds):
+        us = int(seconds * 1000000)
+        shift = self._shift(us)
+        key = us >> shift << shift
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+        self.sum += us
+        if self.min is None or us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def upper(self, key):
+        ''' returns the largest latency in microseconds in the bucket '''
+        return min(key + (1 << self._shift(key)) - 1, self.max)
+
+    def percentile(self, percent):
+        ''' returns the latency in seconds below or at which percent of the latencies are '''
+        rank = max(1, int(math.ceil(self.total * percent / 100.0 - 1e-9)))
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= rank:
+                return self.upper(key) / 1000000.0
+        return self.max / 1000000.0
+
+    def buckets(self):
+        ''' returns the list of [the upper bound in seconds, the count] of the buckets '''
+        return [[self.upper(key) / 1000000.0, self.counts[key]] for key in sorted(self.counts)]
+
+    def to_dict(self):
+        return dict(counts=list(self.counts.items()), total=self.total, sum=self.sum, min=self.min, max=self.max)
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = dict((key, count) for key, count in data['counts'])
+        histogram.total = data['total']
+        histogram.sum = data['sum']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+
+class LoadStats(object):
+    ''' the histogram of the latencies of the responses, the errors and the requests without responses of a load '''
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.errors = {}
+        self.unanswered = 0
+
+    def record(self, result):
+        if 'latency' in result:
+            self.histogram.record(result['latency'])
+        else:
+            self.unanswered += 1
+        if result['changed']:
+            msg = '%s: %s' % (result['host'] or result['url'], '; '.join(result['msg']))
+            self.errors[msg] = self.errors.get(msg, 0) + 1
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        for msg, count in other.errors.items():
+            self.errors[msg] = self.errors.get(msg, 0) + count
+        self.unanswered += other.unanswered
+
+    def to_dict(self):
+        return dict(histogram=self.histogram.to_dict(), errors=self.errors, unanswered=self.unanswered)
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.histogram = Histogram.from_dict(data['histogram'])
+        stats.errors = data['errors']
+        stats.unanswered = data['unanswered']
+        return stats
+
+
+def run_load(probes, connections, duration, timeout, validate_certs):
+    ''' returns the LoadStats of sending the probes over the connections for duration seconds '''
+    pool = ConnectionPool(timeout, validate_certs)
+    deadline = time.time() + duration
+    stats = []
+
+    # NOTE: Each thread counts by itself, so the threads share only the pool.
+    def worker(start):
+        thread_stats = LoadStats()
+        stats.append(thread_stats)
+        i = start
+        while time.time() < deadline:
+            thread_stats.record(check(pool, probes[i % len(probes)]))
+            i += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(connections)]
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+
+    total = LoadStats()
+    for thread_stats in stats:
+        total.merge(thread_stats)
+    return total
+
+
+def fork_load(probes, connections, duration, timeout, validate_certs):
+    ''' returns the pid of the process running run_load() and the pipe of its result '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(w)
+        return pid, r
+    os.close(r)
+    status = 1
+    try:
+        stats = run_load(probes, connections, duration, timeout, validate_certs)
+        data = json.dumps(stats.to_dict()).encode('utf-8')
+        while data:
+            data = data[os.write(w, data):]
+        status = 0
+    finally:
+        # NOTE: Do not run the exit handlers of the parent.
+        os._exit(status)
+
+
+def run_load_processes(probes, connections, processes, duration, timeout, validate_certs):
+    ''' returns the merged LoadStats of run_load() in the processes '''
+    if processes == 1:
+        return run_load(probes, connections, duration, timeout, validate_certs)
+
+    children = []
+    for i in range(processes):
+        share = connections // processes + (i < connections % processes and 1 or 0)
+        children.append(fork_load(probes, share, duration, timeout, validate_certs))
+
+    total = LoadStats()
+    for pid, r in children:
+        chunks = []
+        while True:
+            chunk = os.read(r, READ_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(r)
+        os.waitpid(pid, 0)
+        try:
+            total.merge(LoadStats.from_dict(json.loads(b''.join(chunks).decode('utf-8'))))
+        except ValueError:
+            msg = 'load process %d exited without the result' % pid
+            total.errors[msg] = 1
+    return total
+
+
+def load_result(module, probes):
+    ''' returns the result of the load of the probes '''
+    params = module.params
+    processes = params['processes'] or os.sysconf('SC_NPROCESSORS_ONLN')
+    connections = params['concurrency']
+    processes = min(processes, connections)
+
+    start = time.time()
+    stats = run_load_processes(probes, connections, processes, params['duration'],
+                               params['timeout'], params['validate_certs'])
+    elapsed = time.time() - start
+
+    histogram = stats.histogram
+    requests = histogram.total + stats.unanswered
+    error_count = sum(stats.errors.values())
+    error_rate = requests and round(float(error_count) / requests, 6) or 0.0
+
+    latency = dict(min=0.0, mean=0.0, p50=0.0, p90=0.0, p99=0.0, p999=0.0, max=0.0)
+    if histogram.total:
+        latency = dict(
+            min=histogram.min / 1000000.0,
+            mean=round(histogram.sum / 1000000.0 / histogram.total, 6),
+            p50=histogram.percentile(50),
+            p90=histogram.percentile(90),
+            p99=histogram.percentile(99),
+            p999=histogram.percentile(99.9),
+            max=histogram.max / 1000000.0,
+        )
+
+    slo = {}
+    violations = []
+    for name, value in (('max_p50', latency['p50']), ('max_p99', latency['p99']), ('max_error_rate', error_rate)):
+        limit = params[name]
+        if limit is None:
+            continue
+        if name != 'max_error_rate' and not histogram.total:
+            slo[name] = dict(limit=limit, value=None, ok=False)
+            violations.append('%s is unknown without responses' % name[4:])
+            continue
+        ok = value <= limit
+        slo[name] = dict(limit=limit, value=value, ok=ok)
+        if not ok:
+            violations.append('%s %s exceeds %s' % (name[4:], value, limit))
+
+    top = sorted(stats.errors.items(), key=lambda item: (-item[1], item[0]))[:MAX_ERRORS]
+    msg = '%d requests over %d connections in %.1fs (%.1f/s), p50 %.6fs, p99 %.6fs, %d errors' % (
+        requests, connections, elapsed, requests / elapsed, latency['p50'], latency['p99'], error_count)
+    if violations:
+        msg = '%s: %s' % (msg, ', '.join(violations))
+    return {
+        'changed': bool(violations),
+        'load': dict(
+            duration=round(elapsed, 6),
+            connections=connections,
+            processes=processes,
+            requests=requests,
+            rps=round(requests / elapsed, 1),
+            errors=error_count,
+            error_rate=error_rate,
+        ),
+        'latency': latency,
+        'histogram': histogram.buckets(),
+        'slo': slo,
+        'errors': [dict(msg=m, count=c) for m, c in top],
+        'msg': msg,
+        '_ansible_verbose_always': True
+    }
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+          urls=dict(type='list', default=[]),
+          vhosts=dict(type='list', default=[]),
+          url=dict(type='str', default='http://127.0.0.1/'),
+          method=dict(type='str', default='GET'),
+          status=dict(type='raw', default=200),
+          headers=dict(type='dict', default={}),
+          checksum=dict(type='str', default=None),
+          body=dict(type='str', default=None),
+          concurrency=dict(type='int', default=16),
+          timeout=dict(type='float', default=10),
+          validate_certs=dict(type='bool', default=False),
+          duration=dict(type='float', default=0),
+          processes=dict(type='int', default=1),
+          max_p50=dict(type='float', default=None),
+          max_p99=dict(type='float', default=None),
+          max_error_rate=dict(type='float', default=0),
+        ),
+        supports_check_mode = True
+    )
+
+    probes = build_probes(module)
+    if not probes:
+        module.fail_json(msg='urls or vhosts is required')
+    if module.params['concurrency'] < 1:
+        module.fail_json(msg='concurrency must be 1 or more: %d' % module.params['concurrency'])
+
+    if module.params['duration'] > 0:
+        if module.params['duration'] > MAX_DURATION:
+            module.fail_json(msg='duration must be %d or less: %s' % (MAX_DURATION, module.params['duration']))
+        if module.params['concurrency'] > MAX_CONNECTIONS:
+            module.fail_json(msg='concurrency must be %d or less with duration: %d' % (MAX_CONNECTIONS, module.params['concurrency']))
+        if module.params['processes'] < 0:
+            module.fail_json(msg='processes must be 0 or more: %d' % module.params['processes'])
+        module.exit_json(**load_result(module, probes))
+
+    pool = ConnectionPool(module.params['timeout'], module.params['validate_certs'])
+    start = time.time()
+    try:
+        results = run_probes(pool, probes, module.params['concurrency'])
+    finally:
+        pool.close()
+    elapsed = time.time() - start
+
+    failed = [result for result in results if result['changed']]
+    latencies = sorted(result['latency'] for result in results if 'latency' in result)
+    result = {
+        'changed': bool(failed),
+        'probes': results,
+        'elapsed': round(elapsed, 6),
+        'connections': pool.opened,
+        'msg': '%d of %d probes got unexpected responses' % (len(failed), len(results)),
+        '_ansible_verbose_always': True
+    }
+    if latencies:
+        result['latency'] = dict(
+            min=latencies[0],
+            median=latencies[len(latencies) // 2],
+            max=latencies[-1],
+        )
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
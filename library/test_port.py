@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: test_port
+short_description: Check the listening sockets and the processes which own them.
+description:
+     - Reads the listening TCP sockets and the unconnected UDP sockets from
+       /proc/net/tcp, tcp6, udp and udp6, and checks them against the expected
+       listeners.
+options:
+  listeners:
+    description:
+      - the list of the expected listeners. Each listener is a port number, or a
+        dictionary with C(port), C(proto) (tcp or udp, default tcp), C(address)
+        (default any address), C(process), the pattern of the name of a process
+        which owns the socket, and C(state).
+      - With C(state=present) (the default), a matching socket must exist. With
+        C(state=absent), none must exist. With C(state=allowed), a matching socket
+        may exist and is not unexpected.
+    required: false
+    default: []
+  allowed:
+    description:
+      - the list of the ports of the listeners of C(state=allowed) with the proto
+        C(allowed_proto) and any address, as the ports allowed by the firewall.
+    required: false
+    default: []
+  allowed_proto:
+    description:
+      - the proto of the listeners on the C(allowed) ports.
+    required: false
+    default: tcp
+    choices: [ "tcp", "udp", "any" ]
+  exclusive:
+    description:
+      - if this is true, a listening socket which does not match any listener of
+        C(state=present) or C(state=allowed), or is not on an C(allowed) port, is unexpected, and the result is changed.
+    required: false
+    default: no
+  ignore_loopback:
+    description:
+      - if this is true, the sockets on loopback addresses are not unexpected with
+        C(exclusive).
+    required: false
+    default: yes
+  owners:
+    description:
+      - if this is true, the owners, the pid and the name of the processes which
+        have the socket open, of every listening socket are returned. They are looked
+        up only for the listeners with C(process) otherwise.
+    required: false
+    default: no
+note:
+    - The rows of the established connections are not parsed. The kernel lists the
+      listening TCP sockets first, so reading /proc/net/tcp stops at the first
+      other row. The owners are looked up in one pass over /proc/*/fd, which needs
+      the privilege to read the file descriptors of the processes.
+author:
+    - Hiroaki Nakamura
+'''
+
+EXAMPLES = '''
+- test_port:
+    listeners:
+      - port: 80
+        process: nginx
+      - port: 22
+        state: allowed
+    exclusive: yes
+
+# Check that nothing but the daemons on the ports open in the firewall listens.
+- test_port:
+    allowed: "{{ worldwide_allowed_ports }}"
+    exclusive: yes
+'''
+
+import os
+import re
+import socket
+import struct
+
+from ansible.module_utils.basic import AnsibleModule
+
+# /proc/net/tcp states: LISTEN, and SYN_RECV which older kernels list after
+# each listening socket
+TCP_LISTEN = '0A'
+TCP_SYN_RECV = '03'
+
+UNCONNECTED = (' 00000000:0000 ', ' 00000000000000000000000000000000:0000 ')
+
+LOOPBACK_RE = re.compile(r'^(127\.|::1$|::ffff:127\.)')
+
+
+def decode_address(hex_addr):
+    ''' returns the text of an address in /proc/net/{tcp,udp}[6] '''
+    # NOTE: Each 32 bit word is printed as a number in the host byte order.
+    packed = b''.join(struct.pack('=I', int(hex_addr[i:i + 8], 16)) for i in range(0, len(hex_addr), 8))
+    return socket.inet_ntop(len(packed) == 4 and socket.AF_INET or socket.AF_INET6, packed)
+
+
+def normalize_address(address):
+    ''' returns the address in the text of decode_address(), or None if it is not an address '''
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_ntop(family, socket.inet_pton(family, address))
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+def read_listening(proto):
+    ''' returns the list of [proto, address, port, inode] of the listening sockets in /proc/net/<proto> '''
+    try:
+        f = open('/proc/net/%s' % proto)
+    except IOError:
+        return []
+    tcp = proto.startswith('tcp')
+    sockets = []
+    try:
+        f.readline() # the header
+        for line in f:
+            if tcp:
+                fields = line.split(None, 4)
+                if fields[3] != TCP_LISTEN:
+                    if fields[3] == TCP_SYN_RECV:
+                        continue
+                    break
+            elif UNCONNECTED[0] not in line and UNCONNECTED[1] not in line:
+                continue
+            fields = line.split()
+            addr, port = fields[1].split(':')
+            sockets.append([proto, decode_address(addr), int(port, 16), int(fields[9])])
+    finally:
+        f.close()
+    return sockets
+
+
+def find_owners(inodes):
+    ''' returns the dictionary of the socket inodes to the list of [pid, name] of the processes which have them open '''
+    targets = dict(('socket:[%d]' % inode, inode) for inode in inodes)
+    owners = {}
+    if not targets:
+        return owners
+    comm_re = re.compile(r'\(([^)]+)\)')
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            fds = os.listdir('/proc/%s/fd' % pid)
+        except OSError:
+            continue # the process exited, or is not ours
+        found = []
+        for fd in fds:
+            try:
+                inode = targets.get(os.readlink('/proc/%s/fd/%s' % (pid, fd)))
+            except OSError:
+                continue
+            if inode is not None:
+                found.append(inode)
+        if not found:
+            continue
+        try:
+            m = comm_re.search(open('/proc/%s/stat' % pid).read())
+        except IOError:
+            continue
+        owner = [int(pid), m and m.group(1) or '']
+        for inode in found:
+            owners.setdefault(inode, []).append(owner)
+    return owners
+
+
+def parse_listener(module, listener):
+    ''' returns the listener as a dictionary of port, proto, address, process and state '''
+    if not isinstance(listener, dict):
+        listener = dict(port=listener)
+    spec = dict(
+        port=listener.get('port'),
+        proto=listener.get('proto', 'tcp'),
+        address=listener.get('address'),
+        process=listener.get('process'),
+        state=listener.get('state', 'present'),
+    )
+    try:
+        spec['port'] = int(spec['port'])
+    except (TypeError, ValueError):
+        module.fail_json(msg='invalid port of a listener: %s' % listener)
+    if spec['proto'] not in ('tcp', 'udp'):
+        module.fail_json(msg='proto of a listener must be tcp or udp: %s' % listener)
+    if spec['state'] not in ('present', 'absent', 'allowed'):
+        module.fail_json(msg='state of a listener must be present, absent or allowed: %s' % listener)
+    if spec['address'] in ('*', ''):
+        spec['address'] = None
+    if spec['address'] is not None:
+        address = normalize_address(spec['address'])
+        if address is None:
+            module.fail_json(msg='invalid address of a listener: %s' % listener)
+        spec['address'] = address
+    return spec
+
+
+def format_socket(sock):
+    proto, address, port = sock[:3]
+    if ':' in address:
+        return '%s [%s]:%d' % (proto, address, port)
+    return '%s %s:%d' % (proto, address, port)
+
+
+def matches(spec, sock):
+    proto, address, port = sock[:3]
+    return port == spec['port'] and (spec['proto'] is None or proto.startswith(spec['proto'])) and \
+        (spec['address'] is None or address == spec['address'])
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+          listeners=dict(type='list', default=[]),
+          allowed=dict(type='list', default=[]),
+          allowed_proto=dict(default='tcp', choices=['tcp', 'udp', 'any']),
+          exclusive=dict(type='bool', default=False),
+          ignore_loopback=dict(type='bool', default=True),
+          owners=dict(type='bool', default=False),
+        ),
+        supports_check_mode = True
+    )
+
+    specs = [parse_listener(module, listener) for listener in module.params['listeners']]
+    for port in module.params['allowed']:
+        if module.params['allowed_proto'] == 'any':
+            spec = parse_listener(module, dict(port=port, state='allowed'))
+            spec['proto'] = None
+        else:
+            spec = parse_listener(module, dict(port=port, proto=module.params['allowed_proto'], state='allowed'))
+        specs.append(spec)
+
+    sockets = []
+    for proto in ('tcp', 'tcp6', 'udp', 'udp6'):
+        sockets.extend(read_listening(proto))
+    sockets.sort(key=lambda sock: (sock[2], sock[0], sock[1]))
+
+    # NOTE: Look up the owners only of the sockets which are checked.
+    if module.params['owners']:
+        inodes = [sock[3] for sock in sockets]
+    else:
+        inodes = [sock[3] for sock in sockets for spec in specs if spec['process'] and matches(spec, sock)]
+    owners = find_owners(inodes)
+
+    listeners = []
+    for proto, address, port, inode in sockets:
+        listener = dict(proto=proto, address=address, port=port, inode=inode)
+        if inode in owners:
+            listener['owners'] = [dict(pid=pid, name=name) for pid, name in owners[inode]]
+        listeners.append(listener)
+
+    changed = False
+    expected = []
+    for spec in specs:
+        got = [sock for sock in sockets if matches(spec, sock)]
+        if spec['process']:
+            pattern = re.compile(spec['process'])
+            got = [sock for sock in got if [o for o in owners.get(sock[3], []) if pattern.search(o[1])]]
+        result = dict(spec)
+        result['got'] = [format_socket(sock) for sock in got]
+        if spec['state'] == 'present':
+            result['changed'] = not got
+        elif spec['state'] == 'absent':
+            result['changed'] = bool(got)
+        else:
+            result['changed'] = False
+        changed = changed or result['changed']
+        expected.append(result)
+
+    result = {
+        'listeners': listeners,
+        'expected': expected,
+        '_ansible_verbose_always': True
+    }
+
+    if module.params['exclusive']:
+        known = [spec for spec in specs if spec['state'] != 'absent']
+        unexpected = []
+        for listener, sock in zip(listeners, sockets):
+            if module.params['ignore_loopback'] and LOOPBACK_RE.match(sock[1]):
+                continue
+            if not [spec for spec in known if matches(spec, sock)]:
+                unexpected.append(listener)
+        result['unexpected'] = unexpected
+        changed = changed or bool(unexpected)
+
+    result['changed'] = changed
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
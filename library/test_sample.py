@@ -0,0 +1,2 @@
+# NOTE: test_sample is implemented as an action plugin: action_plugins/test_sample.py
+# So there is no code here.
@@ -68,23 +68,10 @@ EXAMPLES = '''
 
 '''
 
-import platform
+import os
 import pipes
-#import os
-#import re
-#import tempfile
-#import shlex
-#import select
-#import time
-#import string
-#import glob
-
-# The distutils module is not shipped with SUNWPython on Solaris.
-# It's in the SUNWPython-devel package which also contains development files
-# that don't belong on production boxes.  Since our Solaris code doesn't
-# depend on LooseVersion, do not import it on Solaris.
-if platform.system() != 'SunOS':
-    from distutils.version import LooseVersion
+
+from ansible.module_utils.basic import AnsibleModule, load_platform_subclass
 
 class TestService(object):
     """
@@ -180,6 +167,10 @@ class LinuxTestService(TestService):
         if location.get('initctl', False) and os.path.exists("/etc/init/%s.conf" % self.name):
             # service is managed by upstart
             self.enable_cmd = location['initctl']
+            # NOTE: distutils and re are only needed for upstart, so they are
+            # imported here to keep them off the startup of the module.
+            import re
+            from distutils.version import LooseVersion
             # set the upstart version based on the output of 'initctl version'
             self.upstart_version = LooseVersion('0.0.0')
             try:
@@ -438,6 +429,5 @@ def main():
     result['changed'] = changed
     module.exit_json(**result)
 
-from ansible.module_utils.basic import *
-
-main()
+if __name__ == '__main__':
+    main()
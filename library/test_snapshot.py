@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: test_snapshot
+short_description: Collect what the test modules check on a remote node at once.
+description:
+     - Collects the installed packages, the systemd units, the SysV init scripts with
+       their chkconfig levels and status, the process table, the pid files, the
+       listening sockets and the iptables ruleset of the remote node, and returns
+       them as one compressed snapshot.
+     - This module is called from the test_check action plugin when the
+       test_snapshot variable is true, and the checks of test_rpm, test_ps,
+       test_pidfile, test_service, test_systemd and test_iptables are evaluated
+       against the snapshot on the controller. See README.md
+options:
+  pidfile_dirs:
+    description:
+      - the directories whose C(*.pid) files, and those of their subdirectories, are
+        collected.
+    required: false
+    default: [ "/var/run", "/run" ]
+  service_status:
+    description:
+      - if this is true, the status command of each SysV init script is run, as
+        test_service does for C(state).
+    required: false
+    default: true
+note:
+    - The result has C(snapshot), the base64 encoded zlib compressed JSON of the
+      snapshot, and C(size), the size of the JSON in bytes.
+    - A part which cannot be collected on the node, like the units on a node
+      without systemd, is null in the snapshot, and the checks of it run the test
+      modules instead.
+author:
+    - Hiroaki Nakamura
+'''
+
+EXAMPLES = '''
+# Collect the snapshot and save it on the controller.
+- test_snapshot:
+'''
+
+import base64
+import json
+import os
+import pipes
+import re
+import time
+import zlib
+
+from ansible.module_utils.basic import AnsibleModule
+
+# The version of the format of the snapshot.
+SNAPSHOT_VERSION = 1
+
+RPM_QUERYFORMAT = '%{NAME}\\t%{EPOCH}\\t%{VERSION}\\t%{RELEASE}\\t%{ARCH}\\n'
+
+SYSV_TOOL_DIRS = ['/sbin', '/usr/sbin', '/bin', '/usr/bin']
+
+# /proc/net/tcp state of listening sockets
+TCP_LISTEN = '0A'
+
+
+def run(module, cmd):
+    ''' returns the stdout of cmd, or None if it failed '''
+    rc, out, err = module.run_command(cmd, environ_update=dict(LANG='C', LC_ALL='C', LC_MESSAGES='C'))
+    if rc != 0:
+        return None
+    return out
+
+
+def collect_packages(module):
+    ''' returns the list of [name, epoch, version, release, arch] of the installed packages '''
+    rpmbin = module.get_bin_path('rpm')
+    if rpmbin is None:
+        return None
+    out = run(module, [rpmbin, '-qa', '--qf', RPM_QUERYFORMAT])
+    if out is None:
+        return None
+    packages = []
+    for line in out.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 5:
+            if fields[1] == '(none)':
+                fields[1] = None
+            packages.append(fields)
+    return packages
+
+
+def collect_units(module):
+    ''' returns the dictionary of the unit names to [load state, active state, unit file state] '''
+    systemctl = module.get_bin_path('systemctl')
+    if systemctl is None:
+        return None
+    files = run(module, [systemctl, 'list-unit-files', '--no-legend', '--no-pager'])
+    loaded = run(module, [systemctl, 'list-units', '--all', '--no-legend', '--no-pager'])
+    if files is None or loaded is None:
+        return None
+
+    units = {}
+    for line in files.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            units[fields[0]] = [None, None, fields[1]]
+    for line in loaded.splitlines():
+        fields = line.split()
+        # NOTE: Failed units are marked with a bullet before the name.
+        if fields and '.' not in fields[0]:
+            fields = fields[1:]
+        if len(fields) >= 3:
+            units.setdefault(fields[0], [None, None, None])[:2] = fields[1:3]
+    return units
+
+
+def collect_sysv(module, service_status):
+    ''' returns the init scripts, their chkconfig levels and status, as test_service examines them '''
+    location = dict()
+    for binary in ('service', 'chkconfig', 'update-rc.d', 'insserv', 'rc-service', 'initctl'):
+        location[binary] = module.get_bin_path(binary, opt_dirs=SYSV_TOOL_DIRS)
+    # NOTE: test_service supports only SysV init scripts with chkconfig.
+    if not location['chkconfig'] or location['rc-service'] or location['update-rc.d'] or location['insserv']:
+        return None
+
+    try:
+        scripts = sorted(name for name in os.listdir('/etc/init.d') if os.path.isfile('/etc/init.d/%s' % name))
+    except OSError:
+        scripts = []
+    upstart = []
+    if location['initctl']:
+        upstart = [name for name in scripts if os.path.exists('/etc/init/%s.conf' % name)]
+
+    levels = {}
+    out = run(module, [location['chkconfig'], '--list'])
+    for line in (out or '').splitlines():
+        fields = line.split()
+        # NOTE: The xinetd based services are listed after the SysV ones.
+        if len(fields) == 8 and fields[1].startswith('0:'):
+            levels[fields[0]] = [field.split(':')[0] for field in fields[1:] if field.endswith(':on')]
+
+    status = {}
+    if service_status:
+        for name in scripts:
+            if name in upstart:
+                continue
+            if location['service']:
+                cmd = '%s %s status' % (location['service'], pipes.quote(name))
+            else:
+                cmd = '/etc/init.d/%s status' % pipes.quote(name)
+            rc, stdout, stderr = module.run_command(cmd)
+            status[name] = [cmd, rc, stdout, stderr]
+
+    return dict(initscripts=scripts, upstart=upstart, initctl=bool(location['initctl']),
+                levels=levels, status=status)
+
+
+def collect_processes():
+    ''' returns the list of [pid, comm, cmdline] of the processes except this one '''
+    comm_re = re.compile(r'\(([^)]+)\)')
+    me = str(os.getpid())
+    processes = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or pid == me:
+            continue
+        try:
+            stat = open('/proc/%s/stat' % pid).read()
+            cmdline = open('/proc/%s/cmdline' % pid).read()
+        except IOError:
+            continue # the process exited
+        m = comm_re.search(stat)
+        processes.append([int(pid), m and m.group(1) or '', cmdline])
+    processes.sort()
+    return processes
+
+
+def collect_pidfiles(dirs):
+    ''' returns the dictionary of the paths of the pid files to their contents '''
+    pidfiles = {}
+    for top in dirs:
+        try:
+            names = os.listdir(top)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(top, name)
+            if os.path.isdir(path):
+                try:
+                    paths = [os.path.join(path, n) for n in os.listdir(path)]
+                except OSError:
+                    continue
+            else:
+                paths = [path]
+            for path in paths:
+                if path.endswith('.pid') and os.path.isfile(path):
+                    try:
+                        pidfiles[path] = open(path).read()
+                    except IOError:
+                        pass
+    return pidfiles
+
+
+def decode_address(hex_addr):
+    ''' returns the text of an address in /proc/net/{tcp,udp}[6] '''
+    words = [hex_addr[i:i + 8] for i in range(0, len(hex_addr), 8)]
+    # NOTE: Each 32 bit word is in the host byte order (little endian).
+    octets = []
+    for word in words:
+        octets.extend(int(word[i:i + 2], 16) for i in (6, 4, 2, 0))
+    if len(octets) == 4:
+        return '.'.join(str(o) for o in octets)
+    groups = ['%x' % (octets[i] << 8 | octets[i + 1]) for i in range(0, 16, 2)]
+    return ':'.join(groups)
+
+
+def collect_sockets():
+    ''' returns the list of [protocol, address, port, inode] of the listening sockets '''
+    sockets = []
+    for proto in ('tcp', 'tcp6', 'udp', 'udp6'):
+        try:
+            lines = open('/proc/net/%s' % proto).read().splitlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            local, remote, state, inode = fields[1], fields[2], fields[3], fields[9]
+            if proto.startswith('tcp') and state != TCP_LISTEN:
+                continue
+            if proto.startswith('udp') and not remote.endswith(':0000'):
+                continue
+            addr, port = local.split(':')
+            sockets.append([proto, decode_address(addr), int(port, 16), int(inode)])
+    return sockets
+
+
+def collect_iptables(module):
+    ''' returns the output of iptables-save '''
+    executable = module.get_bin_path('iptables-save', opt_dirs=SYSV_TOOL_DIRS)
+    if executable is None:
+        return None
+    rc, out, err = module.run_command(executable)
+    if rc != 0:
+        return None
+    return out
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=dict(
+          pidfile_dirs=dict(type='list', default=['/var/run', '/run']),
+          service_status=dict(type='bool', default=True),
+        ),
+        supports_check_mode = True
+    )
+
+    snapshot = dict(
+        version=SNAPSHOT_VERSION,
+        time=time.time(),
+        packages=collect_packages(module),
+        units=collect_units(module),
+        sysv=collect_sysv(module, module.params['service_status']),
+        processes=collect_processes(),
+        pidfiles=collect_pidfiles(module.params['pidfile_dirs']),
+        pidfile_dirs=module.params['pidfile_dirs'],
+        sockets=collect_sockets(),
+        iptables=collect_iptables(module),
+    )
+    data = json.dumps(snapshot, separators=(',', ':'))
+
+    module.exit_json(
+        changed=False,
+        size=len(data),
+        snapshot=base64.b64encode(zlib.compress(data.encode('utf-8'), 6)).decode('ascii'),
+    )
+
+if __name__ == '__main__':
+    main()
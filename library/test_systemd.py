@@ -175,6 +175,5 @@ def main():
     result['changed'] = changed
     module.exit_json(**result)
 
-from ansible.module_utils.basic import *
-
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# lxd_inventory.py is a third party dynamic inventory script for Ansible
+#
+# lxd_inventory.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# lxd_inventory.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Lists the LXD containers as the inventory of Ansible, with one query of
+the LXD API on its local unix domain socket.
+
+usage: lxd_inventory.py [--list | --host HOST] [--refresh-cache]
+
+    ansible-playbook -C -i lxd_inventory.py testbook.yml
+
+The containers (only the running ones unless LXD_INVENTORY_ALL is set)
+are in the containers group (LXD_INVENTORY_GROUP) with the lxd
+connection, and in a group by their distribution and major version like
+centos_7. Each container has the facts which testbook.yml and the test
+action plugins use, from the image properties in its configuration:
+
+    ansible_distribution                e.g. CentOS
+    ansible_distribution_version        e.g. 7
+    ansible_distribution_major_version  e.g. 7
+    ansible_service_mgr                 e.g. systemd (from SERVICE_MGRS)
+
+so that the play does not have to gather facts. A container whose image
+has no such properties does not have them.
+
+The listing is cached in LXD_INVENTORY_CACHE (default:
+~/.ansible/tmp/lxd_inventory.json) for LXD_INVENTORY_CACHE_TTL seconds
+(default: 60). The stale cache is used when the LXD API cannot be
+reached. The socket is LXD_SOCKET, or the first of DEFAULT_SOCKETS which
+exists.
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import re
+import socket
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+DEFAULT_SOCKETS = ('/var/snap/lxd/common/lxd/unix.socket', '/var/lib/lxd/unix.socket')
+DEFAULT_CACHE = '~/.ansible/tmp/lxd_inventory.json'
+DEFAULT_CACHE_TTL = 60
+DEFAULT_GROUP = 'containers'
+TIMEOUT = 30
+
+# The names of the distributions in the facts of Ansible by the lower case
+# image.os of the LXD images.
+DISTRIBUTIONS = {
+    'alpine': 'Alpine',
+    'centos': 'CentOS',
+    'debian': 'Debian',
+    'fedora': 'Fedora',
+    'opensuse': 'openSUSE',
+    'oracle': 'OracleLinux',
+    'redhat': 'RedHat',
+    'ubuntu': 'Ubuntu',
+}
+
+# (distribution, the first major version, service manager), in the
+# order of the major versions for each distribution, as the setup module
+# detects them.
+SERVICE_MGRS = (
+    ('Alpine', 0, 'openrc'),
+    ('CentOS', 7, 'systemd'),
+    ('CentOS', 6, 'upstart'),
+    ('CentOS', 0, 'sysvinit'),
+    ('Debian', 8, 'systemd'),
+    ('Debian', 0, 'sysvinit'),
+    ('Fedora', 15, 'systemd'),
+    ('OracleLinux', 7, 'systemd'),
+    ('OracleLinux', 6, 'upstart'),
+    ('RedHat', 7, 'systemd'),
+    ('RedHat', 6, 'upstart'),
+    ('Ubuntu', 15, 'systemd'),
+    ('Ubuntu', 6, 'upstart'),
+)
+
+
+class UnixHTTPConnection(HTTPConnection):
+    ''' a HTTP connection to a unix domain socket '''
+
+    def __init__(self, path, timeout=TIMEOUT):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._path)
+        self.sock = sock
+
+
+def find_socket():
+    if os.environ.get('LXD_SOCKET'):
+        return os.environ['LXD_SOCKET']
+    for path in DEFAULT_SOCKETS:
+        if os.path.exists(path):
+            return path
+    return DEFAULT_SOCKETS[-1]
+
+
+def query_containers(sock_path):
+    ''' returns the list of the containers with their configuration '''
+    conn = UnixHTTPConnection(sock_path)
+    try:
+        conn.request('GET', '/1.0/containers?recursion=1')
+        response = conn.getresponse()
+        body = json.loads(response.read().decode('utf-8'))
+    finally:
+        conn.close()
+    if response.status != 200 or body.get('type') == 'error':
+        raise IOError('LXD API error %s: %s' % (response.status, body.get('error')))
+    return body['metadata']
+
+
+def load_cache(path, ttl):
+    ''' returns the cached list of the containers and whether it is fresh, or (None, False) '''
+    try:
+        with open(path) as f:
+            containers = json.load(f)
+        return containers, time.time() - os.path.getmtime(path) < ttl
+    except (IOError, OSError, ValueError):
+        return None, False
+
+
+def save_cache(path, containers):
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(containers, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        sys.stderr.write('lxd_inventory.py: could not save the cache %s: %s\n' % (path, e))
+
+
+def get_containers(refresh):
+    path = os.path.expanduser(os.environ.get('LXD_INVENTORY_CACHE', DEFAULT_CACHE))
+    ttl = int(os.environ.get('LXD_INVENTORY_CACHE_TTL', DEFAULT_CACHE_TTL))
+    containers, fresh = load_cache(path, ttl)
+    if fresh and not refresh:
+        return containers
+
+    sock_path = find_socket()
+    try:
+        containers = query_containers(sock_path)
+    except (IOError, OSError, ValueError, socket.error) as e:
+        if containers is None:
+            raise
+        sys.stderr.write('lxd_inventory.py: using the stale cache %s: %s: %s\n' % (path, sock_path, e))
+        return containers
+    save_cache(path, containers)
+    return containers
+
+
+def container_facts(container):
+    ''' returns the facts of a container from the image properties in its configuration '''
+    config = container.get('expanded_config') or container.get('config') or {}
+    image_os = config.get('image.os')
+    if not image_os:
+        return {}
+    distribution = DISTRIBUTIONS.get(image_os.lower(), image_os)
+    facts = dict(ansible_distribution=distribution)
+
+    # NOTE: image.release is the code name for some distributions, like
+    # xenial for Ubuntu, whose image.version is the version.
+    version = config.get('image.version') or config.get('image.release') or ''
+    m = re.match(r'\d+', version)
+    if m is None:
+        return facts
+    facts['ansible_distribution_version'] = version
+    facts['ansible_distribution_major_version'] = major = m.group(0)
+    for name, first_major, service_mgr in SERVICE_MGRS:
+        if name == distribution and int(major) >= first_major:
+            facts['ansible_service_mgr'] = service_mgr
+            break
+    return facts
+
+
+def build_inventory(containers):
+    group = os.environ.get('LXD_INVENTORY_GROUP', DEFAULT_GROUP)
+    include_all = bool(os.environ.get('LXD_INVENTORY_ALL'))
+    inventory = {
+        group: dict(hosts=[], vars=dict(ansible_connection='lxd')),
+        '_meta': dict(hostvars={}),
+    }
+    for container in sorted(containers, key=lambda c: c['name']):
+        if not include_all and container.get('status') != 'Running':
+            continue
+        name = container['name']
+        facts = container_facts(container)
+        inventory[group]['hosts'].append(name)
+        inventory['_meta']['hostvars'][name] = facts
+        if 'ansible_distribution_major_version' in facts:
+            distro_group = '%s_%s' % (facts['ansible_distribution'].lower(), facts['ansible_distribution_major_version'])
+            inventory.setdefault(distro_group, dict(hosts=[]))['hosts'].append(name)
+    return inventory
+
+
+def main(args):
+    parser = OptionParser(usage=__doc__.strip())
+    parser.add_option('--list', action='store_true', default=False, help='list the groups and the hosts (default)')
+    parser.add_option('--host', default=None, help='show the variables of the host')
+    parser.add_option('--refresh-cache', action='store_true', default=False, help='query the LXD API ignoring the cache')
+    options, args = parser.parse_args(args)
+    if args:
+        parser.error('no arguments are allowed: %s' % ' '.join(args))
+
+    try:
+        inventory = build_inventory(get_containers(options.refresh_cache))
+    except (IOError, OSError, ValueError, socket.error) as e:
+        sys.stderr.write('lxd_inventory.py: could not list the containers: %s\n' % e)
+        return 1
+
+    if options.host is not None:
+        print(json.dumps(inventory['_meta']['hostvars'].get(options.host, {}), indent=2, sort_keys=True))
+    else:
+        print(json.dumps(inventory, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
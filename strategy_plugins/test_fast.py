@@ -0,0 +1,242 @@
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# test_fast.py is a third party strategy plugin for Ansible
+#
+# test_fast.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# test_fast.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import multiprocessing
+import time
+
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.playbook.included_file import IncludedFile
+from ansible.plugins.strategy import StrategyBase
+from ansible.template import Templar
+from ansible.module_utils._text import to_text
+
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+
+class StrategyModule(StrategyBase):
+    '''
+    A strategy for the test playbooks run in check mode.
+
+    Like the free strategy, each host runs its tasks as fast as it can
+    without waiting for the other hosts. In addition, the read-only test
+    tasks (the test_* actions without register) of a host are run
+    concurrently, up to test_max_concurrent_checks tasks per host
+    (default: 4). Any other task waits until the previous tasks of the
+    host are done, and the next tasks wait for it.
+
+    A changed result of a test task means the test failed. Instead of
+    running the handlers notified by it, the failure is counted in the
+    stats directly and the play ends with failed hosts: the test tasks are
+    run without notify.
+    '''
+
+    DEFAULT_MAX_CONCURRENT_CHECKS = 4
+
+    def __init__(self, tqm):
+        super(StrategyModule, self).__init__(tqm)
+        self._running = dict()         # host name -> number of running tasks
+        self._exclusive = dict()       # host name -> True while a task which is not read-only is running
+        self._max_checks = dict()      # host name -> maximum number of concurrent read-only tasks
+        self._queued = set()           # (host name, task uuid) of the running tasks
+        self._test_failed_hosts = set()
+
+    def _is_read_only(self, task):
+        ''' returns whether the task is a read-only test which can run concurrently with others '''
+        return task.action.startswith('test_') and not task.register
+
+    def _get_max_checks(self, host, play):
+        name = host.get_name()
+        if name not in self._max_checks:
+            host_vars = self._variable_manager.get_vars(loader=self._loader, play=play, host=host)
+            value = Templar(loader=self._loader, variables=host_vars).template(
+                host_vars.get('test_max_concurrent_checks', self.DEFAULT_MAX_CONCURRENT_CHECKS))
+            self._max_checks[name] = max(int(value), 1)
+        return self._max_checks[name]
+
+    def _can_start(self, host, task, play):
+        name = host.get_name()
+        running = self._running.get(name, 0)
+        if self._exclusive.get(name):
+            return False
+        if self._is_read_only(task):
+            return running < self._get_max_checks(host, play)
+        return running == 0
+
+    def _process_pending_results(self, iterator, one_pass=False, max_passes=None):
+        results = super(StrategyModule, self)._process_pending_results(iterator, one_pass=one_pass, max_passes=max_passes)
+        for task_result in results:
+            name = task_result._host.get_name()
+            key = (name, task_result._task._uuid)
+            # NOTE: The results of the handlers, which flush_handlers runs and
+            # processes here too, are not of the tasks queued by run().
+            if key not in self._queued:
+                continue
+            self._queued.remove(key)
+            self._running[name] -= 1
+            self._exclusive[name] = False
+            if self._is_read_only(task_result._task) and task_result.is_changed() and not task_result.is_failed():
+                self._tqm._stats.increment('failures', name)
+                self._test_failed_hosts.add(name)
+        return results
+
+    def run(self, iterator, play_context):
+        '''
+        Gives each host as many of its next tasks as it can run, looping
+        over the hosts like the free strategy, then processes the results.
+        '''
+
+        result = self._tqm.RUN_OK
+
+        # NOTE: The task queue manager starts as many workers as the hosts in
+        # the batch, which is enough only when each host runs one task at a time.
+        hosts = self._inventory.get_hosts(iterator._play.hosts)
+        num_workers = min(self._tqm._options.forks, sum(self._get_max_checks(host, iterator._play) for host in hosts))
+        while len(self._workers) < num_workers:
+            worker = [None, multiprocessing.Queue()]
+            self._tqm._workers.append(worker)
+            self._workers.append(worker)
+
+        work_to_do = True
+        while work_to_do and not self._tqm._terminated:
+
+            hosts_left = [host for host in self._inventory.get_hosts(iterator._play.hosts) if host.name not in self._tqm._unreachable_hosts]
+            if len(hosts_left) == 0:
+                self._tqm.send_callback('v2_playbook_on_no_hosts_remaining')
+                result = False
+                break
+
+            work_to_do = False        # assume we have no more work to do
+
+            host_results = []
+            for host in hosts_left:
+                host_name = host.get_name()
+                while True:
+                    (state, task) = iterator.get_next_task_for_host(host, peek=True)
+                    if not task:
+                        if self._running.get(host_name, 0):
+                            work_to_do = True
+                        break
+
+                    # there is still some work to do for this host
+                    work_to_do = True
+
+                    if not self._can_start(host, task, iterator._play):
+                        display.debug("%s is busy, skipping for now" % host_name)
+                        break
+
+                    (state, task) = iterator.get_next_task_for_host(host)
+
+                    display.debug("getting variables")
+                    task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, host=host, task=task)
+                    self.add_tqm_variables(task_vars, play=iterator._play)
+                    templar = Templar(loader=self._loader, variables=task_vars)
+                    display.debug("done getting variables")
+
+                    try:
+                        task.name = to_text(templar.template(task.name, fail_on_undefined=False), nonstring='empty')
+                    except:
+                        # just ignore any errors during task name templating,
+                        # we don't care if it just shows the raw name
+                        display.debug("templating failed for some reason")
+
+                    # check to see if this task should be skipped, due to it being a member of a
+                    # role which has already run (and whether that role allows duplicate execution)
+                    if task._role and task._role.has_run(host):
+                        if task._role._metadata is None or task._role._metadata and not task._role._metadata.allow_duplicates:
+                            display.debug("'%s' skipped because role has already run" % task)
+                            continue
+
+                    if task.action == 'meta':
+                        self._execute_meta(task, play_context, iterator, target_host=host)
+                        continue
+
+                    if self._step and not self._take_step(task, host_name):
+                        continue
+
+                    self._running[host_name] = self._running.get(host_name, 0) + 1
+                    self._exclusive[host_name] = not self._is_read_only(task)
+                    self._queued.add((host_name, task._uuid))
+                    self._tqm.send_callback('v2_playbook_on_task_start', task, is_conditional=False)
+                    # NOTE: The task starts on each host separately, so tell
+                    # the callbacks the host as newer Ansible does.
+                    self._tqm.send_callback('v2_runner_on_start', host, task)
+                    if self._is_read_only(task):
+                        # NOTE: The copy keeps the uuid, by which the result is
+                        # matched with the original task.
+                        task = task.copy(exclude_tasks=True)
+                        task.notify = None
+                    self._queue_task(host, task, task_vars, play_context)
+                    del task_vars
+
+            results = self._process_pending_results(iterator)
+            host_results.extend(results)
+
+            try:
+                included_files = IncludedFile.process_include_results(
+                    host_results,
+                    self._tqm,
+                    iterator=iterator,
+                    inventory=self._inventory,
+                    loader=self._loader,
+                    variable_manager=self._variable_manager
+                )
+            except AnsibleError:
+                return self._tqm.RUN_ERROR
+
+            if len(included_files) > 0:
+                all_blocks = dict((host, []) for host in hosts_left)
+                for included_file in included_files:
+                    display.debug("collecting new blocks for %s" % included_file)
+                    try:
+                        new_blocks = self._load_included_file(included_file, iterator=iterator)
+                    except AnsibleError as e:
+                        for host in included_file._hosts:
+                            iterator.mark_host_failed(host)
+                        display.warning(str(e))
+                        continue
+
+                    for new_block in new_blocks:
+                        task_vars = self._variable_manager.get_vars(loader=self._loader, play=iterator._play, task=included_file._task)
+                        final_block = new_block.filter_tagged_tasks(play_context, task_vars)
+                        for host in hosts_left:
+                            if host in included_file._hosts:
+                                all_blocks[host].append(final_block)
+                    display.debug("done collecting new blocks for %s" % included_file)
+
+                for host in hosts_left:
+                    iterator.add_tasks(host, all_blocks[host])
+
+            # pause briefly so we don't spin lock
+            time.sleep(C.DEFAULT_INTERNAL_POLL_INTERVAL)
+
+        # collect all the final results
+        self._wait_on_pending_results(iterator)
+
+        if result == self._tqm.RUN_OK and self._test_failed_hosts:
+            result = self._tqm.RUN_FAILED_HOSTS
+
+        # run the base class run() method, which executes the cleanup function
+        # and runs any outstanding handlers which have been triggered
+        return super(StrategyModule, self).run(iterator, play_context, result)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# (c) 2017, Hiroaki Nakamura <hnakamur@gmail.com>
+#
+# test_history.py is a third party tool for the test callback plugin
+#
+# test_history.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# test_history.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Queries the history of the test results which the test callback plugin
+writes to a SQLite database when TEST_CALLBACK_HISTORY_DB is set.
+
+usage: test_history.py [-d DB] COMMAND [ARGS]
+
+commands:
+    runs [-n N]                     shows the last N runs with their counts
+    first-failure HOST TASK [CHECK] shows when the check started failing on the host
+    latency HOST [TASK] [-n N]      shows the latency of the checks on the host in the last N runs
+    regressions [RUN]               shows the checks which passed in the previous run and fail
+                                    in the run (default: the last run), by host
+
+A check is a task, or a check of test_bundle or an item of a loop (for
+example "item=foo") in the task. A changed, failed or unreachable result
+is a failure of the check, as in the recap.
+'''
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sqlite3
+import sys
+import time
+from optparse import OptionParser
+
+FAILING = ('changed', 'failed', 'unreachable')
+FAILING_SQL = "('changed', 'failed', 'unreachable')"
+
+
+def format_time(t):
+    if t is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+
+def check_condition(task, check):
+    ''' returns the WHERE condition and its parameters of a task or a check in the task '''
+    if check is None:
+        return 'task = ?', [task]
+    return 'task = ? AND check_name = ?', [task, check]
+
+
+def show_runs(db, limit):
+    rows = db.execute('''
+        SELECT runs.id, runs.playbook, runs.started, runs.finished, COUNT(results.run_id),
+               SUM(results.status IN %s), COUNT(DISTINCT results.host)
+        FROM runs LEFT JOIN results ON results.run_id = runs.id
+        GROUP BY runs.id ORDER BY runs.id DESC LIMIT ?''' % FAILING_SQL, (limit,)).fetchall()
+    print('%6s  %-19s  %8s  %6s  %8s  %8s  %s' % ('run', 'started', 'time', 'hosts', 'checks', 'failures', 'playbook'))
+    for run_id, playbook, started, finished, checks, failures, hosts in reversed(rows):
+        elapsed = started and finished and '%7.1fs' % (finished - started) or '-'
+        print('%6d  %-19s  %8s  %6d  %8d  %8d  %s' % (run_id, format_time(started), elapsed, hosts, checks, failures or 0, playbook or '-'))
+    return 0
+
+
+def show_first_failure(db, host, task, check):
+    condition, params = check_condition(task, check)
+    rows = db.execute('''
+        SELECT results.run_id, runs.started, SUM(results.status IN %s), MAX(results.msg)
+        FROM results JOIN runs ON runs.id = results.run_id
+        WHERE host = ? AND %s AND status != 'skipped'
+        GROUP BY results.run_id ORDER BY results.run_id DESC''' % (FAILING_SQL, condition), [host] + params).fetchall()
+    if not rows:
+        print('no results of the check on %s' % host)
+        return 1
+
+    run_id, started, failures, msg = rows[0]
+    if not failures:
+        print('passing in the last run %d at %s' % (run_id, format_time(started)))
+        return 0
+
+    # NOTE: Go back to the first failing run after the last passing run.
+    first = rows[0]
+    last_passing = None
+    for row in rows[1:]:
+        if not row[2]:
+            last_passing = row
+            break
+        first = row
+    print('failing since run %d at %s: %s' % (first[0], format_time(first[1]), first[3] or '-'))
+    if last_passing:
+        print('last passed in run %d at %s' % (last_passing[0], format_time(last_passing[1])))
+    else:
+        print('never passed in the history')
+    return 0
+
+
+def show_latency(db, host, task, limit):
+    condition, params = 'host = ?', [host]
+    if task is not None:
+        condition += ' AND task = ?'
+        params.append(task)
+    rows = db.execute('''
+        SELECT results.run_id, runs.started, COUNT(*), AVG(duration), MAX(duration), SUM(duration)
+        FROM results JOIN runs ON runs.id = results.run_id
+        WHERE %s AND duration IS NOT NULL AND status != 'skipped'
+        GROUP BY results.run_id ORDER BY results.run_id DESC LIMIT ?''' % condition, params + [limit]).fetchall()
+    if not rows:
+        print('no results on %s' % host)
+        return 1
+
+    print('%6s  %-19s  %6s  %8s  %8s  %9s  %8s' % ('run', 'started', 'checks', 'avg', 'max', 'total', 'change'))
+    previous = None
+    for run_id, started, count, avg, max_, total in reversed(rows):
+        change = previous and '%+7.0f%%' % ((avg - previous) / previous * 100) or '-'
+        print('%6d  %-19s  %6d  %7.2fs  %7.2fs  %8.2fs  %8s' % (run_id, format_time(started), count, avg, max_, total, change))
+        previous = avg
+    return 0
+
+
+def show_regressions(db, run_id):
+    if run_id is None:
+        run_id = db.execute('SELECT MAX(id) FROM runs').fetchone()[0]
+    previous_id = db.execute('SELECT MAX(id) FROM runs WHERE id < ?', (run_id,)).fetchone()[0]
+    if run_id is None or previous_id is None:
+        print('no previous run to compare with')
+        return 1
+
+    rows = db.execute('''
+        SELECT DISTINCT cur.host, cur.task, cur.check_name, cur.status, cur.msg
+        FROM results cur JOIN results prev
+          ON prev.host = cur.host AND prev.task = cur.task
+             AND (prev.check_name = cur.check_name OR prev.check_name IS NULL AND cur.check_name IS NULL)
+        WHERE cur.run_id = ? AND prev.run_id = ?
+          AND cur.status IN %s AND prev.status NOT IN %s AND prev.status != 'skipped'
+        ORDER BY cur.host, cur.task, cur.check_name''' % (FAILING_SQL, FAILING_SQL), (run_id, previous_id)).fetchall()
+    print('regressions in run %d since run %d: %d hosts' % (run_id, previous_id, len(set(row[0] for row in rows))))
+    host = None
+    for row_host, task, check, status, msg in rows:
+        if row_host != host:
+            host = row_host
+            print('%s:' % host)
+        name = check and '%s (%s)' % (task, check) or task
+        print('    %s: %s%s' % (status, name, msg and ' => %s' % msg or ''))
+    return 0
+
+
+def main(args):
+    parser = OptionParser(usage=__doc__.strip())
+    parser.add_option('-d', '--db', default=os.environ.get('TEST_CALLBACK_HISTORY_DB', 'test-history.db'),
+                      help='the history database (default: $TEST_CALLBACK_HISTORY_DB or test-history.db)')
+    parser.add_option('-n', '--runs', type='int', default=10, help='the number of runs to show (default: 10)')
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('a command is required')
+    if not os.path.exists(options.db):
+        parser.error('no history database %s' % options.db)
+
+    command, args = args[0], args[1:]
+    parser.enable_interspersed_args()
+    options, args = parser.parse_args(args, options)
+
+    db = sqlite3.connect(options.db)
+    try:
+        if command == 'runs' and not args:
+            return show_runs(db, options.runs)
+        elif command == 'first-failure' and len(args) in (2, 3):
+            return show_first_failure(db, args[0], args[1], len(args) == 3 and args[2] or None)
+        elif command == 'latency' and len(args) in (1, 2):
+            return show_latency(db, args[0], len(args) == 2 and args[1] or None, options.runs)
+        elif command == 'regressions' and len(args) in (0, 1):
+            return show_regressions(db, args and int(args[0]) or None)
+        parser.error('invalid command or arguments: %s' % ' '.join([command] + args))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))